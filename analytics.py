@@ -0,0 +1,226 @@
+"""
+Pre-aggregated analytics for the admin dashboard.
+
+Instead of aggregating the documents and credit_requests tables on every
+dashboard load, small rollup tables are kept up to date by the writes that
+change them, inside the same transaction:
+
+    daily_user_scans      scans per user per day      (Document.save / save_many)
+    topic_scan_counts     scans per filename topic    (Document.save / save_many)
+    user_activity_totals  scans and approved credits per user
+    credit_request_totals requests and credits per request status
+
+The dashboard then only reads these tables. Databases that already hold
+history (or rollups that drifted, e.g. after rows were edited by hand) are
+rebuilt from the base tables with:
+
+    python -m analytics backfill [--database new_database.db]
+"""
+import argparse
+import sqlite3
+
+import db
+from db import get_db_connection
+
+TOP_TOPICS = 10  # Topics listed on the dashboard
+TOP_USERS = 10  # Users listed on the dashboard
+SCAN_DAYS = 30  # Days of per-user scan counts listed on the dashboard
+
+# Dashboard reads, module-level so `python -m migrations check` plans the statements actually run
+DASHBOARD_SCANS_PER_USER = """
+    SELECT u.username, s.scan_day, s.scan_count
+    FROM daily_user_scans s
+    JOIN users u ON s.user_id = u.id
+    WHERE s.scan_day >= DATE('now', ?)
+    ORDER BY s.scan_day DESC, s.scan_count DESC, u.username
+"""
+DASHBOARD_TOP_TOPICS = "SELECT topic, scan_count FROM topic_scan_counts ORDER BY scan_count DESC, topic LIMIT ?"
+# Walks the rank index of user_activity_totals and stops after LIMIT rows; users are looked up only for those
+DASHBOARD_TOP_USERS = """
+    SELECT u.username, t.total_scans, t.approved_credits AS total_credits_used
+    FROM user_activity_totals t
+    JOIN users u ON u.id = t.user_id
+    ORDER BY t.total_scans DESC, t.approved_credits DESC, t.user_id
+    LIMIT ?
+"""
+# Users who never scanned nor got credits approved have no totals row; only read when the top list is short
+DASHBOARD_IDLE_USERS = """
+    SELECT u.username, 0 AS total_scans, NULL AS total_credits_used
+    FROM users u
+    WHERE NOT EXISTS (SELECT 1 FROM user_activity_totals t WHERE t.user_id = u.id)
+    ORDER BY u.username
+    LIMIT ?
+"""
+
+
+def record_scans(cursor, documents):
+    """
+    Adds newly saved documents to the scan rollups.
+
+    Must run in the transaction that inserted the documents.
+
+    Args:
+        cursor: Cursor of that transaction.
+        documents: The Document objects that were inserted.
+    """
+    # Topic and day are derived in SQL exactly as the backfill derives them from the documents table
+    cursor.executemany("""
+        INSERT INTO daily_user_scans (user_id, scan_day, scan_count) VALUES (?, DATE(?), 1)
+        ON CONFLICT (user_id, scan_day) DO UPDATE SET scan_count = scan_count + 1
+    """, [(document.user_id, document.scan_date) for document in documents])
+    cursor.executemany("""
+        INSERT INTO topic_scan_counts (topic, scan_count) VALUES (SUBSTR(?1, 1, INSTR(?1, '.') - 1), 1)
+        ON CONFLICT (topic) DO UPDATE SET scan_count = scan_count + 1
+    """, [(document.filename,) for document in documents])
+    cursor.executemany("""
+        INSERT INTO user_activity_totals (user_id, total_scans) VALUES (?, 1)
+        ON CONFLICT (user_id) DO UPDATE SET total_scans = total_scans + 1
+    """, [(document.user_id,) for document in documents])
+
+
+def record_credit_request(cursor, requested_credits):
+    """Counts a new (pending) credit request. Must run in the transaction that inserted it."""
+    _add_credit_request_total(cursor, 'pending', 1, requested_credits)
+
+
+def record_credit_request_status(cursor, user_id, requested_credits, old_status, new_status):
+    """
+    Moves a credit request between statuses in the rollups.
+
+    Must run in the transaction that updated the request.
+
+    Args:
+        cursor: Cursor of that transaction.
+        user_id: Requesting user.
+        requested_credits: Credits of the request.
+        old_status: Status before the update.
+        new_status: Status after the update.
+    """
+    if old_status == new_status:
+        return
+    _add_credit_request_total(cursor, old_status, -1, -requested_credits)
+    _add_credit_request_total(cursor, new_status, 1, requested_credits)
+    if new_status == 'approved':
+        cursor.execute("""
+            INSERT INTO user_activity_totals (user_id, approved_credits) VALUES (?, ?)
+            ON CONFLICT (user_id) DO UPDATE SET approved_credits = COALESCE(approved_credits, 0) + excluded.approved_credits
+        """, (user_id, requested_credits))
+    elif old_status == 'approved':
+        # Back to NULL once nothing is approved, as the backfill leaves users without approved requests
+        cursor.execute("""
+            UPDATE user_activity_totals SET approved_credits = NULLIF(COALESCE(approved_credits, 0) - ?, 0)
+            WHERE user_id = ?
+        """, (requested_credits, user_id))
+
+
+def _add_credit_request_total(cursor, status, requests, credits):
+    cursor.execute("""
+        INSERT INTO credit_request_totals (status, request_count, requested_credits) VALUES (?, ?, ?)
+        ON CONFLICT (status) DO UPDATE SET request_count = request_count + excluded.request_count,
+                                           requested_credits = requested_credits + excluded.requested_credits
+    """, (status, requests, credits))
+
+
+def backfill(conn):
+    """
+    Rebuilds every rollup table from the documents and credit_requests tables in one transaction.
+
+    Returns:
+        The number of documents and credit requests that were aggregated.
+    """
+    cursor = conn.cursor()
+    try:
+        cursor.execute("BEGIN IMMEDIATE")  # No scans or approvals may slip in between the delete and the rebuild
+        for table in ('daily_user_scans', 'topic_scan_counts', 'user_activity_totals', 'credit_request_totals'):
+            cursor.execute(f"DELETE FROM {table}")
+        cursor.execute("""
+            INSERT INTO daily_user_scans (user_id, scan_day, scan_count)
+            SELECT user_id, DATE(scan_date), COUNT(*) FROM documents GROUP BY user_id, DATE(scan_date)
+        """)
+        cursor.execute("""
+            INSERT INTO topic_scan_counts (topic, scan_count)
+            SELECT SUBSTR(filename, 1, INSTR(filename, '.') - 1) AS topic, COUNT(*) FROM documents GROUP BY topic
+        """)
+        # Scans and approved credits are aggregated separately, so neither multiplies the other
+        cursor.execute("""
+            INSERT INTO user_activity_totals (user_id, total_scans, approved_credits)
+            SELECT user_id, SUM(scans), SUM(credits) FROM (
+                SELECT user_id, COUNT(*) AS scans, NULL AS credits FROM documents GROUP BY user_id
+                UNION ALL
+                SELECT user_id, 0, SUM(requested_credits) FROM credit_requests WHERE status = 'approved' GROUP BY user_id
+            ) GROUP BY user_id
+        """)
+        cursor.execute("""
+            INSERT INTO credit_request_totals (status, request_count, requested_credits)
+            SELECT status, COUNT(*), COALESCE(SUM(requested_credits), 0) FROM credit_requests GROUP BY status
+        """)
+        documents = cursor.execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+        credit_requests = cursor.execute("SELECT COUNT(*) FROM credit_requests").fetchone()[0]
+        conn.commit()
+        return documents, credit_requests
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+
+
+def get_dashboard(conn):
+    """
+    Reads the admin dashboard figures from the rollup tables.
+
+    Every read is bounded: scans_per_user covers the last SCAN_DAYS days (read through the
+    scan_day index), and topics and users are the first TOP_TOPICS and TOP_USERS rows of
+    the rollups' rank indexes. Users without any activity only fill up a short top_users list.
+
+    Returns:
+        A dictionary with scans_per_user, common_topics, top_users and credit_stats.
+    """
+    cursor = conn.cursor()
+    cursor.execute(DASHBOARD_SCANS_PER_USER, (f"-{SCAN_DAYS - 1} days",))
+    scans_per_user = [dict(row) for row in cursor.fetchall()]
+
+    cursor.execute(DASHBOARD_TOP_TOPICS, (TOP_TOPICS,))
+    common_topics = [dict(row) for row in cursor.fetchall()]
+
+    cursor.execute(DASHBOARD_TOP_USERS, (TOP_USERS,))
+    top_users = [dict(row) for row in cursor.fetchall()]
+    if len(top_users) < TOP_USERS:
+        cursor.execute(DASHBOARD_IDLE_USERS, (TOP_USERS - len(top_users),))
+        top_users.extend(dict(row) for row in cursor.fetchall())
+
+    totals = {row['status']: row for row in cursor.execute(
+        "SELECT status, request_count, requested_credits FROM credit_request_totals")}
+    request_count = sum(row['request_count'] for row in totals.values())
+    total_credits = sum(row['requested_credits'] for row in totals.values())
+    credit_stats = {
+        'total_credits_used': total_credits if request_count else None,
+        'avg_credits_used': total_credits / request_count if request_count else None,
+        'approved_credits': totals['approved']['requested_credits'] if 'approved' in totals else (0 if request_count else None),
+        'pending_credits': totals['pending']['requested_credits'] if 'pending' in totals else (0 if request_count else None),
+    }
+
+    return {
+        'scans_per_user': scans_per_user,
+        'common_topics': common_topics,
+        'top_users': top_users,
+        'credit_stats': credit_stats,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m analytics', description='Admin analytics maintenance.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    command = commands.add_parser('backfill', help='rebuild the analytics rollup tables from the full history')
+    command.add_argument('--database', default=db.DATABASE, help='SQLite database file')
+    args = parser.parse_args(argv)
+
+    db.DATABASE = args.database
+    conn = get_db_connection()
+    try:
+        documents, credit_requests = backfill(conn)
+    finally:
+        conn.close()
+    print(f"Rebuilt analytics rollups from {documents} documents and {credit_requests} credit requests")
+
+
+if __name__ == '__main__':
+    main()
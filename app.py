@@ -1,27 +1,53 @@
-from flask import Flask, request, jsonify, session, render_template #We are adding session from Flask because we'll use Flask's built-in session management to keep users logged in after successful login. We are also adding render_template because we will need to serve the login.html file later.
+from flask import Flask, Response, request, jsonify, session, render_template #We are adding session from Flask because we'll use Flask's built-in session management to keep users logged in after successful login. We are also adding render_template because we will need to serve the login.html file later.
 import sqlite3
 from werkzeug.utils import secure_filename
-from models import User, Document
+from models import User, Document, ScanJob, DOCUMENT_KEYS, USER_CACHE, PENDING_CREDIT_REQUESTS, CREDIT_REQUEST_BY_ID
+import db
 from db import get_db_connection 
+from search_index import InvertedIndex
+from index_snapshot import save_snapshot, load_snapshot, SnapshotError
+from similarity_engine import SimilarityEngine
+from shards import ShardCoordinator, ShardError
+from match_store import MatchStore
+from result_cache import ResultCache
+import analytics
+from metrics import REGISTRY, REQUEST_STAGE_SECONDS, StageTimer
+from sampling_profiler import SamplingProfiler, PROFILE_INTERVAL
+from near_duplicates import MinHashLSH, SignatureAccumulator
+from storage import store_upload
+from job_queue import ScanWorkerPool
+from streaming_ingest import StreamingTokenizer, PUNCTUATION, READ_CHUNK_SIZE, SNIPPET_LENGTH, analyze_text_file
+import extraction
+from extraction import TextExtractor, ExtractionError, EXTRACTION_TIMEOUT
+from segment_store import SegmentStore, sync_with_uploads, COMPACT_DEAD_RATIO
 from functools import wraps # Import wraps for decorator best practices
-import re
 import os
 import math
+import atexit
+import threading
 from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 from apscheduler.schedulers.background import BackgroundScheduler
 
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'qwerty1234'  # this should be a long random string
+db.init_app(app)  # One pooled database connection per request, returned to the pool on teardown
 
+# Armed by an admin through /admin/profile, samples the stack of the next (matching) request
+PROFILER = SamplingProfiler()
+
+@app.before_request
+def start_profiler():
+    PROFILER.start(request.path)
+
+@app.teardown_request
+def stop_profiler(exception=None):
+    PROFILER.stop()
+
+# Credits are reset lazily per user (see models.DAILY_CREDITS), so there is no nightly reset job
 scheduler = BackgroundScheduler(daemon=True)
-scheduler.add_job(
-    id='daily_credit_reset',
-    func=lambda: User.reset_all_credits(),
-    trigger='cron',
-    hour=0,  # Runs daily at midnight
-    timezone='UTC'
-)
 scheduler.start()
 
 ###FRONTEND ROUTES
@@ -147,7 +173,7 @@ def preprocess_text(text):
         A list of preprocessed words.
     """
     text = text.lower()  # Convert text to lowercase
-    text = re.sub(r'[^\w\s]', '', text)  # Remove punctuation using regular expressions
+    text = PUNCTUATION.sub('', text)  # Remove punctuation with the precompiled pattern shared with StreamingTokenizer
     words = text.split()  # Split text into words (by whitespace)
     return words
 
@@ -222,64 +248,333 @@ def cosine_similarity(vec1, vec2):
     # Calculate cosine similarity
     return dot_product / (magnitude1 * magnitude2)
 
+# Text of PDF (and, with OCR installed, image) uploads, extracted on a process pool and cached by content hash
+TEXT_EXTRACTION_TIMEOUT = float(os.environ.get('TEXT_EXTRACTION_TIMEOUT', EXTRACTION_TIMEOUT))  # Seconds per document
+TEXT_EXTRACTOR = TextExtractor(timeout=TEXT_EXTRACTION_TIMEOUT)
+atexit.register(TEXT_EXTRACTOR.shutdown)
+
+def upload_text_path(filename):
+    """Returns the path of the text a stored upload is indexed by, or None (see extraction.upload_text_path)."""
+    return extraction.upload_text_path('uploads', filename, TEXT_EXTRACTOR.cache_folder)
+
+# The text of every indexed upload, packed into a few large segment files read through mmap;
+# uploads/ keeps the original files
+CORPUS_FOLDER = 'corpus_segments'
+CORPUS_COMPACT_DEAD_RATIO = float(os.environ.get('CORPUS_COMPACT_DEAD_RATIO', COMPACT_DEAD_RATIO))  # Dead share that triggers compaction of a segment
+CORPUS_STORE = SegmentStore(CORPUS_FOLDER)
+atexit.register(CORPUS_STORE.close)
+
+def store_corpus_text(doc_key, text_path):
+    """Adds the text of a newly indexed upload to CORPUS_STORE (once per stored content)."""
+    if doc_key in CORPUS_STORE:
+        return
+    try:
+        CORPUS_STORE.put_file(doc_key, text_path)
+    except OSError as e:
+        print(f"Error adding {doc_key} to the corpus store: {e}")
+
+def iter_corpus_texts(doc_ids=None):
+    """
+    Decodes the text of stored documents from CORPUS_STORE, one document at a time.
+
+    Args:
+        doc_ids: Keys to read (default: every stored document); missing keys are skipped.
+
+    Yields:
+        (doc_id, text) tuples.
+    """
+    for doc_id in CORPUS_STORE.keys() if doc_ids is None else doc_ids:
+        view = CORPUS_STORE.get(doc_id)
+        if view is None:
+            continue
+        try:
+            yield doc_id, str(view, 'utf-8')  # Decoded straight from the mapped segment
+        except UnicodeDecodeError as e:
+            print(f"Error reading {doc_id}: {e}")
+
+def corpus_snippet(doc_key):
+    """Returns the content_snippet of a stored document, decoded from the first bytes of its record only."""
+    head = CORPUS_STORE.head(doc_key, 4 * (SNIPPET_LENGTH + 1))  # A UTF-8 character takes at most 4 bytes
+    if head is None:
+        return None
+    # A character cut at the end of the slice only happens past SNIPPET_LENGTH characters
+    text = str(head, 'utf-8', 'replace')
+    return text[:SNIPPET_LENGTH] + "..." if len(text) > SNIPPET_LENGTH else text
+
+def feed_text_file(tokenizer, path):
+    """Feeds a stored text file to a StreamingTokenizer chunk by chunk and closes it."""
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            tokenizer.feed(chunk)
+    tokenizer.close()
+
+def failed_analysis(error):
+    """An analyze_text_file-style result for an upload whose text could not be extracted."""
+    return {'term_counts': Counter(), 'total_words': 0, 'signature': None, 'content_snippet': None, 'error': str(error)}
+
 def get_documents_from_uploads():
     """
-    Reads all text files from the uploads directory and returns their content.
+    Reads the text of every stored upload from the corpus store (the extracted
+    text, for uploads that are not plain text).
 
     Returns:
         A dictionary mapping filenames to their content.
     """
-    documents = {}
-    upload_folder = 'uploads'
-    
-    # Make sure the folder exists
-    os.makedirs(upload_folder, exist_ok=True)
-    
-    # Read all text files in the uploads folder
-    for filename in os.listdir(upload_folder):
-        filepath = os.path.join(upload_folder, filename)
-        
-        # Only process text files for now
-        if filename.endswith('.txt') and os.path.isfile(filepath):
-            try:
-                with open(filepath, 'r', encoding='utf-8') as f:
-                    content = f.read()
-                documents[filename] = content
-            except Exception as e:
-                print(f"Error reading {filename}: {e}")
-    
-    return documents
+    return dict(iter_corpus_texts())
 
-# This will be called when the Flask app starts and whenever we need fresh data
-def update_document_vectors():
-    # Get documents from uploads folder
-    stored_documents = get_documents_from_uploads()
-    
-    if not stored_documents:
+# This will be called when the Flask app starts (or when the index has to be rebuilt from scratch)
+def update_document_vectors(listeners=()):
+    """
+    Builds a fresh inverted index from every document in the corpus store.
+
+    Args:
+        listeners: Objects to attach to the new index before it is filled (see InvertedIndex.listeners).
+
+    Returns:
+        An InvertedIndex containing all stored documents, keyed by filename.
+    """
+    index = InvertedIndex()
+    index.listeners.extend(listeners)
+
+    if not len(CORPUS_STORE):
         print("Warning: No documents found in uploads folder.")
-        return {}, {}, []
-    
-    # Preprocess all documents
-    preprocessed_docs = {doc_id: preprocess_text(content) for doc_id, content in stored_documents.items()}
-    
-    # Calculate document frequency across all documents
-    all_doc_words = list(preprocessed_docs.values())
-    idf = calculate_document_frequency(all_doc_words)
-    
-    # Calculate TF-IDF vectors for all documents
-    tfidf_vectors = {}
-    for doc_id, words in preprocessed_docs.items():
-        tf = calculate_term_frequency(words)
-        tfidf_vectors[doc_id] = calculate_tfidf_vector(tf, idf)
-    
-    return stored_documents, tfidf_vectors, idf
+        return index
+
+    # One document decoded at a time, instead of the whole corpus held as strings
+    for doc_id, content in iter_corpus_texts():
+        index.add_document(doc_id, preprocess_text(content))
+
+    return index
+
+INDEX_SNAPSHOT_PATH = 'index.snapshot'  # Binary snapshot of DOCUMENT_INDEX used for fast warm startup
+NEAR_DUPLICATE_INDEX_PATH = 'near_duplicates.npz'  # MinHash signatures of NEAR_DUPLICATE_INDEX
+LSH_BANDS = 16  # More bands: near-duplicates are found more reliably
+LSH_ROWS = 8  # More rows per band: fewer (and closer) candidates to check
+NEAR_DUPLICATE_MIN_JACCARD = 0.5  # Minimum estimated Jaccard similarity reported by mode=near_duplicate
+INDEX_LOCK = threading.RLock()  # Guards the document indexes against concurrent scans and snapshot saves
+_snapshot_generation = None  # Index generation of the last snapshot written or loaded
+_near_duplicate_generation = None  # Same for the near-duplicate index
+
+def get_corpus_versions():
+    """
+    Collects the location of every document's record in the corpus store, which
+    changes whenever the document is stored again (or moved by compaction).
+
+    Returns:
+        A dictionary mapping filenames to (segment, offset) tuples.
+    """
+    return {doc_id: CORPUS_STORE.location(doc_id) for doc_id in CORPUS_STORE.keys()}
+
+def save_index_snapshot(index):
+    """Writes the index snapshots if the indexes changed since they were last written or loaded."""
+    global _snapshot_generation, _near_duplicate_generation
+    with INDEX_LOCK:
+        if index.generation != _snapshot_generation:
+            doc_versions = get_corpus_versions()
+            try:
+                save_snapshot(index, INDEX_SNAPSHOT_PATH, doc_versions)
+                _snapshot_generation = index.generation
+            except OSError as e:
+                print(f"Error saving index snapshot: {e}")
+
+        near_duplicate_index = globals().get('NEAR_DUPLICATE_INDEX')
+        if near_duplicate_index is not None and near_duplicate_index.generation != _near_duplicate_generation:
+            try:
+                near_duplicate_index.save(NEAR_DUPLICATE_INDEX_PATH)
+                _near_duplicate_generation = near_duplicate_index.generation
+            except OSError as e:
+                print(f"Error saving near-duplicate index: {e}")
 
-# Initialize document data variables
-STORED_DOCUMENTS, DOCUMENT_VECTORS, GLOBAL_IDF = {}, {}, {}
+def load_document_index(listeners=()):
+    """
+    Restores the document index from its snapshot and replays only the documents
+    added, changed or deleted in the corpus store since the snapshot was written. Falls back to a
+    full rebuild when the snapshot is missing, corrupt or from another version.
+
+    Args:
+        listeners: Objects to attach to the index before any document is replayed.
+
+    Returns:
+        The ready-to-use InvertedIndex.
+    """
+    global _snapshot_generation
+    try:
+        index, snapshot_versions = load_snapshot(INDEX_SNAPSHOT_PATH)
+    except SnapshotError as e:
+        print(f"Index snapshot not usable, rebuilding from uploads: {e}")
+        index = update_document_vectors(listeners)
+        save_index_snapshot(index)
+        return index
+
+    _snapshot_generation = index.generation
+    index.listeners.extend(listeners)
+    current_versions = get_corpus_versions()
+
+    # Drop documents whose upload is gone
+    for doc_id in [doc_id for doc_id in index.doc_ids() if doc_id not in current_versions]:
+        index.remove_document(doc_id)
+
+    # Replay documents that are new or were stored again after the snapshot
+    changed = [doc_id for doc_id, version in current_versions.items() if snapshot_versions.get(doc_id) != version]
+    for doc_id, content in iter_corpus_texts(changed):
+        index.add_document(doc_id, preprocess_text(content))
+
+    save_index_snapshot(index)
+    return index
+
+def load_near_duplicate_index():
+    """Restores the MinHash LSH index from disk, or starts an empty one if that is not possible."""
+    global _near_duplicate_generation
+    try:
+        near_duplicate_index = MinHashLSH.load(NEAR_DUPLICATE_INDEX_PATH, LSH_BANDS, LSH_ROWS)
+        _near_duplicate_generation = near_duplicate_index.generation
+        return near_duplicate_index
+    except ValueError as e:
+        print(f"Near-duplicate index not usable, rebuilding: {e}")
+        return MinHashLSH(bands=LSH_BANDS, rows=LSH_ROWS)
+
+def sync_near_duplicate_index(near_duplicate_index, index):
+    """Brings the LSH index in line with the document index after startup (e.g. after a rebuild)."""
+    for doc_id in [doc_id for doc_id in near_duplicate_index.signatures if doc_id not in index]:
+        near_duplicate_index.remove(doc_id)
+
+    missing = [doc_id for doc_id in index.doc_ids() if doc_id not in near_duplicate_index and index.length(doc_id)]
+    for doc_id, content in iter_corpus_texts(missing):
+        near_duplicate_index.add(doc_id, near_duplicate_index.signature(preprocess_text(content)))
+
+def compact_corpus_store():
+    """Rewrites corpus segments that are mostly deleted documents and removes them."""
+    global _snapshot_generation
+    if CORPUS_STORE.compact(CORPUS_COMPACT_DEAD_RATIO):
+        with INDEX_LOCK:
+            _snapshot_generation = None  # Records moved: the next snapshot saves their new locations
+
+# Initialize the document index (restored at import time so it is also ready under a WSGI server)
+# Uploads added or deleted by hand while the app was stopped are picked up from one listing of the folder
+sync_with_uploads(CORPUS_STORE, 'uploads', upload_text_path)
+NEAR_DUPLICATE_INDEX = load_near_duplicate_index()  # Kept in sync with DOCUMENT_INDEX through its listener hook
+DOCUMENT_INDEX = load_document_index(listeners=[NEAR_DUPLICATE_INDEX])
+sync_near_duplicate_index(NEAR_DUPLICATE_INDEX, DOCUMENT_INDEX)
+SIMILARITY_ENGINE = SimilarityEngine(DOCUMENT_INDEX)  # Kept in sync with DOCUMENT_INDEX through its listener hook
+
+# Optional scatter-gather search over shard server processes, partitioned by document key
+SEARCH_SHARDS = int(os.environ.get('SEARCH_SHARDS', 0))  # Local shard processes; 0 searches in this process
+SEARCH_SHARD_ADDRESSES = [address for address in os.environ.get('SEARCH_SHARD_ADDRESSES', '').split(',') if address]  # Shard servers started with python -m shards serve
+SHARDED_SEARCH = None  # Kept in sync with DOCUMENT_INDEX through its listener hook
+if SEARCH_SHARDS or SEARCH_SHARD_ADDRESSES:
+    try:
+        SHARDED_SEARCH = ShardCoordinator(DOCUMENT_INDEX, shards=SEARCH_SHARDS, addresses=SEARCH_SHARD_ADDRESSES,
+                                          authkey=os.environ.get('SEARCH_SHARD_AUTHKEY', '').encode('utf-8') or None)
+        atexit.register(SHARDED_SEARCH.close)
+    except ShardError as e:
+        print(f"Sharded search not available, searching in process: {e}")
+MATCHES_TOP_N = int(os.environ.get('MATCHES_TOP_N', 20))  # Neighbours materialized per document for /matches
+MATCHES_REFRESH_DRIFT = float(os.environ.get('MATCHES_REFRESH_DRIFT', 0.05))  # Share of changed documents that triggers a refresh
+MATCH_STORE = MatchStore(DOCUMENT_INDEX, SIMILARITY_ENGINE, INDEX_LOCK, top_n=MATCHES_TOP_N,
+                         drift_threshold=MATCHES_REFRESH_DRIFT)  # Updated at ingest through its listener hook
+MATCH_STORE.load()
+
+def maintain_match_store():
+    """
+    Enters new documents into the neighbour lists they qualify for, persists changed lists,
+    and recomputes all of them once IDF drift passes the threshold.
+    """
+    MATCH_STORE.merge_new_documents()
+    MATCH_STORE.flush()
+    MATCH_STORE.refresh_if_drifted()
+
+# Maintain the neighbour lists in the background, and persist them on shutdown
+scheduler.add_job(
+    id='document_matches',
+    func=maintain_match_store,
+    trigger='interval',
+    minutes=1,
+    max_instances=1
+)
+atexit.register(MATCH_STORE.flush)
+
+# Reclaim the space of deleted documents in the background
+scheduler.add_job(
+    id='corpus_compaction',
+    func=compact_corpus_store,
+    trigger='interval',
+    minutes=10,
+    max_instances=1
+)
+
+RESULT_CACHE_MAX_BYTES = int(os.environ.get('RESULT_CACHE_MAX_BYTES', 32 * 1024 * 1024))  # Memory for cached similarity results
+RESULT_CACHE_TTL = float(os.environ.get('RESULT_CACHE_TTL', 300))  # Seconds a cached result stays valid
+RESULT_CACHE = ResultCache(max_bytes=RESULT_CACHE_MAX_BYTES, ttl=RESULT_CACHE_TTL)
+
+# Index size and cache gauges, read when /admin/metrics is rendered
+REGISTRY.gauge('docscan_index_documents', 'Documents in the TF-IDF index.', lambda: len(DOCUMENT_INDEX))
+REGISTRY.gauge('docscan_index_vocabulary_terms', 'Distinct terms in the TF-IDF index.', lambda: len(DOCUMENT_INDEX.vocabulary))
+REGISTRY.gauge('docscan_index_postings_bytes', 'Bytes held by the postings arrays of the TF-IDF index.',
+               lambda: DOCUMENT_INDEX.postings_bytes())
+REGISTRY.gauge('docscan_match_store_drift', 'Share of the corpus changed since the last neighbour refresh.',
+               lambda: MATCH_STORE.drift())
+REGISTRY.gauge('docscan_result_cache_entries', 'Entries in the similarity result cache.', lambda: RESULT_CACHE.stats()['entries'])
+REGISTRY.gauge('docscan_result_cache_bytes', 'Estimated bytes of the similarity result cache.', lambda: RESULT_CACHE.stats()['bytes'])
+REGISTRY.gauge('docscan_result_cache_hit_rate', 'Hit rate of the similarity result cache.', lambda: RESULT_CACHE.stats()['hit_rate'])
+REGISTRY.gauge('docscan_user_cache_hit_rate', 'Hit rate of the user cache.', lambda: USER_CACHE.stats()['hit_rate'])
+REGISTRY.gauge('docscan_search_shards_connected', 'Search shards queried by this process (0: searching in process).',
+               lambda: SHARDED_SEARCH.shards if SHARDED_SEARCH is not None and SHARDED_SEARCH.stats()['connected'] else 0)
+REGISTRY.gauge('docscan_corpus_segments', 'Segment files of the corpus store.', lambda: CORPUS_STORE.stats()['segments'])
+REGISTRY.gauge('docscan_corpus_dead_ratio', 'Share of the corpus store taken by deleted or replaced documents.',
+               lambda: CORPUS_STORE.stats()['dead_ratio'])
+
+def cached_top_k(doc_key, k, min_score=0.0):
+    """
+    Best matches of an indexed document, answered from RESULT_CACHE while the index generation is unchanged.
+
+    Ranked by the vectorized SimilarityEngine (one sparse mat-vec and an argpartition), whose
+    row norms follow every ingest incrementally.
+
+    Must be called while holding INDEX_LOCK.
+
+    Returns:
+        A list of (doc_id, similarity) tuples, or None if the document is not indexed.
+    """
+    # Stored uploads are keyed by their content hash, so identical text shares one entry
+    cache_key = (doc_key, k, min_score)
+    matches = RESULT_CACHE.get(cache_key, DOCUMENT_INDEX.generation)
+    if matches is None:
+        query_vector = DOCUMENT_INDEX.tfidf_vector(doc_key)
+        if query_vector is None:
+            return None
+        matches = None
+        if SHARDED_SEARCH is not None:
+            try:
+                matches = SHARDED_SEARCH.top_k(query_vector, k, min_score=min_score, exclude=doc_key)
+            except ShardError as e:
+                print(f"Error querying search shards, searching in process: {e}")
+        if matches is None:
+            matches = SIMILARITY_ENGINE.query(query_vector, k=k, exclude=doc_key, min_score=min_score)
+        RESULT_CACHE.put(cache_key, matches, DOCUMENT_INDEX.generation)
+    return matches
+
+# Persist index changes periodically and on shutdown
+scheduler.add_job(
+    id='index_snapshot',
+    func=lambda: save_index_snapshot(DOCUMENT_INDEX),
+    trigger='interval',
+    minutes=5
+)
+atexit.register(lambda: save_index_snapshot(DOCUMENT_INDEX))
 
 
 #Scan endpoint
+SCAN_TOP_K = 5  # Number of best matches reported in document_similarities
+SCAN_MODES = {'similarity', 'near_duplicate'}  # TF-IDF cosine similarity, or MinHash/LSH near-duplicate check
 ALLOWED_EXTENSIONS = {'txt', 'pdf', 'png', 'jpg', 'jpeg'} # Or similar set of allowed extensions
+SCAN_BATCH_MAX_FILES = 1000  # Most files accepted by one /scan/batch request
+SCAN_BATCH_WORKERS = os.cpu_count() or 1  # Worker processes tokenizing batch uploads
+SCAN_JOB_WORKERS = int(os.environ.get('SCAN_JOB_WORKERS', 2))  # Threads running asynchronous /scan?async=1 jobs
+_scan_pool = None
+_scan_pool_lock = threading.Lock()
 
 def allowed_file(filename):
     return '.' in filename and \
@@ -306,29 +601,18 @@ def calculate_word_overlap_similarity(doc1_frequencies, doc2_frequencies):
     overlap_score = len(common_words) # Word overlap score is the number of common words
     return overlap_score
 
-STORED_DOCUMENTS = {}
-DOCUMENT_VECTORS = {} 
-GLOBAL_IDF = {}
-
 @app.route('/scan', methods=['POST'])
 @role_required('user')
 def scan_document():
-    # --- Credit Deduction Logic ---
-
-    global STORED_DOCUMENTS, DOCUMENT_VECTORS, GLOBAL_IDF
-
     user_id = session.get('user_id')
-    user = User.get_user_by_id(user_id)
-
-    if not user:
-        return jsonify({'message': 'User not found'}), 404
+    timer = StageTimer(REQUEST_STAGE_SECONDS, 'scan')  # Per-stage latency, see /admin/metrics
 
-    if user.total_credits <= 0:
-        return jsonify({'message': 'Insufficient credits'}), 402
+    scan_mode = request.args.get('mode') or request.form.get('mode') or 'similarity'
+    if scan_mode not in SCAN_MODES:
+        return jsonify({'message': f'Unknown scan mode: {scan_mode}'}), 400
 
-    User.decrement_credits(user_id)
-    
     # --- Document Upload Handling ---
+    # Requests that cannot be scanned are rejected before any credit is taken
     if 'document' not in request.files:
         return jsonify({'message': 'No document part'}), 400
 
@@ -337,87 +621,159 @@ def scan_document():
     if file.filename == '':
         return jsonify({'message': 'No selected file'}), 400
 
-    if file and allowed_file(file.filename):
-        filename = secure_filename(file.filename)
-        upload_folder = 'uploads'
-        os.makedirs(upload_folder, exist_ok=True)
-        filepath = os.path.join(upload_folder, filename)
-        file.save(filepath)
+    if not (file and allowed_file(file.filename)):
+        return jsonify({'message': 'Error uploading document'}), 500
 
-        # --- Document Processing ---
-        scan_results = {}
-        file_extension = filename.rsplit('.', 1)[1].lower()
-        
-        if file_extension == 'txt':
-            document_type = "Text Document"
-            try:
-                with open(filepath, 'r', encoding='utf-8') as f:
-                    uploaded_document_content = f.read()
-                
-                # Process the document content
-                preprocessed_words = preprocess_text(uploaded_document_content)
-                term_frequencies = calculate_term_frequency(preprocessed_words)
-                
-                # Calculate TF-IDF for the uploaded document
-                uploaded_tfidf = calculate_tfidf_vector(term_frequencies, GLOBAL_IDF)
-                
-                # Get a content snippet for display
-                content_snippet = uploaded_document_content[:200] + "..." if len(uploaded_document_content) > 200 else uploaded_document_content
-                
-                # Refresh document vectors to include any new documents
-                
-                STORED_DOCUMENTS, DOCUMENT_VECTORS, GLOBAL_IDF = update_document_vectors()
-                
-                # Calculate similarity with all stored documents
-                document_similarities = {}
-                for doc_id, doc_vector in DOCUMENT_VECTORS.items():
-                    # Skip comparing to itself if it's already in the stored documents
-                    if doc_id == filename:
-                        continue
-                    similarity_score = cosine_similarity(uploaded_tfidf, doc_vector)
-                    document_similarities[doc_id] = similarity_score
-                
-                # Find the best match
-                best_match_doc_id = "No Match Found"
-                max_similarity_score = 0
-                for doc_id, score in document_similarities.items():
-                    if score > max_similarity_score:
-                        max_similarity_score = score
-                        best_match_doc_id = doc_id
+    # --- Credit Deduction Logic ---
+    # Balance check and deduction are one UPDATE, so concurrent scans cannot overdraw
+    reserved = User.reserve_credits(user_id)
+    timer.lap('reserve_credits')
+    if reserved is None:
+        if User.get_user_by_id(user_id) is None:
+            return jsonify({'message': 'User not found'}), 404
+        return jsonify({'message': 'Insufficient credits'}), 402
+
+    # Failed scans are not charged
+    try:
+        response = process_scan_upload(user_id, file, scan_mode, timer)
+    except Exception:
+        User.refund_credits(user_id)
+        raise
+    if response[1] >= 400:
+        User.refund_credits(user_id)
+        timer.lap('refund_credits')
+    timer.finish()
+    return response
+
+
+def process_scan_upload(user_id, file, scan_mode, timer):
+    """
+    Stores and analyzes the upload of a /scan request whose credit is already reserved.
+
+    The credit is refunded here if the document is stored but its text cannot be read.
+
+    Args:
+        timer: StageTimer of the request; every stage below is recorded as one lap.
+
+    Returns:
+        The (response, status[, headers]) tuple of the request.
+    """
+    filename = secure_filename(file.filename)
+    upload_folder = 'uploads'
+    file_extension = file.filename.rsplit('.', 1)[1].lower()
+
+    if request.args.get('async') == '1':
+        # Only store the upload and queue the analysis; a scan worker picks it up
+        content_hash, filepath, already_stored = store_upload(file, upload_folder, file_extension)
+        timer.lap('store_upload')
+        document = Document(filename=filename, filepath=filepath, user_id=user_id, content_hash=content_hash)
+        if not document.save():
+            return jsonify({'message': 'Error saving document metadata to database'}), 500
+        timer.lap('document_save')
+        job_id = ScanJob.enqueue(user_id, document.id, filename, filepath, content_hash, already_stored, scan_mode)
+        if job_id is None:
+            return jsonify({'message': 'Error queueing scan job'}), 500
+        SCAN_WORKERS.notify()
+        timer.lap('enqueue_job')
+        status_url = f'/scan/jobs/{job_id}'
+        return jsonify({
+            'message': 'Scan request received, credit deducted, document uploaded, scan queued',
+            'job_id': job_id,
+            'status': 'queued',
+            'status_url': status_url,
+            'document_id': document.id
+        }), 202, {'Location': status_url}
+
+    # Text uploads are tokenized (and MinHashed) chunk by chunk while they are being stored;
+    # PDFs (and images, with OCR) go through the same tokenizer once their text is extracted
+    tokenizer = signature_accumulator = None
+    if file_extension == 'txt' or TEXT_EXTRACTOR.supports(file_extension):
+        signature_accumulator = SignatureAccumulator(NEAR_DUPLICATE_INDEX)
+        tokenizer = StreamingTokenizer(word_consumers=[signature_accumulator.update])
+
+    # Store the body under its SHA-256, so identical uploads share one file instead of overwriting each other
+    content_hash, filepath, already_stored = store_upload(
+        file, upload_folder, file_extension, consumer=tokenizer.feed if file_extension == 'txt' else None)
+    doc_key = os.path.basename(filepath)  # Key of the stored content in the document indexes
+    timer.lap('store_upload')  # Includes tokenizing and MinHashing text uploads while they stream in
+
+    # --- Document Processing ---
+    scan_results = {}
+    
+    if tokenizer is not None:
+        document_type = "Text Document" if file_extension == 'txt' else f"{file_extension.upper()} Document"
+        try:
+            if file_extension == 'txt':
+                tokenizer.close()
+                text_path = filepath
+            else:
+                # Extracted once per distinct content, on the extraction pool, then cached by content hash
+                text_path = TEXT_EXTRACTOR.extract(filepath, file_extension, content_hash)
+                timer.lap('extract_text')
+                feed_text_file(tokenizer, text_path)
+            if tokenizer.error is not None:
+                raise tokenizer.error
+            store_corpus_text(doc_key, text_path)
+            
+            # Full text and word list are only kept for reasonably small documents
+            uploaded_document_content = tokenizer.content
+            preprocessed_words = tokenizer.words
+            term_frequencies = tokenizer.term_frequencies()
+            
+            # Get a content snippet for display
+            content_snippet = tokenizer.content_snippet
+            timer.lap('preprocess')
+            
+            with INDEX_LOCK:
+                timer.lap('index_lock_wait')
+                # Byte-identical content scanned before keeps its indexed vector and near-duplicate signature
+                reused_analysis = already_stored and doc_key in DOCUMENT_INDEX
+                if not reused_analysis:
+                    # Add only this document to the index instead of rebuilding the whole corpus
+                    DOCUMENT_INDEX.add_term_counts(doc_key, tokenizer.term_counts, tokenizer.total_words)
+                    NEAR_DUPLICATE_INDEX.add(doc_key, signature_accumulator.signature())
+                timer.lap('index_update')  # Includes the index listeners (similarity engine, MinHash, match store)
                 
+                if scan_mode == 'near_duplicate':
+                    # Only documents sharing an LSH bucket are compared; scores are estimated Jaccard similarities
+                    near_duplicates = NEAR_DUPLICATE_INDEX.query(NEAR_DUPLICATE_INDEX.signatures.get(doc_key),
+                                                                 min_jaccard=NEAR_DUPLICATE_MIN_JACCARD, exclude=doc_key)
+                    document_similarities = dict(near_duplicates[:SCAN_TOP_K])
+                else:
+                    # Only the best SCAN_TOP_K matches are ranked (argpartition, no full sort);
+                    # a rescan of identical text before the next ingest is answered from the result cache
+                    document_similarities = dict(cached_top_k(doc_key, SCAN_TOP_K))
+                timer.lap('similarity')
+            
+            # Find the best match
+            best_match_doc_id = "No Match Found"
+            max_similarity_score = 0
+            for doc_id, score in document_similarities.items():
+                if score > max_similarity_score:
+                    max_similarity_score = score
+                    best_match_doc_id = doc_id
+            
+            if scan_mode == 'near_duplicate':
+                processing_status = "Text Content Extracted, Preprocessed, and MinHash Near-Duplicate Check Completed"
+            else:
                 processing_status = "Text Content Extracted, Preprocessed, and TF-IDF Similarity Analysis Completed"
-                
-                scan_results['document_type'] = document_type
-                scan_results['content_snippet'] = content_snippet
-                scan_results['processing_status'] = processing_status
-                scan_results['uploaded_document_content'] = uploaded_document_content
-                scan_results['preprocessed_words'] = preprocessed_words
-                scan_results['term_frequencies'] = term_frequencies
-                scan_results['document_similarities'] = document_similarities
-                scan_results['best_match_document_id'] = best_match_doc_id
-                scan_results['best_match_similarity_score'] = round(max_similarity_score * 100, 2)  # Convert to percentage for clarity
-                
-            except Exception as e:
-                document_type = "Text Document (Error Reading Content)"
-                content_snippet = "Error reading document content."
-                processing_status = f"Error: {str(e)}"
-                uploaded_document_content = "Error reading file content"
-                scan_results['document_type'] = document_type
-                scan_results['content_snippet'] = content_snippet
-                scan_results['processing_status'] = processing_status
-                scan_results['uploaded_document_content'] = uploaded_document_content
-                scan_results['preprocessed_words'] = []
-                scan_results['term_frequencies'] = {}
-                scan_results['document_similarities'] = {}
-                scan_results['best_match_document_id'] = "N/A"
-                scan_results['best_match_similarity_score'] = 0
-        
-        else:  # For non-text files (binary files)
-            document_type = "Binary Document (Content Preview Unavailable)"
-            content_snippet = "N/A - Binary file, cannot preview text content"
-            processing_status = "Binary File - Content Extraction Skipped"
-            uploaded_document_content = "Binary File - Content N/A"
             
+            scan_results['document_type'] = document_type
+            scan_results['content_snippet'] = content_snippet
+            scan_results['processing_status'] = processing_status
+            scan_results['uploaded_document_content'] = uploaded_document_content
+            scan_results['preprocessed_words'] = preprocessed_words
+            scan_results['term_frequencies'] = term_frequencies
+            scan_results['reused_analysis'] = reused_analysis
+            scan_results['document_similarities'] = document_similarities
+            scan_results['best_match_document_id'] = best_match_doc_id
+            scan_results['best_match_similarity_score'] = round(max_similarity_score * 100, 2)  # Convert to percentage for clarity
+            
+        except Exception as e:
+            document_type = f"{document_type} (Error Reading Content)"
+            content_snippet = "Error reading document content."
+            processing_status = f"Error: {str(e)}"
+            uploaded_document_content = "Error reading file content"
             scan_results['document_type'] = document_type
             scan_results['content_snippet'] = content_snippet
             scan_results['processing_status'] = processing_status
@@ -427,72 +783,497 @@ def scan_document():
             scan_results['document_similarities'] = {}
             scan_results['best_match_document_id'] = "N/A"
             scan_results['best_match_similarity_score'] = 0
+    
+    else:  # For non-text files (binary files)
+        document_type = "Binary Document (Content Preview Unavailable)"
+        content_snippet = "N/A - Binary file, cannot preview text content"
+        processing_status = "Binary File - Content Extraction Skipped"
+        uploaded_document_content = "Binary File - Content N/A"
         
-        scan_results['filename'] = filename
-        scan_results['filepath'] = filepath
-        
-        # --- Document Metadata Storage ---
-        document = Document(filename=filename, filepath=filepath, user_id=user_id)
-        if document.save():
+        scan_results['document_type'] = document_type
+        scan_results['content_snippet'] = content_snippet
+        scan_results['processing_status'] = processing_status
+        scan_results['uploaded_document_content'] = uploaded_document_content
+        scan_results['preprocessed_words'] = []
+        scan_results['term_frequencies'] = {}
+        scan_results['document_similarities'] = {}
+        scan_results['best_match_document_id'] = "N/A"
+        scan_results['best_match_similarity_score'] = 0
+    
+    scan_results['filename'] = filename
+    scan_results['filepath'] = filepath
+    scan_results['content_hash'] = content_hash
+    scan_results['scan_mode'] = scan_mode
+    
+    timer.skip()  # Building the result dictionary is not a stage of its own
+
+    # --- Document Metadata Storage ---
+    document = Document(filename=filename, filepath=filepath, user_id=user_id, content_hash=content_hash)
+    saved = document.save()
+    timer.lap('document_save')
+    if saved:
+        # Matches are found by content key; users know them by the filenames they uploaded
+        name_scan_matches(scan_results, document_filenames(scan_results['document_similarities']))
+        if tokenizer is not None and not scan_failed(scan_results):
+            copies = Document.get_copies([filepath], SCAN_TOP_K + 1).get(filepath, [])
+            add_exact_matches(scan_results, copies, document.id)
+        timer.lap('fetch_documents')
+        if scan_failed(scan_results):
+            # The upload is kept, but a scan whose text could not be read is not charged
+            User.refund_credits(user_id)
+            timer.lap('refund_credits')
             return jsonify({
-                'message': 'Scan request received, credit deducted, document uploaded, metadata saved, text content extracted',
+                'message': 'Scan request received, document uploaded, metadata saved, text content could not be read, credit refunded',
                 'filename': filename,
                 'filepath': filepath,
                 'document_id': document.id,
                 'scan_results': scan_results
             }), 200
-        else:
-            return jsonify({'message': 'Error saving document metadata to database'}), 500
-    
+        return jsonify({
+            'message': 'Scan request received, credit deducted, document uploaded, metadata saved, text content extracted',
+            'filename': filename,
+            'filepath': filepath,
+            'document_id': document.id,
+            'scan_results': scan_results
+        }), 200
     else:
-        return jsonify({'message': 'Error uploading document'}), 500
+        return jsonify({'message': 'Error saving document metadata to database'}), 500
+
+
+
+def document_filenames(doc_keys):
+    """
+    Maps content keys of the document indexes to the filenames they were uploaded under, in one query.
+
+    A key gets the filename of the first document stored under it, as /matches reports it. Keys
+    without a documents row (e.g. files placed in uploads by hand) keep their stored name, and a
+    filename already given to other content is followed by its document id.
+    """
+    document_ids = {doc_key: DOCUMENT_KEYS.document_id_for(doc_key) for doc_key in doc_keys}
+    documents = Document.get_by_ids([document_id for document_id in document_ids.values() if document_id is not None])
+    filenames = {}
+    taken = set()
+    for doc_key, document_id in document_ids.items():
+        document = documents.get(document_id)
+        filename = document.filename if document else doc_key
+        if filename in taken:
+            filename = f"{filename} (document {document_id})"
+        taken.add(filename)
+        filenames[doc_key] = filename
+    return filenames
+
+def name_scan_matches(scan_results, filenames):
+    """Replaces the content keys in document_similarities and best_match_document_id with filenames."""
+    scan_results['document_similarities'] = {filenames.get(doc_key, doc_key): score
+                                             for doc_key, score in scan_results['document_similarities'].items()}
+    best_match = scan_results['best_match_document_id']
+    scan_results['best_match_document_id'] = filenames.get(best_match, best_match)
+
+def add_exact_matches(scan_results, copies, document_id):
+    """
+    Reports the other uploads of the same content as 100% matches, ahead of the ranked ones.
+
+    Identical uploads share one content key, which the index queries exclude as the scanned
+    document itself, so its copies are read from the documents table instead.
+
+    Args:
+        scan_results: scan_results of a successfully analyzed file, with matches named by filename.
+        copies: Documents stored at the same filepath (Document.get_copies), oldest first.
+        document_id: Id of the scanned document itself, left out.
+    """
+    ranked = scan_results['document_similarities']
+    exact = {}
+    for document in copies:
+        if document.id == document_id or len(exact) == SCAN_TOP_K:
+            continue
+        filename = document.filename
+        if filename in exact or filename in ranked:
+            filename = f"{filename} (document {document.id})"
+        exact[filename] = 1.0
+    if not exact:
+        return
+    scan_results['document_similarities'] = dict(list(exact.items()) + list(ranked.items())[:SCAN_TOP_K - len(exact)])
+    scan_results['best_match_document_id'] = next(iter(exact))
+    scan_results['best_match_similarity_score'] = 100.0
+
+def get_scan_pool():
+    """Returns the process pool used by /scan/batch, starting it on first use."""
+    global _scan_pool
+    with _scan_pool_lock:
+        if _scan_pool is None:
+            _scan_pool = ProcessPoolExecutor(max_workers=SCAN_BATCH_WORKERS)
+            atexit.register(_scan_pool.shutdown)
+    return _scan_pool
+
+def analyze_text_files(filepaths):
+    """
+    Tokenizes and MinHashes stored text files, in parallel on the scan pool when there are several.
+
+    Returns:
+        A list with one analyze_text_file result per filepath, in the same order.
+    """
+    if len(filepaths) <= 1:  # Not worth a round trip to another process
+        return [analyze_text_file(filepath, LSH_BANDS, LSH_ROWS) for filepath in filepaths]
+    # Hand out several files per task so small files do not drown in inter-process overhead
+    chunksize = max(1, len(filepaths) // (SCAN_BATCH_WORKERS * 4))
+    return list(get_scan_pool().map(analyze_text_file, filepaths, repeat(LSH_BANDS), repeat(LSH_ROWS),
+                                    chunksize=chunksize))
+
+def scan_failed(scan_results):
+    """True if the text of a scanned document could not be read (such scans are refunded)."""
+    return scan_results['processing_status'].startswith('Error')
+
+def summarize_scan(analysis, matches, scan_mode, reused_analysis):
+    """
+    Builds the analysis part of a file's scan_results for /scan/batch and asynchronous scans.
+
+    Args:
+        analysis: analyze_text_file result, or None for a binary file.
+        matches: List of (doc_id, score) tuples, best match first.
+        scan_mode: 'similarity' or 'near_duplicate'.
+        reused_analysis: True if the indexed analysis of identical content was reused.
+    """
+    scan_results = {}
+    if analysis is None:
+        scan_results['document_type'] = "Binary Document (Content Preview Unavailable)"
+        scan_results['content_snippet'] = "N/A - Binary file, cannot preview text content"
+        scan_results['processing_status'] = "Binary File - Content Extraction Skipped"
+        scan_results['document_similarities'] = {}
+        scan_results['best_match_document_id'] = "N/A"
+        scan_results['best_match_similarity_score'] = 0
+    elif analysis['error'] is not None:
+        scan_results['document_type'] = "Text Document (Error Reading Content)"
+        scan_results['content_snippet'] = "Error reading document content."
+        scan_results['processing_status'] = f"Error: {analysis['error']}"
+        scan_results['document_similarities'] = {}
+        scan_results['best_match_document_id'] = "N/A"
+        scan_results['best_match_similarity_score'] = 0
+    else:
+        document_similarities = dict(matches)
+        best_match = max(document_similarities.items(), key=lambda item: item[1], default=("No Match Found", 0))
+        scan_results['document_type'] = "Text Document"
+        scan_results['content_snippet'] = analysis['content_snippet']
+        if scan_mode == 'near_duplicate':
+            scan_results['processing_status'] = "Text Content Extracted, Preprocessed, and MinHash Near-Duplicate Check Completed"
+        else:
+            scan_results['processing_status'] = "Text Content Extracted, Preprocessed, and TF-IDF Similarity Analysis Completed"
+        scan_results['reused_analysis'] = reused_analysis
+        scan_results['document_similarities'] = document_similarities
+        scan_results['best_match_document_id'] = best_match[0]
+        scan_results['best_match_similarity_score'] = round(best_match[1] * 100, 2)  # Convert to percentage for clarity
+    return scan_results
+
+@app.route('/scan/batch', methods=['POST'])
+@role_required('user')
+def scan_batch():
+    """
+    Scans many uploaded files (multipart field 'documents') in one request.
+
+    Credits for the whole batch (one per file) are checked and deducted in one
+    statement and refunded if the batch fails, text files are analyzed in parallel on the scan pool, the indexes
+    are updated under a single lock, similarity is scored for all files in one
+    sparse mat-mat and the documents rows are inserted with one executemany.
+    """
+    user_id = session.get('user_id')
+
+    scan_mode = request.args.get('mode') or request.form.get('mode') or 'similarity'
+    if scan_mode not in SCAN_MODES:
+        return jsonify({'message': f'Unknown scan mode: {scan_mode}'}), 400
+
+    files = [file for file in request.files.getlist('documents') if file.filename != '']
+    if not files:
+        return jsonify({'message': 'No documents part'}), 400
+    if len(files) > SCAN_BATCH_MAX_FILES:
+        return jsonify({'message': f'Too many files, at most {SCAN_BATCH_MAX_FILES} per batch'}), 400
+    rejected = [file.filename for file in files if not allowed_file(file.filename)]
+    if rejected:
+        return jsonify({'message': 'Unsupported file type', 'rejected_files': rejected}), 400
+
+    # --- Credit Deduction Logic (one credit per file, all reserved at once or none) ---
+    if User.reserve_credits(user_id, len(files)) is None:
+        if User.get_user_by_id(user_id) is None:
+            return jsonify({'message': 'User not found'}), 404
+        return jsonify({'message': 'Insufficient credits'}), 402
+
+    # Failed batches are not charged
+    try:
+        response = process_scan_batch(user_id, files, scan_mode)
+    except Exception:
+        User.refund_credits(user_id, len(files))
+        raise
+    if response[1] >= 400:
+        User.refund_credits(user_id, len(files))
+    return response
+
+
+def process_scan_batch(user_id, files, scan_mode):
+    """
+    Stores, analyzes and scores the files of a /scan/batch request whose credits are already reserved.
+
+    The credit of every file whose text cannot be read is refunded here, once the batch is saved.
+
+    Returns:
+        The (response, status) tuple of the request.
+    """
+    # --- Document Upload Handling ---
+    upload_folder = 'uploads'
+    uploads = []
+    for file in files:
+        file_extension = file.filename.rsplit('.', 1)[1].lower()
+        content_hash, filepath, already_stored = store_upload(file, upload_folder, file_extension)
+        uploads.append({
+            'filename': secure_filename(file.filename),
+            'filepath': filepath,
+            'doc_key': os.path.basename(filepath),
+            'content_hash': content_hash,
+            'already_stored': already_stored,
+            'extension': file_extension,
+            'is_text': file_extension == 'txt' or TEXT_EXTRACTOR.supports(file_extension),
+        })
+
+    # --- Document Processing (identical files in the batch are analyzed once) ---
+    # The text of all PDFs (and images) in the batch is extracted in parallel, then analyzed like .txt files
+    extracted = TEXT_EXTRACTOR.extract_many([(upload['filepath'], upload['extension'], upload['content_hash'])
+                                             for upload in uploads if upload['is_text'] and upload['extension'] != 'txt'])
+    text_files = {}
+    failed = {}
+    for upload in uploads:
+        if not upload['is_text']:
+            continue
+        text_path = upload['filepath'] if upload['extension'] == 'txt' else extracted[upload['content_hash']]
+        if isinstance(text_path, ExtractionError):
+            failed[upload['doc_key']] = failed_analysis(text_path)
+        else:
+            text_files[upload['doc_key']] = text_path
+    analyses = dict(zip(text_files, analyze_text_files(list(text_files.values()))))
+    for doc_key, analysis in analyses.items():
+        if analysis['error'] is None:
+            store_corpus_text(doc_key, text_files[doc_key])
+    analyses.update(failed)
+
+    stored_before = {upload['doc_key'] for upload in uploads if upload['already_stored']}
+    with INDEX_LOCK:
+        reused_keys = set()
+        for doc_key, analysis in analyses.items():
+            if analysis['error'] is not None:
+                continue
+            # Byte-identical content scanned before keeps its indexed vector and near-duplicate signature
+            if doc_key in stored_before and doc_key in DOCUMENT_INDEX:
+                reused_keys.add(doc_key)
+                continue
+            DOCUMENT_INDEX.add_term_counts(doc_key, analysis['term_counts'], analysis['total_words'])
+            NEAR_DUPLICATE_INDEX.add(doc_key, analysis['signature'])
+
+        query_keys = [doc_key for doc_key, analysis in analyses.items() if analysis['error'] is None]
+        if scan_mode == 'near_duplicate':
+            matches = {doc_key: NEAR_DUPLICATE_INDEX.query(NEAR_DUPLICATE_INDEX.signatures.get(doc_key),
+                                                           min_jaccard=NEAR_DUPLICATE_MIN_JACCARD,
+                                                           exclude=doc_key)[:SCAN_TOP_K]
+                       for doc_key in query_keys}
+        else:
+            # Files whose results are not cached are scored against the corpus in a single sparse mat-mat
+            generation = DOCUMENT_INDEX.generation
+            matches = {doc_key: RESULT_CACHE.get((doc_key, SCAN_TOP_K, 0.0), generation) for doc_key in query_keys}
+            missing_keys = [doc_key for doc_key, result in matches.items() if result is None]
+            if missing_keys:
+                query_vectors = [DOCUMENT_INDEX.tfidf_vector(doc_key) for doc_key in missing_keys]
+                results = None
+                if SHARDED_SEARCH is not None:
+                    try:
+                        results = SHARDED_SEARCH.top_k_batch(query_vectors, SCAN_TOP_K, exclude=missing_keys)
+                    except ShardError as e:
+                        print(f"Error querying search shards, searching in process: {e}")
+                if results is None:
+                    results = SIMILARITY_ENGINE.query_batch(query_vectors, k=SCAN_TOP_K, exclude=missing_keys)
+                for doc_key, result in zip(missing_keys, results):
+                    matches[doc_key] = result
+                    RESULT_CACHE.put((doc_key, SCAN_TOP_K, 0.0), result, generation)
+
+    # --- Document Metadata Storage ---
+    documents = [Document(filename=upload['filename'], filepath=upload['filepath'], user_id=user_id,
+                          content_hash=upload['content_hash']) for upload in uploads]
+    if not Document.save_many(documents):
+        return jsonify({'message': 'Error saving document metadata to database'}), 500
+    # Saved first, so matches among the files of this batch are named too
+    filenames = document_filenames({doc_key for result in matches.values() for doc_key, _ in result})
+    # Earlier uploads of the same content, and identical files of this batch, are exact matches
+    copies = Document.get_copies([upload['filepath'] for upload in uploads if upload['doc_key'] in matches],
+                                 SCAN_TOP_K + 1)
+
+    results = []
+    for upload, document in zip(uploads, documents):
+        scan_results = {
+            'filename': upload['filename'],
+            'filepath': upload['filepath'],
+            'document_id': document.id,
+            'content_hash': upload['content_hash'],
+            'scan_mode': scan_mode,
+        }
+        analysis = analyses.get(upload['doc_key'])
+        scan_results.update(summarize_scan(analysis, matches.get(upload['doc_key'], []), scan_mode,
+                                           upload['doc_key'] in reused_keys))
+        name_scan_matches(scan_results, filenames)
+        if upload['doc_key'] in matches:
+            add_exact_matches(scan_results, copies.get(upload['filepath'], []), document.id)
+        results.append(scan_results)
+
+    # Files whose text could not be read are not charged
+    refunded = sum(1 for scan_results in results if scan_failed(scan_results))
+    if refunded:
+        User.refund_credits(user_id, refunded)
+    return jsonify({
+        'message': 'Batch scan completed, credits deducted, documents uploaded, metadata saved',
+        'credits_deducted': len(files) - refunded,
+        'credits_refunded': refunded,
+        'results': results
+    }), 200
+
+
+def refund_scan_job(job):
+    """Scan worker failure handler: refunds the credit reserved when the job was queued."""
+    User.refund_credits(job.user_id)
+
+def refund_failed_scan_job(job, scan_results):
+    """Scan worker result handler: refunds the credit of a job whose document text could not be read."""
+    if scan_failed(scan_results):
+        User.refund_credits(job.user_id)
+
+def scan_job_results(job):
+    """
+    Analyzes a queued upload, adds it to the indexes and scores it.
+
+    Returns:
+        The job's scan_results dictionary (stored in the queue as its result).
+    """
+    doc_key = os.path.basename(job.filepath)
+    analysis = None
+    matches = []
+    reused_analysis = False
+    extension = job.filepath.rsplit('.', 1)[-1].lower()
+    if extension == 'txt' or TEXT_EXTRACTOR.supports(extension):
+        try:
+            text_path = job.filepath if extension == 'txt' else TEXT_EXTRACTOR.extract(job.filepath, extension,
+                                                                                      job.content_hash)
+        except ExtractionError as e:
+            analysis = failed_analysis(e)
+        else:
+            # Tokenizing is CPU-bound, so it runs on the scan process pool rather than in this thread
+            try:
+                analysis = get_scan_pool().submit(analyze_text_file, text_path, LSH_BANDS, LSH_ROWS).result()
+            except RuntimeError:  # The pool is shutting down with the interpreter
+                analysis = analyze_text_file(text_path, LSH_BANDS, LSH_ROWS)
+            if analysis['error'] is None:
+                store_corpus_text(doc_key, text_path)
+        if analysis['error'] is None:
+            with INDEX_LOCK:
+                reused_analysis = job.already_stored and doc_key in DOCUMENT_INDEX
+                if not reused_analysis:
+                    DOCUMENT_INDEX.add_term_counts(doc_key, analysis['term_counts'], analysis['total_words'])
+                    NEAR_DUPLICATE_INDEX.add(doc_key, analysis['signature'])
+                if job.scan_mode == 'near_duplicate':
+                    matches = NEAR_DUPLICATE_INDEX.query(NEAR_DUPLICATE_INDEX.signatures.get(doc_key),
+                                                         min_jaccard=NEAR_DUPLICATE_MIN_JACCARD,
+                                                         exclude=doc_key)[:SCAN_TOP_K]
+                else:
+                    matches = cached_top_k(doc_key, SCAN_TOP_K)
+
+    scan_results = summarize_scan(analysis, matches, job.scan_mode, reused_analysis)
+    name_scan_matches(scan_results, document_filenames(doc_key for doc_key, _ in matches))
+    if analysis is not None and analysis['error'] is None:
+        copies = Document.get_copies([job.filepath], SCAN_TOP_K + 1).get(job.filepath, [])
+        add_exact_matches(scan_results, copies, job.document_id)
+    scan_results['filename'] = job.filename
+    scan_results['filepath'] = job.filepath
+    scan_results['content_hash'] = job.content_hash
+    scan_results['scan_mode'] = job.scan_mode
+    return scan_results
+
+SCAN_WORKERS = ScanWorkerPool(scan_job_results, workers=SCAN_JOB_WORKERS, on_failure=refund_scan_job,
+                              on_result=refund_failed_scan_job)
+SCAN_WORKERS.start()
+
+@app.route('/scan/jobs/<int:job_id>', methods=['GET'])
+@role_required('user')
+def get_scan_job(job_id):
+    job = ScanJob.get_by_id(job_id)
+    # Jobs of other users are reported as missing rather than forbidden
+    if not job or job.user_id != session.get('user_id'):
+        return jsonify({'message': 'Scan job not found'}), 404
+
+    response = {
+        'job_id': job.id,
+        'status': job.status,
+        'document_id': job.document_id,
+        'filename': job.filename,
+        'created_at': job.created_at,
+        'started_at': job.started_at,
+        'finished_at': job.finished_at
+    }
+    if job.status == 'done':
+        response['scan_results'] = job.result
+    elif job.status == 'failed':
+        response['error'] = job.error
+    return jsonify(response), 200
 
 
 @app.route('/matches/<int:doc_id>', methods=['GET'])
 @role_required('user')
 def get_similar_documents(doc_id):
+    timer = StageTimer(REQUEST_STAGE_SECONDS, 'matches')  # Per-stage latency, see /admin/metrics
     try:
-        # Get the target document
-        target_doc = Document.get_by_id(doc_id)
-        if not target_doc:
+        # Find the target's content key in memory; documents are only read once, in one batch, below
+        target_key = DOCUMENT_KEYS.key_for(doc_id)
+        timer.lap('key_lookup')
+        if target_key is None:
+            return jsonify({'message': 'Document not found'}), 404
+
+        # Only the best `limit` documents scoring above `min_score` (in percent, like similarity_score)
+        limit = request.args.get('limit', default=5, type=int)
+        min_score = request.args.get('min_score', default=0, type=float)
+
+        timer.skip()
+        with INDEX_LOCK:
+            timer.lap('index_lock_wait')
+            # Materialized neighbours: a lookup instead of scoring the whole corpus
+            similarities = MATCH_STORE.lookup(target_key, limit, min_score=min_score / 100)
+            timer.lap('stored_matches')
+
+            if similarities is None:
+                # Not materialized yet (or more matches asked for than are stored): score it now, or reuse a cached result
+                if not DOCUMENT_INDEX.tfidf_vector(target_key):
+                    return jsonify({'message': 'Document analysis not available'}), 404
+
+                similarities = cached_top_k(target_key, limit, min_score=min_score / 100)
+                timer.lap('similarity')
+
+        # One query for the target and every matched document
+        match_ids = [DOCUMENT_KEYS.document_id_for(doc_key) for doc_key, _ in similarities]
+        documents = Document.get_by_ids([doc_id] + [match_id for match_id in match_ids if match_id is not None])
+        timer.lap('fetch_documents')
+        if doc_id not in documents:
             return jsonify({'message': 'Document not found'}), 404
+        target_filename = documents[doc_id].filename
 
-        # Get all documents excluding the target
-        all_docs = Document.get_all_documents()
         similar_docs = []
-        
-        # Get similarity scores from existing data (modify this based on your storage)
-        target_filename = target_doc.filename
-        target_vector = DOCUMENT_VECTORS.get(target_filename)
-        
-        if not target_vector:
-            return jsonify({'message': 'Document analysis not available'}), 404
+        for (doc_key, similarity), match_id in zip(similarities, match_ids):  # Only matches with similarity > 0 are returned
+            # Files without a documents row (e.g. placed in uploads by hand) are reported by their stored name
+            document = documents.get(match_id)
+            similar_docs.append({
+                'document_id': document.id if document else None,
+                'filename': document.filename if document else doc_key,
+                'similarity_score': round(similarity * 100, 2),
+                'content_snippet': corpus_snippet(doc_key)  # Only the first bytes of the stored text are read
+            })
 
-        # Calculate similarity with all documents
-        for doc_filename, doc_vector in DOCUMENT_VECTORS.items():
-            if doc_filename == target_filename:
-                continue  # Skip self-comparison
-                
-            similarity = cosine_similarity(target_vector, doc_vector)
-            if similarity > 0:  # Adjust threshold as needed
-                similar_docs.append({
-                    'document_id': Document.get_by_filename(doc_filename).id,
-                    'filename': doc_filename,
-                    'similarity_score': round(similarity * 100, 2)
-                })
-
-        # Sort by similarity score descending
-        similar_docs.sort(key=lambda x: x['similarity_score'], reverse=True)
-        
-        # Limit results (optional)
-        limit = request.args.get('limit', default=5, type=int)
         return jsonify({
             'target_document': target_filename,
-            'matches': similar_docs[:limit]
+            'matches': similar_docs
         }), 200
 
     except Exception as e:
         return jsonify({'message': str(e)}), 500
+    finally:
+        timer.finish()
 
 
 @app.route('/credits/request', methods=['POST'])
@@ -530,6 +1311,7 @@ def request_credits():
             "INSERT INTO credit_requests (user_id, requested_credits, status) VALUES (?, ?, 'pending')",
             (user_id, requested_credits)
         )
+        analytics.record_credit_request(cursor, requested_credits)
         conn.commit()
         return jsonify({'message': 'Credit request submitted successfully'}), 201
     except sqlite3.Error as e:
@@ -547,13 +1329,7 @@ def get_pending_credit_requests():
 
     try:
         # Fetch all pending credit requests
-        cursor.execute("""
-            SELECT cr.id, u.username, cr.requested_credits, cr.request_date
-            FROM credit_requests cr
-            JOIN users u ON cr.user_id = u.id
-            WHERE cr.status = 'pending'
-            ORDER BY cr.request_date DESC;
-        """)
+        cursor.execute(PENDING_CREDIT_REQUESTS)
         pending_requests = cursor.fetchall()
 
         # Format results
@@ -580,8 +1356,9 @@ def approve_credit_request(request_id):
     cursor = conn.cursor()
 
     try:
-        # Fetch the request
-        cursor.execute("SELECT user_id, requested_credits FROM credit_requests WHERE id = ?", (request_id,))
+        # Fetch the request inside the write transaction, so its status cannot change before the update
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.execute(CREDIT_REQUEST_BY_ID, (request_id,))
         request_data = cursor.fetchone()
 
         if not request_data:
@@ -590,13 +1367,15 @@ def approve_credit_request(request_id):
         user_id = request_data['user_id']
         requested_credits = request_data['requested_credits']
 
-        # Update user's credits
-        cursor.execute("UPDATE users SET credits = credits + ? WHERE id = ?", (requested_credits, user_id))
+        # Update user's credits (on top of today's allowance if their daily reset is due)
+        User.add_credits(cursor, user_id, requested_credits)
 
         # Update request status to 'approved'
         cursor.execute("UPDATE credit_requests SET status = 'approved' WHERE id = ?", (request_id,))
+        analytics.record_credit_request_status(cursor, user_id, requested_credits, request_data['status'], 'approved')
 
         conn.commit()
+        USER_CACHE.invalidate(user_id)
         return jsonify({'message': 'Credit request approved successfully'}), 200
     except sqlite3.Error as e:
         conn.rollback()
@@ -612,7 +1391,12 @@ def reject_credit_request(request_id):
 
     try:
         # Update request status to 'rejected'
+        cursor.execute("BEGIN IMMEDIATE")
+        request_data = cursor.execute(CREDIT_REQUEST_BY_ID, (request_id,)).fetchone()
         cursor.execute("UPDATE credit_requests SET status = 'rejected' WHERE id = ?", (request_id,))
+        if request_data:
+            analytics.record_credit_request_status(cursor, request_data['user_id'], request_data['requested_credits'],
+                                                   request_data['status'], 'rejected')
         conn.commit()
         return jsonify({'message': 'Credit request rejected successfully'}), 200
     except sqlite3.Error as e:
@@ -626,66 +1410,60 @@ def reject_credit_request(request_id):
 @role_required('admin')
 def get_admin_analytics():
     conn = get_db_connection()
-    cursor = conn.cursor()
 
     try:
-        # Scans per user per day
-        cursor.execute("""
-            SELECT u.username, DATE(d.scan_date) AS scan_day, COUNT(d.id) AS scan_count
-            FROM documents d
-            JOIN users u ON d.user_id = u.id
-            GROUP BY u.username, DATE(d.scan_date)
-            ORDER BY scan_day DESC, scan_count DESC;
-        """)
-        scans_per_user = cursor.fetchall()
-
-        # Most common scanned document topics (assuming topics are derived from filenames)
-        cursor.execute("""
-            SELECT SUBSTR(filename, 1, INSTR(filename, '.') - 1) AS topic, COUNT(id) AS scan_count
-            FROM documents
-            GROUP BY topic
-            ORDER BY scan_count DESC
-            LIMIT 10;
-        """)
-        common_topics = cursor.fetchall()
-
-        # Top users by scans and credit usage
-        cursor.execute("""
-            SELECT u.username, COUNT(d.id) AS total_scans, SUM(cr.requested_credits) AS total_credits_used
-            FROM users u
-            LEFT JOIN documents d ON u.id = d.user_id
-            LEFT JOIN credit_requests cr ON u.id = cr.user_id AND cr.status = 'approved'
-            GROUP BY u.username
-            ORDER BY total_scans DESC, total_credits_used DESC
-            LIMIT 10;
-        """)
-        top_users = cursor.fetchall()
-
-        # Credit usage statistics
-        cursor.execute("""
-            SELECT 
-                SUM(requested_credits) AS total_credits_used,
-                AVG(requested_credits) AS avg_credits_used,
-                SUM(CASE WHEN status = 'approved' THEN requested_credits ELSE 0 END) AS approved_credits,
-                SUM(CASE WHEN status = 'pending' THEN requested_credits ELSE 0 END) AS pending_credits
-            FROM credit_requests;
-        """)
-        credit_stats = cursor.fetchone()
-
-        # Combine all analytics data
-        analytics_data = {
-            'scans_per_user': scans_per_user,
-            'common_topics': common_topics,
-            'top_users': top_users,
-            'credit_stats': credit_stats
-        }
-
+        # Scans per user per day, common topics, top users and credit statistics, read from the rollup tables
+        analytics_data = analytics.get_dashboard(conn)
         return jsonify(analytics_data), 200
     except sqlite3.Error as e:
         return jsonify({'message': 'Failed to fetch analytics data', 'error': str(e)}), 500
     finally:
         conn.close()
 
+@app.route('/admin/result-cache', methods=['GET'])
+@role_required('admin')
+def get_result_cache_stats():
+    # Hit/miss/eviction counters of the similarity result cache
+    return jsonify(RESULT_CACHE.stats()), 200
+
+@app.route('/admin/search-shards', methods=['GET'])
+@role_required('admin')
+def get_search_shard_stats():
+    # Addresses, connection state and documents per shard of the sharded search
+    if SHARDED_SEARCH is None:
+        return jsonify({'shards': 0}), 200
+    return jsonify(SHARDED_SEARCH.stats()), 200
+
+@app.route('/admin/user-cache', methods=['GET'])
+@role_required('admin')
+def get_user_cache_stats():
+    # Hit/miss/invalidation counters of the user cache
+    return jsonify(USER_CACHE.stats()), 200
+
+@app.route('/admin/metrics', methods=['GET'])
+@role_required('admin')
+def get_metrics():
+    # Stage and query latency histograms plus index and cache gauges, in the Prometheus text format
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/admin/profile', methods=['POST'])
+@role_required('admin')
+def arm_profiler():
+    # Samples the stack of the next request (to `path`, if given) every `interval_ms` milliseconds
+    data = request.get_json(silent=True) or {}
+    interval_ms = data.get('interval_ms', PROFILE_INTERVAL * 1000)
+    if not isinstance(interval_ms, (int, float)) or interval_ms <= 0:
+        return jsonify({'message': 'interval_ms must be a positive number'}), 400
+    PROFILER.arm(path=data.get('path'), interval=interval_ms / 1000)
+    return jsonify({'message': 'Profiler armed for the next request', 'path': data.get('path')}), 200
+
+@app.route('/admin/profile', methods=['GET'])
+@role_required('admin')
+def get_profile():
+    # Collapsed stacks of the last profiled request
+    if PROFILER.last_profile is None:
+        return jsonify({'message': 'No request has been profiled yet'}), 404
+    return jsonify(PROFILER.last_profile), 200
+
 if __name__ == '__main__':
-   STORED_DOCUMENTS, DOCUMENT_VECTORS, GLOBAL_IDF = update_document_vectors()
    app.run(debug=True)
\ No newline at end of file
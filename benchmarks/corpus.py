@@ -0,0 +1,52 @@
+"""
+Deterministic synthetic corpora for the benchmarks.
+
+Word frequencies follow Zipf's law, like natural text, and a share of the
+documents can be planted near-duplicates of earlier ones (a copy with a few
+words replaced), so near-duplicate detection and high similarity scores are
+exercised as well.
+"""
+import os
+import random
+
+
+def generate_corpus(documents, vocabulary_size, words_per_document, seed=0, near_duplicates=0.0,
+                    mutation_rate=0.05, prefix='doc'):
+    """
+    Generates a deterministic corpus.
+
+    Args:
+        documents: Number of documents.
+        vocabulary_size: Number of distinct terms.
+        words_per_document: Average document length in words (lengths vary from half to 1.5 times this).
+        seed: Seed of the random generator; the same arguments always give the same corpus.
+        near_duplicates: Share of documents (0-1) that are near-duplicates of an earlier document.
+        mutation_rate: Share of the words replaced in a near-duplicate.
+        prefix: Prefix of the generated doc_ids.
+
+    Returns:
+        A list of (doc_id, text) tuples.
+    """
+    generator = random.Random(seed)
+    vocabulary = [f"term{number}" for number in range(vocabulary_size)]
+    weights = [1 / (rank + 1) for rank in range(vocabulary_size)]
+    corpus = []
+    for number in range(documents):
+        if near_duplicates and corpus and generator.random() < near_duplicates:
+            # Copy an earlier document and replace a few of its words
+            words = generator.choice(corpus)[1].split()
+            for position in generator.sample(range(len(words)), max(1, int(len(words) * mutation_rate))):
+                words[position] = generator.choices(vocabulary, weights)[0]
+        else:
+            length = generator.randint(words_per_document // 2, words_per_document * 3 // 2)
+            words = generator.choices(vocabulary, weights, k=length)
+        corpus.append((f"{prefix}{number}.txt", ' '.join(words)))
+    return corpus
+
+
+def write_corpus(corpus, folder):
+    """Writes every document of a corpus to folder/<doc_id>."""
+    os.makedirs(folder, exist_ok=True)
+    for doc_id, text in corpus:
+        with open(os.path.join(folder, doc_id), 'w', encoding='utf-8') as f:
+            f.write(text)
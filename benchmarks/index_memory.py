@@ -0,0 +1,81 @@
+"""
+Measures how much memory the document index needs for a synthetic corpus.
+
+Compares the original representation (one {word: tf-idf} dict per document, as
+DOCUMENT_VECTORS used to hold them) with the array-backed InvertedIndex.
+
+Usage:
+    python -m benchmarks.index_memory [--documents N] [--vocabulary N] [--words N]
+"""
+import argparse
+import gc
+import math
+import tracemalloc
+from collections import Counter
+
+from benchmarks.corpus import generate_corpus
+from search_index import InvertedIndex
+from streaming_ingest import PUNCTUATION
+
+
+def tokenize(text):
+    # Same steps as preprocess_text; every document gets its own word objects, as when reading files
+    return PUNCTUATION.sub('', text.lower()).split()
+
+
+def build_dict_vectors(corpus):
+    # The former DOCUMENT_VECTORS: {doc_id: {word: tf * idf}}
+    term_frequencies = {}
+    document_frequency = Counter()
+    for doc_id, text in corpus:
+        words = tokenize(text)
+        term_frequencies[doc_id] = {word: count / len(words) for word, count in Counter(words).items()}
+        document_frequency.update(term_frequencies[doc_id].keys())
+    idf = {word: math.log(len(corpus) / (freq + 1)) + 1 for word, freq in document_frequency.items()}
+    return {doc_id: {word: tf * idf[word] for word, tf in tf_vector.items()}
+            for doc_id, tf_vector in term_frequencies.items()}
+
+
+def build_inverted_index(corpus):
+    index = InvertedIndex()
+    for doc_id, text in corpus:
+        index.add_document(doc_id, tokenize(text))
+    return index
+
+
+def measure(build, corpus):
+    """Returns (bytes still allocated by the built structure, peak bytes while building)."""
+    gc.collect()
+    tracemalloc.start()
+    try:
+        structure = build(corpus)
+        gc.collect()
+        retained, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del structure
+    return retained, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--documents', type=int, default=2000)
+    parser.add_argument('--vocabulary', type=int, default=20000)
+    parser.add_argument('--words', type=int, default=500, help='average number of words per document')
+    args = parser.parse_args()
+
+    corpus = generate_corpus(args.documents, args.vocabulary, args.words)
+    results = {
+        'dict vectors': measure(build_dict_vectors, corpus),
+        'inverted index': measure(build_inverted_index, corpus),
+    }
+
+    print(f"{args.documents} documents, {args.vocabulary} terms, ~{args.words} words per document")
+    for name, (retained, peak) in results.items():
+        print(f"  {name:<15} retained {retained / 1024 / 1024:8.1f} MiB   peak {peak / 1024 / 1024:8.1f} MiB")
+    ratio = results['dict vectors'][0] / results['inverted index'][0]
+    print(f"  inverted index uses {ratio:.1f}x less memory")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,307 @@
+"""
+Micro-benchmarks of the scan pipeline on synthetic corpora.
+
+Every corpus size runs in its own process, inside a scratch directory holding
+the generated uploads folder and a fresh database, so startup and peak RSS of
+one size do not leak into the next. Per size it measures:
+
+    preprocess_text, calculate_term_frequency   per document
+    calculate_document_frequency                over the whole corpus
+    update_document_vectors                     full index build from the uploads folder
+    cosine_similarity                           per pair of tf-idf vectors
+    match_store_refresh                         recomputing every /matches neighbour list
+    scan                                        POST /scan through the Flask test client
+    matches                                     GET /matches/<doc_id> through the Flask test client
+
+and reports throughput (operations per second), p50/p99 latency and the
+peak RSS of the process as JSON. Two result files are compared with `compare`,
+which exits with status 1 if any benchmark got slower than the threshold.
+
+Usage:
+    python -m benchmarks.scan_pipeline run [--sizes 1000,10000,100000] [--output results.json]
+    python -m benchmarks.scan_pipeline compare baseline.json results.json [--threshold 0.1]
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.corpus import generate_corpus, write_corpus
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SIZES = [1000, 10000, 100000]  # Documents in the corpus of each run
+VOCABULARY_SIZE = 50000
+WORDS_PER_DOCUMENT = 200
+NEAR_DUPLICATES = 0.1  # Share of planted near-duplicates, in the corpus and in the scanned uploads
+SAMPLES = 1000  # Calls timed per per-document benchmark
+SCAN_REQUESTS = 200
+MATCHES_REQUESTS = 500
+REGRESSION_THRESHOLD = 0.1  # Relative slowdown that compare reports as a regression
+
+
+def percentile(latencies, fraction):
+    """Nearest-rank percentile of a sorted list of latencies."""
+    if not latencies:
+        return 0.0
+    return latencies[min(len(latencies) - 1, max(0, round(fraction * len(latencies)) - 1))]
+
+
+def summarize(latencies, operations=None):
+    """
+    Turns per-call latencies (seconds) into a benchmark result.
+
+    Args:
+        latencies: Duration of every timed call.
+        operations: Operations done by all calls together (default: one per call).
+
+    Returns:
+        A dictionary with operations, total_s, throughput_per_s, p50_ms and p99_ms.
+    """
+    latencies = sorted(latencies)
+    total = sum(latencies)
+    operations = len(latencies) if operations is None else operations
+    return {
+        'operations': operations,
+        'total_s': round(total, 6),
+        'throughput_per_s': round(operations / total, 3) if total else 0.0,
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 4),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 4),
+    }
+
+
+def time_calls(function, arguments):
+    """Calls function once per argument and returns the latency of every call."""
+    latencies = []
+    for argument in arguments:
+        start = time.perf_counter()
+        function(argument)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def peak_rss_mib():
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def run_size(documents, samples=SAMPLES, scan_requests=SCAN_REQUESTS, matches_requests=MATCHES_REQUESTS, seed=0):
+    """
+    Benchmarks the pipeline on one corpus size. Must run in a scratch directory (see main).
+
+    Returns:
+        A dictionary of benchmark name -> result, plus setup_s and peak_rss_mib.
+    """
+    setup_start = time.perf_counter()
+    corpus = generate_corpus(documents, VOCABULARY_SIZE, WORDS_PER_DOCUMENT, seed=seed, near_duplicates=NEAR_DUPLICATES)
+    write_corpus(corpus, 'uploads')
+
+    import init_db
+    init_db.init_db()
+    import app as app_module  # Builds the index from the uploads folder, as on a cold start
+    app_module.scheduler.pause()  # No background refresh in the middle of a timing
+    from models import Document, User
+
+    # Every corpus file gets its documents row, so /matches can reach it
+    User.create_user('benchmark', 'benchmark')
+    user = User.get_user_by_username('benchmark')
+    Document.save_many([Document(doc_id, os.path.join('uploads', doc_id), user.id) for doc_id, _ in corpus])
+    conn = app_module.get_db_connection()
+    conn.execute("UPDATE users SET credits = ? WHERE id = ?", (scan_requests + 1, user.id))
+    conn.commit()
+    conn.close()
+    setup = time.perf_counter() - setup_start
+
+    generator = random.Random(seed)
+    sample = [text for _, text in generator.sample(corpus, min(samples, len(corpus)))]
+    results = {}
+
+    results['preprocess_text'] = summarize(time_calls(app_module.preprocess_text, sample))
+    word_lists = [app_module.preprocess_text(text) for text in sample]
+    results['calculate_term_frequency'] = summarize(time_calls(app_module.calculate_term_frequency, word_lists))
+
+    all_words = [app_module.preprocess_text(text) for _, text in corpus]
+    results['calculate_document_frequency'] = summarize(
+        time_calls(app_module.calculate_document_frequency, [all_words]), operations=len(all_words))
+    del all_words
+
+    results['update_document_vectors'] = summarize(
+        time_calls(lambda _: app_module.update_document_vectors(), [None]), operations=len(corpus))
+
+    index = app_module.DOCUMENT_INDEX
+    keys = [doc_id for doc_id, _ in corpus]
+    pairs = [(index.tfidf_vector(generator.choice(keys)), index.tfidf_vector(generator.choice(keys)))
+             for _ in range(min(samples, len(corpus)))]
+    results['cosine_similarity'] = summarize(time_calls(lambda pair: app_module.cosine_similarity(*pair), pairs))
+    del pairs
+
+    results['match_store_refresh'] = summarize(
+        time_calls(lambda _: app_module.MATCH_STORE.refresh(), [None]), operations=len(index))
+
+    app_module.app.config['TESTING'] = True
+    client = app_module.app.test_client()
+    response = client.post('/auth/login', json={'username': 'benchmark', 'password': 'benchmark'})
+    if response.status_code != 200:
+        raise RuntimeError(f"Benchmark login failed: {response.status_code}")
+
+    # New uploads: fresh documents plus planted near-duplicates of corpus documents
+    uploads = generate_corpus(scan_requests, VOCABULARY_SIZE, WORDS_PER_DOCUMENT, seed=seed + 1, prefix='scan')
+    for position in range(0, len(uploads), max(1, round(1 / NEAR_DUPLICATES))):
+        words = generator.choice(corpus)[1].split()
+        words[generator.randrange(len(words))] = 'planted'
+        uploads[position] = (uploads[position][0], ' '.join(words))
+
+    def scan(upload):
+        filename, text = upload
+        response = client.post('/scan', data={'document': (io.BytesIO(text.encode('utf-8')), filename)},
+                               content_type='multipart/form-data')
+        if response.status_code != 200:
+            raise RuntimeError(f"/scan failed with {response.status_code}: {response.get_data(as_text=True)}")
+
+    results['scan'] = summarize(time_calls(scan, uploads))
+
+    document_ids = [row['id'] for row in app_module.get_db_connection().execute("SELECT id FROM documents")]
+    targets = generator.sample(document_ids, min(matches_requests, len(document_ids)))
+
+    def matches(document_id):
+        response = client.get(f'/matches/{document_id}')
+        if response.status_code != 200:
+            raise RuntimeError(f"/matches failed with {response.status_code}: {response.get_data(as_text=True)}")
+
+    results['matches'] = summarize(time_calls(matches, targets))
+
+    results['setup_s'] = round(setup, 3)
+    results['peak_rss_mib'] = peak_rss_mib()
+    return results
+
+
+def compare(baseline, current, threshold=REGRESSION_THRESHOLD):
+    """
+    Compares two result files.
+
+    A benchmark regressed if its throughput dropped, or its p50/p99 latency or the
+    peak RSS of its size grew, by more than threshold (relative).
+
+    Returns:
+        A list of (size, benchmark, metric, baseline value, current value, relative change) tuples,
+        one per regression.
+    """
+    regressions = []
+    for size, benchmarks in current['results'].items():
+        old_benchmarks = baseline['results'].get(size)
+        if old_benchmarks is None:
+            continue
+        for name, result in benchmarks.items():
+            old = old_benchmarks.get(name)
+            if old is None:
+                continue
+            if name == 'peak_rss_mib':
+                checks = [('peak_rss_mib', old, result, 1)]
+            elif isinstance(result, dict):
+                checks = [('throughput_per_s', old['throughput_per_s'], result['throughput_per_s'], -1),
+                          ('p50_ms', old['p50_ms'], result['p50_ms'], 1),
+                          ('p99_ms', old['p99_ms'], result['p99_ms'], 1)]
+            else:
+                continue  # setup_s: informational only
+            for metric, old_value, new_value, worse in checks:
+                if not old_value:
+                    continue
+                change = (new_value - old_value) / old_value
+                if change * worse > threshold:
+                    regressions.append((size, name, metric, old_value, new_value, change))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.scan_pipeline',
+                                     description='Micro-benchmarks of the scan pipeline.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run = commands.add_parser('run', help='run the benchmarks and write the results as JSON')
+    run.add_argument('--sizes', default=','.join(str(size) for size in SIZES),
+                     help='comma-separated corpus sizes (documents)')
+    run.add_argument('--samples', type=int, default=SAMPLES, help='calls timed per per-document benchmark')
+    run.add_argument('--scans', type=int, default=SCAN_REQUESTS, help='/scan requests per size')
+    run.add_argument('--matches', type=int, default=MATCHES_REQUESTS, help='/matches requests per size')
+    run.add_argument('--seed', type=int, default=0)
+    run.add_argument('--output', default='benchmark_results.json')
+
+    check = commands.add_parser('compare', help='flag regressions between two result files')
+    check.add_argument('baseline')
+    check.add_argument('current')
+    check.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD,
+                       help='relative slowdown reported as a regression (0.1 = 10%%)')
+
+    # Internal: one size, run by `run` in a fresh process and scratch directory
+    single = commands.add_parser('size')
+    single.add_argument('documents', type=int)
+    single.add_argument('output')
+    single.add_argument('--samples', type=int, default=SAMPLES)
+    single.add_argument('--scans', type=int, default=SCAN_REQUESTS)
+    single.add_argument('--matches', type=int, default=MATCHES_REQUESTS)
+    single.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    if args.command == 'size':
+        sys.path.insert(0, PROJECT_ROOT)
+        results = run_size(args.documents, samples=args.samples, scan_requests=args.scans,
+                           matches_requests=args.matches, seed=args.seed)
+        with open(args.output, 'w') as f:
+            json.dump(results, f)
+        return 0
+
+    if args.command == 'compare':
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.current) as f:
+            current = json.load(f)
+        regressions = compare(baseline, current, threshold=args.threshold)
+        for size, name, metric, old_value, new_value, change in regressions:
+            print(f"REGRESSION {size} documents, {name} {metric}: {old_value} -> {new_value} ({change:+.1%})")
+        print(f"{len(regressions)} regressions above {args.threshold:.0%}")
+        return 1 if regressions else 0
+
+    report = {
+        'meta': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'seed': args.seed,
+        },
+        'results': {},
+    }
+    for documents in [int(size) for size in args.sizes.split(',')]:
+        with tempfile.TemporaryDirectory() as scratch:
+            output = os.path.join(scratch, 'results.json')
+            print(f"Benchmarking {documents} documents...", file=sys.stderr)
+            # The app reads uploads/ and the database from its working directory
+            subprocess.run([sys.executable, '-m', 'benchmarks.scan_pipeline', 'size', str(documents), output,
+                            '--samples', str(args.samples), '--scans', str(args.scans),
+                            '--matches', str(args.matches), '--seed', str(args.seed)],
+                           cwd=scratch, env=dict(os.environ, PYTHONPATH=PROJECT_ROOT),
+                           stdout=subprocess.DEVNULL, check=True)
+            with open(output) as f:
+                report['results'][str(documents)] = json.load(f)
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    for documents, results in report['results'].items():
+        print(f"{documents} documents (peak RSS {results['peak_rss_mib']} MiB):")
+        for name, result in results.items():
+            if isinstance(result, dict):
+                print(f"  {name:<30} {result['throughput_per_s']:>12.1f}/s  p50 {result['p50_ms']:.3f} ms"
+                      f"  p99 {result['p99_ms']:.3f} ms")
+    print(f"Results written to {args.output}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,80 @@
+"""
+Measures similarity query latency for a growing number of search shards.
+
+The same synthetic corpus is queried in process (SimilarityEngine.query, as the
+web app does without shards) and through a ShardCoordinator with local shard
+server processes. Every shard scans only its part of the corpus, so latency
+goes down with the shard count as long as there are cores for the shards.
+
+Usage:
+    python -m benchmarks.sharded_search [--documents N] [--shards 1,2,4] [--queries N] [--batch N]
+"""
+import argparse
+import os
+import random
+import time
+
+from benchmarks.corpus import generate_corpus
+from benchmarks.scan_pipeline import summarize
+from search_index import InvertedIndex
+from shards import ShardCoordinator
+from similarity_engine import SimilarityEngine
+from streaming_ingest import PUNCTUATION
+
+TOP_K = 5
+
+
+def time_queries(search, query_ids, index):
+    latencies = []
+    for doc_id in query_ids:
+        query_vector = index.tfidf_vector(doc_id)
+        started = time.perf_counter()
+        search(query_vector, doc_id)
+        latencies.append(time.perf_counter() - started)
+    return summarize(latencies)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.sharded_search', description=__doc__.split('\n\n')[0])
+    parser.add_argument('--documents', type=int, default=20000)
+    parser.add_argument('--vocabulary', type=int, default=50000)
+    parser.add_argument('--words', type=int, default=300, help='words per document')
+    parser.add_argument('--shards', default='1,2,4', help='comma-separated shard counts')
+    parser.add_argument('--queries', type=int, default=200, help='single queries timed per configuration')
+    parser.add_argument('--batch', type=int, default=100, help='queries of the timed batch query')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    corpus = generate_corpus(args.documents, args.vocabulary, args.words, seed=args.seed, near_duplicates=0.1)
+    index = InvertedIndex()
+    for doc_id, text in corpus:
+        index.add_document(doc_id, PUNCTUATION.sub('', text.lower()).split())
+    query_ids = random.Random(args.seed).sample(index.doc_ids(), min(args.queries, len(index)))
+    batch_ids = query_ids[:args.batch]
+    print(f"{len(index)} documents, {len(index.vocabulary)} terms, {os.cpu_count()} cores")
+
+    engine = SimilarityEngine(index)
+    result = time_queries(lambda query_vector, doc_id: engine.query(query_vector, k=TOP_K, exclude=doc_id),
+                          query_ids, index)
+    print(f"  {'in process':<12} top_k p50 {result['p50_ms']:8.3f} ms  p99 {result['p99_ms']:8.3f} ms")
+
+    for shards in [int(count) for count in args.shards.split(',')]:
+        started = time.perf_counter()
+        coordinator = ShardCoordinator(index, shards=shards)
+        try:
+            setup = time.perf_counter() - started
+            result = time_queries(lambda query_vector, doc_id: coordinator.top_k(query_vector, TOP_K, exclude=doc_id),
+                                  query_ids, index)
+            query_vectors = [index.tfidf_vector(doc_id) for doc_id in batch_ids]
+            started = time.perf_counter()
+            coordinator.top_k_batch(query_vectors, TOP_K, exclude=batch_ids)
+            batch = time.perf_counter() - started
+        finally:
+            coordinator.close()
+            index.listeners.remove(coordinator)
+        print(f"  {f'{shards} shards':<12} top_k p50 {result['p50_ms']:8.3f} ms  p99 {result['p99_ms']:8.3f} ms  "
+              f"batch of {len(batch_ids)} {batch * 1000:8.1f} ms  (setup {setup:.1f}s)")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,179 @@
 import sqlite3
-from flask import Flask
+import threading
+import time
+from flask import g
+
+from metrics import DB_QUERY_SECONDS
 
 
 DATABASE = 'new_database.db'  #Main database initialization
 
+# Settings applied once to every pooled connection
+BUSY_TIMEOUT_MS = 5000  # Wait this long for another writer instead of failing with "database is locked"
+CACHE_SIZE_KIB = 16 * 1024  # Page cache per connection
+MMAP_SIZE = 256 * 1024 * 1024  # Bytes of the database file read through mmap
+CACHED_STATEMENTS = 256  # Prepared statements kept per connection
+POOL_MAX_IDLE = 8  # Idle connections kept open for reuse
+
+
+def statement_type(sql):
+    """Label of a statement for the query timing histogram: its first keyword (SELECT, INSERT, ...)."""
+    words = sql.split(None, 1)
+    return words[0].upper() if words else 'EMPTY'
+
+
+class TimedCursor(sqlite3.Cursor):
+    """Cursor recording the duration of every statement in DB_QUERY_SECONDS."""
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            DB_QUERY_SECONDS.observe(time.perf_counter() - start, statement_type(sql))
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            DB_QUERY_SECONDS.observe(time.perf_counter() - start, statement_type(sql))
+
+
+class PooledConnection(sqlite3.Connection):
+    """
+    sqlite3 connection handed out by ConnectionPool.
+
+    close() gives the connection back to its pool instead of closing it, so the
+    existing `conn = get_db_connection() ... conn.close()` call sites reuse
+    connections (and their prepared statement cache) without changes.
+    """
+
+    pool = None
+
+    # Every statement goes through a TimedCursor, including the execute() shortcuts
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.release(self)
+        else:
+            super().close()
+
+    def close_connection(self):
+        """Really closes the underlying database connection."""
+        super().close()
+
+
+class ConnectionPool:
+    """
+    Pool of tuned SQLite connections.
+
+    A thread checks out one connection and keeps getting that same connection
+    for nested get_db_connection() calls (and for a whole Flask request, see
+    init_app) until every checkout has been closed again; only then does it go
+    back to the idle list, with any transaction left open rolled back.
+    """
+
+    def __init__(self, database, max_idle=POOL_MAX_IDLE):
+        self.database = database
+        self.max_idle = max_idle
+        self._idle = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.database, timeout=BUSY_TIMEOUT_MS / 1000, factory=PooledConnection,
+                               cached_statements=CACHED_STATEMENTS, check_same_thread=False)
+        # WAL lets readers run alongside the single writer; NORMAL sync is durable enough with WAL
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute(f"PRAGMA cache_size = {-CACHE_SIZE_KIB}")
+        conn.execute(f"PRAGMA mmap_size = {MMAP_SIZE}")
+        conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+        conn.pool = self
+        return conn
+
+    def acquire(self):
+        """Checks out this thread's connection (opening or reusing one if it has none yet)."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            self._local.depth += 1
+            return conn
+
+        with self._lock:
+            conn = self._idle.pop() if self._idle else None
+        if conn is None:
+            conn = self._connect()
+        conn.row_factory = sqlite3.Row  # Return rows as dictionaries
+        self._local.conn = conn
+        self._local.depth = 1
+        return conn
+
+    def release(self, conn):
+        """Undoes one acquire(); the last one returns the connection to the idle list."""
+        if getattr(self._local, 'conn', None) is not conn:
+            return  # Already released (e.g. closed twice); it may be in use elsewhere by now
+        self._local.depth -= 1
+        if self._local.depth > 0:
+            return
+
+        self._local.conn = None
+        try:
+            if conn.in_transaction:  # Never hand out a connection in the middle of someone's transaction
+                conn.rollback()
+        except sqlite3.Error:
+            conn.close_connection()
+            return
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(conn)
+                return
+        conn.close_connection()
+
+    def close_all(self):
+        """Closes every idle connection."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close_connection()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """Returns the pool for DATABASE (a new one if DATABASE was changed)."""
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool.database != DATABASE:
+            if _pool is not None:
+                _pool.close_all()
+            _pool = ConnectionPool(DATABASE)
+        return _pool
+
 def get_db_connection():
-    conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row  # Return rows as dictionaries
+    conn = get_pool().acquire()
     return conn
 
+def init_app(app):
+    """
+    Pins one pooled connection to each request: every get_db_connection() during
+    the request reuses it, and the teardown hook hands it back to the pool.
+    """
+    @app.before_request
+    def acquire_request_connection():
+        g.db_connection = get_db_connection()
+
+    @app.teardown_request
+    def release_request_connection(exception=None):
+        conn = g.pop('db_connection', None)
+        if conn is not None:
+            conn.close()
@@ -0,0 +1,303 @@
+"""
+Text extraction for uploads that are not plain text (PDFs, and images through OCR).
+
+Extractors are registered per file extension in EXTRACTORS. TextExtractor runs
+them on its own process pool, so a slow or stuck file never blocks a request
+thread or the scan pool: every document is split into page ranges extracted in
+parallel, and a document is given up on as soon as one of its tasks takes longer
+than the timeout.
+The extracted text is cached on disk under the upload's content hash, so each
+distinct document is extracted once; scans, batch scans, queued jobs and index
+rebuilds then tokenize the cached text file exactly like a .txt upload.
+
+OCR needs the optional pytesseract and Pillow packages (and the tesseract
+binary); without them images are stored but not analyzed, as before.
+"""
+import os
+import signal
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+
+import pdf_text
+
+try:
+    import pytesseract
+    from PIL import Image
+except ImportError:  # OCR is optional
+    pytesseract = None
+
+EXTRACTED_TEXT_FOLDER = 'extracted_text'  # Cached text of extracted uploads, one <content hash>.txt per document
+EXTRACTION_TIMEOUT = 30.0  # Seconds one extraction task (a file's page count, or one range of its pages) may take
+EXTRACTION_WORKERS = os.cpu_count() or 1  # Processes extracting text
+PAGES_PER_TASK = 8  # Pages of one document extracted per pool task
+TIMEOUT_GRACE = 2.0  # Extra seconds the web process waits for a worker to report its own timeout
+WORKER_EXIT_TIMEOUT = 1.0  # Seconds a discarded worker gets to exit on SIGTERM before it is killed
+
+
+class ExtractionError(Exception):
+    """Raised when the text of a document cannot be extracted."""
+
+
+class ExtractionTimeout(ExtractionError):
+    """Raised in a worker when a document takes longer than its timeout."""
+
+
+class Extractor:
+    """
+    Extracts the text of one file type, page by page.
+
+    Extractors run in the worker processes of TextExtractor, so their methods
+    take a file path and only return plain picklable values.
+    """
+
+    name = None
+
+    def page_count(self, path):
+        """Returns the number of separately extractable pages of a file."""
+        return 1
+
+    def extract_pages(self, path, first, last):
+        """Returns the text of pages first..last-1 (0-based) as a list of strings."""
+        raise NotImplementedError
+
+
+class PdfExtractor(Extractor):
+    """Text layer of PDF files, read by the pure-Python parser in pdf_text."""
+
+    name = 'pdf'
+
+    def page_count(self, path):
+        return pdf_text.page_count(path)
+
+    def extract_pages(self, path, first, last):
+        return pdf_text.extract_pages(path, first, last)
+
+
+class OcrExtractor(Extractor):
+    """Text of scanned images, recognized with Tesseract."""
+
+    name = 'tesseract'
+
+    def extract_pages(self, path, first, last):
+        with Image.open(path) as image:
+            return [pytesseract.image_to_string(image)]
+
+
+# File extension -> Extractor; uploads of other types are stored without text analysis
+EXTRACTORS = {}
+
+
+def register_extractor(extensions, extractor):
+    """Makes an extractor handle uploads with the given (lowercase) extensions."""
+    for extension in extensions:
+        EXTRACTORS[extension] = extractor
+
+
+register_extractor(['pdf'], PdfExtractor())
+if pytesseract is not None:
+    register_extractor(['png', 'jpg', 'jpeg'], OcrExtractor())
+
+
+def _run_with_timeout(timeout, function, *args):
+    # Runs in a worker process: an interval timer interrupts pure-Python work that overruns
+    def expire(signum, frame):
+        raise ExtractionTimeout(f"Extraction took longer than {timeout:g} seconds")
+
+    if not hasattr(signal, 'setitimer'):
+        return function(*args)
+    previous = signal.signal(signal.SIGALRM, expire)
+    signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        return function(*args)
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+def _count_pages(extension, path, timeout):
+    return _run_with_timeout(timeout, EXTRACTORS[extension].page_count, path)
+
+
+def _extract_pages(extension, path, first, last, timeout):
+    return _run_with_timeout(timeout, EXTRACTORS[extension].extract_pages, path, first, last)
+
+
+class TextExtractor:
+    """
+    Extracts and caches the text of non-text uploads on a process pool.
+
+    Args:
+        cache_folder: Folder holding the extracted text files.
+        workers: Worker processes.
+        timeout: Seconds one task (page count, or one range of pages) may take.
+        pages_per_task: Pages extracted per pool task (smaller: more parallelism, more overhead).
+    """
+
+    def __init__(self, cache_folder=EXTRACTED_TEXT_FOLDER, workers=EXTRACTION_WORKERS, timeout=EXTRACTION_TIMEOUT,
+                 pages_per_task=PAGES_PER_TASK):
+        self.cache_folder = cache_folder
+        self.workers = workers
+        self.timeout = timeout
+        self.pages_per_task = pages_per_task
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+    def supports(self, extension):
+        return extension in EXTRACTORS
+
+    def cached_text_path(self, content_hash):
+        """Returns the path of the cached text of a document, or None if it was not extracted yet."""
+        path = os.path.join(self.cache_folder, f"{content_hash}.txt")
+        return path if os.path.isfile(path) else None
+
+    def _get_pool(self):
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.workers)
+            return self._pool
+
+    def _discard_pool(self, pool):
+        # A worker that ignored its own timeout may still be busy; new work goes to a fresh pool
+        with self._pool_lock:
+            if self._pool is pool:
+                self._pool = None
+        processes = list((pool._processes or {}).values())  # Taken first: shutdown forgets them
+        pool.shutdown(wait=False, cancel_futures=True)
+        # The stuck worker would otherwise keep its process (and a core) until it returns, if ever
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join(WORKER_EXIT_TIMEOUT)
+            if process.is_alive():
+                process.kill()
+                process.join()
+
+    def shutdown(self):
+        with self._pool_lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)  # Running tasks end by their own timeout at the latest
+
+    def extract(self, path, extension, content_hash):
+        """
+        Returns the path of the text file holding the extracted text of an upload.
+
+        Raises:
+            ExtractionError: No extractor for the extension, or extraction failed or timed out.
+        """
+        result = self.extract_many([(path, extension, content_hash)])[content_hash]
+        if isinstance(result, ExtractionError):
+            raise result
+        return result
+
+    def extract_many(self, uploads):
+        """
+        Extracts several uploads at once, all their pages sharing the pool.
+
+        Args:
+            uploads: List of (path, extension, content_hash) tuples; uploads with the
+                same content hash are extracted once.
+
+        Returns:
+            A dictionary content_hash -> path of the extracted text file, or the ExtractionError it failed with.
+        """
+        results = {}
+        pending = {}
+        for path, extension, content_hash in uploads:
+            if content_hash in results or content_hash in pending:
+                continue
+            cached = self.cached_text_path(content_hash)
+            if cached is not None:
+                results[content_hash] = cached
+            elif extension not in EXTRACTORS:
+                results[content_hash] = ExtractionError(f"No text extractor for .{extension} files")
+            else:
+                pending[content_hash] = (path, extension)
+        if not pending:
+            return results
+
+        pool = self._get_pool()
+        # Workers interrupt their own task after self.timeout; waiting any longer than that (plus
+        # the time to report it) for the next result means a worker is stuck outside Python code
+        wait = self.timeout + TIMEOUT_GRACE
+
+        counts = {content_hash: pool.submit(_count_pages, extension, path, self.timeout)
+                  for content_hash, (path, extension) in pending.items()}
+        tasks = {}
+        timed_out = False
+        for content_hash, future in counts.items():
+            path, extension = pending[content_hash]
+            try:
+                pages = future.result(timeout=wait)
+            except FutureTimeoutError:
+                timed_out = True
+                results[content_hash] = ExtractionTimeout(f"Extraction took longer than {self.timeout:g} seconds")
+                continue
+            except ExtractionError as e:  # Including the worker's own ExtractionTimeout
+                results[content_hash] = e
+                continue
+            except Exception as e:
+                results[content_hash] = ExtractionError(f"Cannot read .{extension} file: {e}")
+                continue
+            # Page ranges of all documents are queued together, so pages of different files run in parallel too
+            tasks[content_hash] = [pool.submit(_extract_pages, extension, path, first, first + self.pages_per_task,
+                                               self.timeout)
+                                   for first in range(0, max(pages, 1), self.pages_per_task)]
+
+        for content_hash, futures in tasks.items():
+            path, extension = pending[content_hash]
+            pages = []
+            try:
+                for future in futures:
+                    pages.extend(future.result(timeout=wait))
+            except FutureTimeoutError:
+                timed_out = True
+                results[content_hash] = ExtractionTimeout(f"Extraction took longer than {self.timeout:g} seconds")
+            except ExtractionError as e:
+                results[content_hash] = e
+            except Exception as e:
+                results[content_hash] = ExtractionError(f"Cannot read .{extension} file: {e}")
+            else:
+                results[content_hash] = self._store(content_hash, '\n'.join(pages))
+            if isinstance(results[content_hash], ExtractionError):
+                for future in futures:
+                    future.cancel()
+
+        if timed_out:
+            self._discard_pool(pool)
+        return results
+
+    def _store(self, content_hash, text):
+        # Written under a temporary name and renamed, so readers never see a partial file
+        os.makedirs(self.cache_folder, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_folder, prefix='.extract-', suffix='.part')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8', errors='replace') as f:
+                f.write(text)
+            path = os.path.join(self.cache_folder, f"{content_hash}.txt")
+            os.replace(tmp_path, path)
+            return path
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+
+def upload_text_path(upload_folder, filename, cache_folder=EXTRACTED_TEXT_FOLDER):
+    """
+    Returns the path of the text a stored upload is indexed by: the upload itself
+    for .txt files, the cached extracted text for other extractable types, or
+    None if there is no text (yet).
+    """
+    stem, _, extension = filename.rpartition('.')
+    extension = extension.lower()
+    if not stem or filename.startswith('.'):
+        return None  # No extension, or a partial upload still being written
+    if extension == 'txt':
+        return os.path.join(upload_folder, filename)
+    if extension in EXTRACTORS:
+        # Stored uploads are named after their content hash
+        path = os.path.join(cache_folder, f"{stem}.txt")
+        return path if os.path.isfile(path) else None
+    return None
@@ -0,0 +1,220 @@
+import mmap
+import os
+import struct
+import zlib
+from array import array
+
+from search_index import InvertedIndex
+
+# Snapshot file layout (all integers little-endian):
+#   header   magic, format version, index generation, #documents, #terms, #postings, text blob sizes
+#   text     newline-joined document filenames, newline-joined vocabulary (in term id order)
+#   arrays   doc lengths (u32), doc store segments (i64), doc store offsets (i64), doc norms (f64),
+#            term posting offsets (u64, #terms + 1), idf (f64),
+#            posting doc numbers (u32), posting counts (u32),
+#            doc vector offsets (u64, #documents + 1), doc vector term ids (u32), doc vector counts (u32)
+#   trailer  CRC32 of everything above (u32)
+# Both the postings and the per-document vectors are stored, so loading only slices arrays.
+SNAPSHOT_MAGIC = b'FSIDX\x00'
+SNAPSHOT_VERSION = 4
+HEADER_FORMAT = '<6sHQIIQQQ'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+TRAILER_FORMAT = '<I'
+TRAILER_SIZE = struct.calcsize(TRAILER_FORMAT)
+
+
+class SnapshotError(Exception):
+    """Raised when a snapshot is missing, corrupt or written by another format version."""
+
+
+def _little_endian(values):
+    if struct.pack('=H', 1) != struct.pack('<H', 1):
+        values.byteswap()
+    return values
+
+
+def save_snapshot(index, path, doc_versions):
+    """
+    Writes the index to a binary snapshot file.
+
+    The file is written next to the target and atomically renamed into place,
+    so a crash while saving never leaves a half-written snapshot behind.
+
+    Args:
+        index: The InvertedIndex to save.
+        path: Destination path of the snapshot.
+        doc_versions: Dictionary mapping doc_ids to the (segment, offset) of the corpus store
+            record they were read from.
+    """
+    # Removed documents leave gaps in the index's doc numbers; the snapshot numbers live documents densely
+    doc_numbers = [number for number, vector in enumerate(index.doc_vectors) if vector is not None]
+    renumbered = {old: new for new, old in enumerate(doc_numbers)}
+    doc_ids = [index.doc_ids_by_number[number] for number in doc_numbers]
+    terms = index.vocabulary.terms
+
+    doc_lengths = array('I', (index.doc_lengths[number] for number in doc_numbers))
+    doc_segments = array('q', (doc_versions.get(doc_id, (0, 0))[0] for doc_id in doc_ids))
+    doc_offsets = array('q', (doc_versions.get(doc_id, (0, 0))[1] for doc_id in doc_ids))
+    doc_norms = array('d', (index.norm(doc_id) for doc_id in doc_ids))
+
+    vector_offsets = array('Q', [0])
+    vector_terms = array('I')
+    vector_counts = array('I')
+    for number in doc_numbers:
+        term_ids, counts = index.doc_vectors[number]
+        vector_terms.extend(term_ids)
+        vector_counts.extend(counts)
+        vector_offsets.append(len(vector_terms))
+
+    term_offsets = array('Q', [0])
+    term_idf = array('d')
+    posting_docs = array('I')
+    posting_counts = array('I')
+    nothing_removed = len(doc_numbers) == len(index.doc_vectors)
+    for term_id in range(len(terms)):
+        if nothing_removed:  # Doc numbers are already dense, so the postings are copied as they are
+            posting_docs.extend(index.postings[term_id][0])
+            posting_counts.extend(index.postings[term_id][1])
+        else:
+            for number, count in zip(*index.postings[term_id]):
+                new_number = renumbered.get(number)
+                if new_number is not None:
+                    posting_docs.append(new_number)
+                    posting_counts.append(count)
+        term_offsets.append(len(posting_docs))
+        term_idf.append(index.term_idf(term_id))
+
+    doc_blob = '\n'.join(doc_ids).encode('utf-8')
+    term_blob = '\n'.join(terms).encode('utf-8')
+    header = struct.pack(HEADER_FORMAT, SNAPSHOT_MAGIC, SNAPSHOT_VERSION, index.generation,
+                         len(doc_ids), len(terms), len(posting_docs), len(doc_blob), len(term_blob))
+
+    body = [header, doc_blob, term_blob]
+    for values in (doc_lengths, doc_segments, doc_offsets, doc_norms,
+                   term_offsets, term_idf, posting_docs, posting_counts,
+                   vector_offsets, vector_terms, vector_counts):
+        body.append(_little_endian(values).tobytes())
+
+    checksum = 0
+    for chunk in body:
+        checksum = zlib.crc32(chunk, checksum)
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        for chunk in body:
+            f.write(chunk)
+        f.write(struct.pack(TRAILER_FORMAT, checksum))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _read_array(typecode, buffer, offset, count):
+    values = array(typecode)
+    end = offset + count * values.itemsize
+    if end > len(buffer):
+        raise SnapshotError("Snapshot is truncated")
+    values.frombytes(buffer[offset:end])
+    return _little_endian(values), end
+
+
+def load_snapshot(path):
+    """
+    Loads an index snapshot written by save_snapshot.
+
+    The file is memory-mapped and validated (magic, version and checksum)
+    before any of it is decoded.
+
+    Args:
+        path: Path of the snapshot file.
+
+    Returns:
+        A tuple (index, doc_versions) with the restored InvertedIndex and a dictionary
+        mapping doc_ids to the (segment, offset) recorded when the snapshot was taken.
+
+    Raises:
+        SnapshotError: If the snapshot is missing, corrupt or from another version.
+    """
+    try:
+        with open(path, 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                buffer = memoryview(mapped)
+                try:
+                    return _decode_snapshot(buffer)
+                finally:
+                    buffer.release()
+    except (OSError, ValueError) as e:
+        raise SnapshotError(f"Cannot read snapshot {path}: {e}") from e
+
+
+def _decode_snapshot(buffer):
+    try:
+        if len(buffer) < HEADER_SIZE + TRAILER_SIZE:
+            raise SnapshotError("Snapshot is truncated")
+
+        (magic, version, generation, num_docs, num_terms, num_postings,
+         doc_blob_size, term_blob_size) = struct.unpack_from(HEADER_FORMAT, buffer, 0)
+        if magic != SNAPSHOT_MAGIC:
+            raise SnapshotError("Not an index snapshot")
+        if version != SNAPSHOT_VERSION:
+            raise SnapshotError(f"Unsupported snapshot version {version} (expected {SNAPSHOT_VERSION})")
+
+        body_size = len(buffer) - TRAILER_SIZE
+        (checksum,) = struct.unpack_from(TRAILER_FORMAT, buffer, body_size)
+        if zlib.crc32(buffer[:body_size]) != checksum:
+            raise SnapshotError("Snapshot checksum mismatch")
+
+        offset = HEADER_SIZE
+        doc_blob = bytes(buffer[offset:offset + doc_blob_size]).decode('utf-8')
+        offset += doc_blob_size
+        term_blob = bytes(buffer[offset:offset + term_blob_size]).decode('utf-8')
+        offset += term_blob_size
+        doc_ids = doc_blob.split('\n') if num_docs else []
+        terms = term_blob.split('\n') if num_terms else []
+        if len(doc_ids) != num_docs or len(terms) != num_terms:
+            raise SnapshotError("Snapshot name tables do not match its header")
+
+        doc_lengths, offset = _read_array('I', buffer, offset, num_docs)
+        doc_segments, offset = _read_array('q', buffer, offset, num_docs)
+        doc_offsets, offset = _read_array('q', buffer, offset, num_docs)
+        doc_norms, offset = _read_array('d', buffer, offset, num_docs)
+        term_offsets, offset = _read_array('Q', buffer, offset, num_terms + 1)
+        term_idf, offset = _read_array('d', buffer, offset, num_terms)
+        posting_docs, offset = _read_array('I', buffer, offset, num_postings)
+        posting_counts, offset = _read_array('I', buffer, offset, num_postings)
+        vector_offsets, offset = _read_array('Q', buffer, offset, num_docs + 1)
+        vector_terms, offset = _read_array('I', buffer, offset, num_postings)
+        vector_counts, offset = _read_array('I', buffer, offset, num_postings)
+        if offset != body_size:
+            raise SnapshotError("Snapshot size does not match its header")
+        if term_offsets[-1] != num_postings or vector_offsets[-1] != num_postings:
+            raise SnapshotError("Snapshot offsets do not match its header")
+    except (struct.error, UnicodeDecodeError) as e:
+        raise SnapshotError(f"Corrupt snapshot: {e}") from e
+
+    index = InvertedIndex()
+    for term in terms:
+        index.vocabulary.intern(term)
+    if len(index.vocabulary) != num_terms:
+        raise SnapshotError("Snapshot vocabulary contains duplicate terms")
+    index.postings = [(posting_docs[term_offsets[term_id]:term_offsets[term_id + 1]],
+                       posting_counts[term_offsets[term_id]:term_offsets[term_id + 1]])
+                      for term_id in range(num_terms)]
+    index.dead_postings = array('I', bytes(4 * num_terms))
+    index.document_frequency = array('I', (len(doc_numbers) for doc_numbers, _ in index.postings))
+
+    index.doc_numbers = {doc_id: number for number, doc_id in enumerate(doc_ids)}
+    index.doc_ids_by_number = doc_ids
+    index.doc_vectors = [(vector_terms[vector_offsets[number]:vector_offsets[number + 1]],
+                          vector_counts[vector_offsets[number]:vector_offsets[number + 1]])
+                         for number in range(num_docs)]
+    index.doc_lengths = doc_lengths
+
+    # IDF and norms are only valid for exactly this corpus, so prime the caches for this generation
+    index.generation = generation
+    index._cache_generation = generation
+    index._idf_cache = dict(enumerate(term_idf))
+    index._norm_cache = dict(enumerate(doc_norms))
+
+    doc_versions = {doc_id: (doc_segments[n], doc_offsets[n]) for n, doc_id in enumerate(doc_ids)}
+    return index, doc_versions
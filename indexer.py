@@ -0,0 +1,274 @@
+"""
+Parallel (re)indexing of the corpus.
+
+The corpus store is first brought in line with the uploads folder. Tokenizing
+every stored document on one core is what makes a full rebuild slow, so this
+splits the documents into chunks that worker processes tokenize (map), each
+producing a partial vocabulary with per-document term vectors, document lengths
+and MinHash signatures. The partial tables are merged into one InvertedIndex with
+NumPy (reduce): local term ids are mapped to global ones, postings are built by
+sorting all (term, document) entries once, and the global IDF and document norms
+are computed as vectors. The result is written as the index snapshot and the
+near-duplicate index, which the web app loads at its next start.
+
+Usage:
+    python -m indexer reindex [--workers N] [--uploads uploads] [--corpus corpus_segments] [--chunk-size 64]
+
+Run it while the web app is stopped; a running app overwrites both files with
+its own indexes on its next snapshot.
+"""
+import argparse
+import os
+import sys
+import time
+from array import array
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from extraction import upload_text_path
+from index_snapshot import save_snapshot
+from near_duplicates import MinHashLSH
+from search_index import InvertedIndex
+from segment_store import SegmentStore, sync_with_uploads
+from streaming_ingest import analyze_text
+
+UPLOAD_FOLDER = 'uploads'
+CORPUS_FOLDER = 'corpus_segments'  # Same files as CORPUS_FOLDER/INDEX_SNAPSHOT_PATH/NEAR_DUPLICATE_INDEX_PATH in app.py
+INDEX_SNAPSHOT_PATH = 'index.snapshot'
+NEAR_DUPLICATE_INDEX_PATH = 'near_duplicates.npz'
+CHUNK_SIZE = 64  # Documents tokenized per worker task
+
+_worker_stores = {}  # corpus folder -> read-only SegmentStore, opened once per worker process
+
+
+def list_corpus_documents(store):
+    """
+    Returns the documents of the corpus store.
+
+    Returns:
+        A sorted list of (doc_id, (segment, offset)) tuples.
+    """
+    return sorted((doc_id, store.location(doc_id)) for doc_id in store.keys())
+
+
+def tokenize_chunk(corpus_folder, filenames, bands, rows):
+    """
+    Map step: tokenizes a chunk of documents into a partial table with its own local vocabulary.
+
+    Documents are tokenized straight from the memory-mapped segments of the corpus store.
+
+    Returns:
+        A dictionary with terms (local id -> term), doc_ids, lengths, offsets (per-document
+        slices of term_ids/counts), term_ids, counts, signatures and errors.
+    """
+    store = _worker_stores.get(corpus_folder)
+    if store is None:
+        store = _worker_stores[corpus_folder] = SegmentStore(corpus_folder, read_only=True)
+    local_ids = {}
+    doc_ids, lengths, offsets = [], [], [0]
+    term_ids, counts, signatures, errors = [], [], [], []
+    for filename in filenames:
+        data = store.get(filename)
+        if data is None:
+            errors.append(f"Error reading {filename}: not in the corpus store")
+            continue
+        analysis = analyze_text(data, bands, rows)
+        if analysis['error'] is not None:
+            errors.append(f"Error reading {filename}: {analysis['error']}")
+            continue
+        for term, count in analysis['term_counts'].items():
+            term_ids.append(local_ids.setdefault(term, len(local_ids)))
+            counts.append(count)
+        doc_ids.append(filename)
+        lengths.append(analysis['total_words'])
+        offsets.append(len(term_ids))
+        signatures.append(analysis['signature'])
+
+    return {
+        'terms': list(local_ids),
+        'doc_ids': doc_ids,
+        'lengths': np.asarray(lengths, dtype=np.uint32),
+        'offsets': np.asarray(offsets, dtype=np.int64),
+        'term_ids': np.asarray(term_ids, dtype=np.uint32),
+        'counts': np.asarray(counts, dtype=np.uint32),
+        'signatures': signatures,
+        'errors': errors,
+    }
+
+
+def merge_partials(partials):
+    """
+    Reduce step: merges partial tables into one InvertedIndex.
+
+    Args:
+        partials: tokenize_chunk results, in the order their documents should be numbered.
+
+    Returns:
+        A tuple (index, signatures) with the filled InvertedIndex (IDF and norms
+        already cached) and a dictionary mapping doc_ids to MinHash signatures.
+    """
+    index = InvertedIndex()
+    vocabulary = index.vocabulary
+    doc_ids, lengths, entry_docs, entry_terms, entry_counts = [], [], [], [], []
+    signatures = {}
+    for partial in partials:
+        # Local term ids -> global vocabulary ids
+        mapping = np.asarray([vocabulary.intern(term) for term in partial['terms']], dtype=np.uint32)
+        first_doc = len(doc_ids)
+        doc_ids.extend(partial['doc_ids'])
+        lengths.append(partial['lengths'])
+        entry_docs.append(first_doc + np.repeat(np.arange(len(partial['doc_ids']), dtype=np.uint32),
+                                                np.diff(partial['offsets'])))
+        entry_terms.append(mapping[partial['term_ids']] if len(mapping) else partial['term_ids'])
+        entry_counts.append(partial['counts'])
+        signatures.update(zip(partial['doc_ids'], partial['signatures']))
+
+    num_docs, num_terms = len(doc_ids), len(vocabulary)
+    lengths = np.concatenate(lengths) if lengths else np.zeros(0, dtype=np.uint32)
+    entry_docs = np.concatenate(entry_docs) if entry_docs else np.zeros(0, dtype=np.uint32)
+    entry_terms = np.concatenate(entry_terms) if entry_terms else np.zeros(0, dtype=np.uint32)
+    entry_counts = np.concatenate(entry_counts) if entry_counts else np.zeros(0, dtype=np.uint32)
+
+    # Document vectors: entries grouped by document, term ids ascending within each one
+    order = np.lexsort((entry_terms, entry_docs))
+    vector_terms, vector_counts = entry_terms[order], entry_counts[order]
+    vector_offsets = np.concatenate([[0], np.cumsum(np.bincount(entry_docs, minlength=num_docs))]).astype(np.int64)
+
+    # Postings: a stable sort by term keeps each term's documents in ascending order
+    order = np.argsort(vector_terms, kind='stable')
+    vector_docs = np.repeat(np.arange(num_docs, dtype=np.uint32), np.diff(vector_offsets))
+    posting_docs, posting_counts = vector_docs[order], vector_counts[order]
+    document_frequency = np.bincount(vector_terms, minlength=num_terms)
+    term_offsets = np.concatenate([[0], np.cumsum(document_frequency)]).astype(np.int64)
+
+    # Global IDF (same formula as InvertedIndex.idf) and the TF-IDF norm of every document
+    idf = np.zeros(num_terms, dtype=np.float64)
+    present = document_frequency > 0
+    idf[present] = np.log(num_docs / (document_frequency[present] + 1)) + 1
+    safe_lengths = np.maximum(lengths, 1).astype(np.float64)
+    weights = vector_counts / safe_lengths[vector_docs] * idf[vector_terms]
+    norms = np.sqrt(np.bincount(vector_docs, weights=weights * weights, minlength=num_docs))
+
+    def as_array(values):
+        column = array('I')
+        column.frombytes(values.astype(np.uint32).tobytes())
+        return column
+
+    index.postings = [(as_array(posting_docs[term_offsets[term_id]:term_offsets[term_id + 1]]),
+                       as_array(posting_counts[term_offsets[term_id]:term_offsets[term_id + 1]]))
+                      for term_id in range(num_terms)]
+    index.dead_postings = array('I', bytes(4 * num_terms))
+    index.document_frequency = as_array(document_frequency)
+    index.doc_numbers = {doc_id: number for number, doc_id in enumerate(doc_ids)}
+    index.doc_ids_by_number = list(doc_ids)
+    index.doc_vectors = [(as_array(vector_terms[vector_offsets[number]:vector_offsets[number + 1]]),
+                          as_array(vector_counts[vector_offsets[number]:vector_offsets[number + 1]]))
+                         for number in range(num_docs)]
+    index.doc_lengths = as_array(lengths)
+
+    # Prime the caches for this generation, as loading a snapshot does
+    index.generation = 1
+    index._cache_generation = index.generation
+    index._idf_cache = dict(enumerate(idf.tolist()))
+    index._norm_cache = dict(enumerate(norms.tolist()))
+    return index, signatures
+
+
+def build_index(corpus_folder, filenames, workers, chunk_size=CHUNK_SIZE, bands=16, rows=8, progress=None):
+    """
+    Tokenizes documents on a process pool and merges the results into one index.
+
+    Args:
+        corpus_folder: Folder of the corpus store holding the documents.
+        filenames: Keys of the documents to index.
+        workers: Number of worker processes (1 tokenizes in this process).
+        chunk_size: Documents per worker task.
+        bands: LSH bands of the near-duplicate signatures.
+        rows: LSH rows per band of the near-duplicate signatures.
+        progress: Optional callable receiving (documents done, total documents) after every chunk.
+
+    Returns:
+        A tuple (index, signatures) as returned by merge_partials.
+    """
+    chunks = [filenames[start:start + chunk_size] for start in range(0, len(filenames), chunk_size)]
+    partials = [None] * len(chunks)
+    done = 0
+
+    def collect(number, partial):
+        nonlocal done
+        partials[number] = partial
+        for error in partial['errors']:
+            print(error, file=sys.stderr)
+        done += len(chunks[number])
+        if progress is not None:
+            progress(done, len(filenames))
+
+    if workers <= 1:
+        for number, chunk in enumerate(chunks):
+            collect(number, tokenize_chunk(corpus_folder, chunk, bands, rows))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(tokenize_chunk, corpus_folder, chunk, bands, rows): number
+                       for number, chunk in enumerate(chunks)}
+            for future in as_completed(futures):
+                collect(futures[future], future.result())
+
+    # Chunks are merged in document order, so the result does not depend on which worker finished first
+    return merge_partials(partials)
+
+
+def reindex(upload_folder=UPLOAD_FOLDER, workers=None, chunk_size=CHUNK_SIZE, snapshot_path=INDEX_SNAPSHOT_PATH,
+            near_duplicate_path=NEAR_DUPLICATE_INDEX_PATH, bands=16, rows=8, progress=None, corpus_folder=CORPUS_FOLDER):
+    """
+    Rebuilds the index snapshot and the near-duplicate index from every document of the uploads folder.
+
+    Returns:
+        The number of indexed documents.
+    """
+    store = SegmentStore(corpus_folder)
+    try:
+        sync_with_uploads(store, upload_folder, lambda filename: upload_text_path(upload_folder, filename))
+        documents = list_corpus_documents(store)
+    finally:
+        store.close()
+    _worker_stores.pop(corpus_folder, None)  # Opened before the sync (forked workers would inherit it)
+    index, signatures = build_index(corpus_folder, [doc_id for doc_id, _ in documents], workers or os.cpu_count() or 1,
+                                    chunk_size=chunk_size, bands=bands, rows=rows, progress=progress)
+    save_snapshot(index, snapshot_path, dict(documents))
+
+    near_duplicate_index = MinHashLSH(bands=bands, rows=rows)
+    for doc_id, signature in signatures.items():
+        near_duplicate_index.add(doc_id, signature)
+    near_duplicate_index.save(near_duplicate_path)
+    return len(index)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m indexer', description='Document index maintenance.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    command = commands.add_parser('reindex', help='rebuild the index snapshot from the uploads folder in parallel')
+    command.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='worker processes (default: all cores)')
+    command.add_argument('--uploads', default=UPLOAD_FOLDER, help='folder with the stored uploads')
+    command.add_argument('--corpus', default=CORPUS_FOLDER, help='folder of the corpus segment files')
+    command.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help='documents per worker task')
+    command.add_argument('--snapshot', default=INDEX_SNAPSHOT_PATH, help='index snapshot to write')
+    command.add_argument('--near-duplicates', default=NEAR_DUPLICATE_INDEX_PATH, help='near-duplicate index to write')
+    args = parser.parse_args(argv)
+
+    started = time.perf_counter()
+
+    def report(done, total):
+        elapsed = time.perf_counter() - started
+        rate = done / elapsed if elapsed else 0
+        print(f"\rTokenized {done}/{total} documents ({done * 100 // max(total, 1)}%, {rate:.0f} documents/s)",
+              end='', file=sys.stderr, flush=True)
+
+    count = reindex(args.uploads, args.workers, args.chunk_size, args.snapshot, args.near_duplicates, progress=report,
+                    corpus_folder=args.corpus)
+    print(file=sys.stderr)
+    print(f"Indexed {count} documents with {args.workers} workers in {time.perf_counter() - started:.1f}s")
+
+
+if __name__ == '__main__':
+    main()
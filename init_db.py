@@ -1,12 +1,14 @@
 import sqlite3
 
+from migrations import migrate
+
 def init_db(db_path="new_database.db"):
     conn = sqlite3.connect(db_path)
     c = conn.cursor()
     
     # Create documents table
     c.execute('''
-    CREATE TABLE documents (
+    CREATE TABLE IF NOT EXISTS documents (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         filename TEXT NOT NULL,
         filepath TEXT NOT NULL,
@@ -17,7 +19,7 @@ def init_db(db_path="new_database.db"):
     
     # Create credit_requests table
     c.execute('''
-    CREATE TABLE credit_requests (
+    CREATE TABLE IF NOT EXISTS credit_requests (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         user_id INTEGER NOT NULL,
         status TEXT DEFAULT 'pending',
@@ -29,7 +31,7 @@ def init_db(db_path="new_database.db"):
     
     # Create users table
     c.execute('''
-    CREATE TABLE users (
+    CREATE TABLE IF NOT EXISTS users (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         username TEXT NOT NULL,
         password_hash TEXT NOT NULL,
@@ -40,6 +42,9 @@ def init_db(db_path="new_database.db"):
     ''')
     
     conn.commit()
+
+    # Bring the schema up to the latest version (every table, column and index added after the baseline tables)
+    migrate(conn)
     conn.close()
 
 if __name__ == "__main__":
@@ -0,0 +1,127 @@
+import os
+import socket
+import threading
+import time
+import traceback
+import uuid
+
+from models import ScanJob
+
+JOB_POLL_INTERVAL = 5.0  # Seconds an idle worker sleeps before looking at the queue again
+JOB_LEASE_SECONDS = 120  # A running job is taken over by another worker once its lease is this old without renewal
+
+
+class ScanWorkerPool:
+    """
+    Worker threads running the jobs of the SQLite-backed scan_jobs queue.
+
+    The queue lives in the database, so queued jobs survive a restart and any
+    number of workers can share it: every worker claims jobs with
+    ScanJob.claim_next, whose write transaction hands each job to exactly one of
+    them. notify() wakes idle workers right away instead of waiting for the next poll.
+
+    A claimed job is leased to this pool and the lease is renewed while the job
+    runs. Jobs of a process that died stop being renewed; once their lease has
+    expired, idle workers of any process put them back into the queue. Jobs still
+    running in other live processes are never taken over.
+    """
+
+    def __init__(self, handler, workers=2, poll_interval=JOB_POLL_INTERVAL, lease_seconds=JOB_LEASE_SECONDS,
+                 on_failure=None, on_result=None):
+        """
+        Args:
+            handler: Callable taking a claimed ScanJob and returning its scan_results dictionary.
+            workers: Number of worker threads.
+            poll_interval: Seconds an idle worker waits before checking the queue again.
+            lease_seconds: Seconds a claimed job stays leased without a renewal (renewed every third of it).
+            on_failure: Optional callable taking a ScanJob whose handler raised, called once the failure
+                is recorded (e.g. to refund its credit); not called if the job was taken over meanwhile.
+            on_result: Optional callable taking a ScanJob and its result, called once the result is
+                stored; likewise not called if the job was taken over meanwhile.
+        """
+        self.handler = handler
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.on_failure = on_failure
+        self.on_result = on_result
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"  # Owner of this pool's leases
+        self._next_requeue = 0.0
+        self._wakeup = threading.Condition()
+        self._pending_wakeups = 0
+        self._stopping = False
+        self._threads = []
+
+    def start(self):
+        """Requeues jobs whose worker died (their lease expired) and starts the worker threads."""
+        self.requeue_expired()
+        for number in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"scan-worker-{number}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        """Lets the workers finish their current job and exit."""
+        with self._wakeup:
+            self._stopping = True
+            self._wakeup.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def notify(self):
+        """Wakes one idle worker, e.g. right after a job was queued."""
+        with self._wakeup:
+            self._pending_wakeups += 1
+            self._wakeup.notify()
+
+    def _wait(self):
+        with self._wakeup:
+            if not self._pending_wakeups and not self._stopping:
+                self._wakeup.wait(self.poll_interval)
+            if self._pending_wakeups:
+                self._pending_wakeups -= 1
+
+    def requeue_expired(self):
+        """Puts running jobs whose lease expired back into the queue."""
+        self._next_requeue = time.monotonic() + self.lease_seconds / 2
+        requeued = ScanJob.requeue_expired()
+        if requeued:
+            print(f"Requeued {requeued} interrupted scan jobs")
+
+    def _run(self):
+        while not self._stopping:
+            job = ScanJob.claim_next(self.worker_id, self.lease_seconds)
+            if job is None:
+                if time.monotonic() >= self._next_requeue:
+                    self.requeue_expired()
+                self._wait()
+                continue
+            self.run_job(job)
+
+    def _renew_lease(self, job, done):
+        while not done.wait(self.lease_seconds / 3):
+            if not ScanJob.renew_lease(job.id, self.worker_id, self.lease_seconds):
+                print(f"Lost the lease of scan job {job.id}; another worker runs it again")
+                return
+
+    def run_job(self, job):
+        """Runs one claimed job, renewing its lease meanwhile, and records its result (or its error) in the queue."""
+        done = threading.Event()
+        renewer = threading.Thread(target=self._renew_lease, args=(job, done), name=f"scan-lease-{job.id}", daemon=True)
+        renewer.start()
+        try:
+            result = self.handler(job)
+        except Exception as e:
+            traceback.print_exc()
+            # Only the worker still holding the job records it, so a job taken over is never refunded twice
+            if ScanJob.finish(job.id, self.worker_id, error=str(e)) and self.on_failure is not None:
+                self.on_failure(job)
+        else:
+            if not ScanJob.finish(job.id, self.worker_id, result=result):
+                print(f"Result of scan job {job.id} not stored: the job was taken over or the database failed")
+            elif self.on_result is not None:
+                self.on_result(job, result)
+        finally:
+            done.set()
+            renewer.join()
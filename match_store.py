@@ -0,0 +1,243 @@
+import sqlite3
+import threading
+
+import numpy as np
+
+from db import get_db_connection
+
+MATCHES_TOP_N = 20  # Neighbours kept per document
+MATCHES_REFRESH_DRIFT = 0.05  # Share of the corpus that may change before all neighbour lists are recomputed
+MATCHES_REFRESH_BATCH = 256  # Documents scored per sparse mat-mat during a refresh
+
+
+class MatchStore:
+    """
+    Materialized nearest-neighbour lists: the top-N most similar documents of every indexed document.
+
+    The lists are kept in memory for lookups and in the document_matches table so they
+    survive a restart; changed lists are written in batches by flush(). As an index listener
+    the store gives a new document its own list at ingest time (one top-N query). Which
+    existing lists the document enters is settled later by merge_new_documents(), in the
+    background: that takes every new document's full score column, and the ingest holding
+    the index lock only pays for the top-N query.
+
+    Every added or removed document also moves the IDF of its terms (and N), so scores
+    already in the lists slowly drift from what a fresh query would compute. Once the
+    share of documents changed since the last full refresh passes drift_threshold,
+    refresh() recomputes every list in batches through the SimilarityEngine.
+    """
+
+    def __init__(self, index, engine, lock, top_n=MATCHES_TOP_N, drift_threshold=MATCHES_REFRESH_DRIFT):
+        self.index = index
+        self.engine = engine
+        self.lock = lock  # Lock guarding the index (INDEX_LOCK)
+        self.top_n = top_n
+        self.drift_threshold = drift_threshold
+        self.neighbours = {}  # doc_id -> list of (score, match doc_id), best first
+        self.referenced_by = {}  # match doc_id -> doc_ids whose lists contain it
+        self.changes_since_refresh = 0
+        self.refreshed_size = 0  # Corpus size at the last full refresh
+        self._refreshing = False
+        self._changed_during_refresh = set()
+        self._dirty = set()  # doc_ids whose stored rows are out of date
+        self._unmerged = set()  # doc_ids added since merge_new_documents() that other lists may still lack
+        self._write_lock = threading.Lock()  # Keeps DB writes in the order their rows were taken
+        index.listeners.append(self)
+
+    def load(self):
+        """Reads the stored neighbour lists, keeping only documents that are still indexed."""
+        conn = get_db_connection()
+        try:
+            rows = conn.execute("SELECT doc_key, match_key, score FROM document_matches").fetchall()
+        except sqlite3.Error as e:
+            print(f"Database error in MatchStore.load: {e}")
+            rows = []
+        finally:
+            conn.close()
+
+        with self.lock:
+            lists = {}
+            for row in rows:
+                if row['doc_key'] in self.index and row['match_key'] in self.index:
+                    lists.setdefault(row['doc_key'], []).append((row['score'], row['match_key']))
+            for doc_id, matches in lists.items():
+                matches.sort(reverse=True)
+                self._set_list(doc_id, matches[:self.top_n])
+            self.refreshed_size = len(self.neighbours)
+
+    def drift(self):
+        """Estimated staleness: share of the corpus added, removed or never materialized since the last refresh."""
+        missing = len(self.index) - len(self.neighbours)
+        return (self.changes_since_refresh + max(missing, 0)) / max(len(self.index), 1)
+
+    def lookup(self, doc_id, limit, min_score=0.0):
+        """
+        Returns the stored matches of a document.
+
+        Returns:
+            A list of (doc_id, similarity) tuples, best match first, or None if the
+            document has no materialized list, has no words, or limit exceeds the stored top_n.
+        """
+        matches = self.neighbours.get(doc_id)
+        if matches is None or limit > self.top_n or not self.index.length(doc_id):
+            return None
+        return [(match_id, score) for score, match_id in matches if score > min_score][:limit]
+
+    def _set_list(self, doc_id, matches):
+        for _, match_id in self.neighbours.get(doc_id, ()):
+            self.referenced_by.get(match_id, set()).discard(doc_id)
+        self.neighbours[doc_id] = matches
+        for _, match_id in matches:
+            self.referenced_by.setdefault(match_id, set()).add(doc_id)
+
+    def document_added(self, doc_id, term_ids, counts, total_words, words):
+        """Index listener: gives the new document its own list; merge_new_documents() enters it into the others."""
+        if self._refreshing:
+            self._changed_during_refresh.add(doc_id)
+        self.changes_since_refresh += 1
+        self._dirty.update(self._add_matches(doc_id))
+
+    def _add_matches(self, doc_id):
+        # Only the document's own top N is ranked now (argpartition, no sort of every score)
+        scores = self.engine.query(self.index.tfidf_vector(doc_id), k=self.top_n, exclude=doc_id)
+        self._set_list(doc_id, [(score, match_id) for match_id, score in scores])
+        self._unmerged.add(doc_id)
+        return {doc_id}
+
+    def _entry_threshold(self, matches):
+        # Score a new document must beat to enter a list; lists not materialized yet are left to the next refresh
+        if matches is None:
+            return np.inf
+        return matches[-1][0] if len(matches) >= self.top_n else 0.0
+
+    def merge_new_documents(self):
+        """
+        Enters the documents added since the last call into the other documents' lists they qualify for.
+
+        Cosine similarity is symmetric, so a new document's score column tells which lists it
+        enters. Columns are computed in batches, each one sparse mat-mat under the index lock,
+        and compared with every list's entry threshold as one vector; only the documents
+        above their threshold are looked at one by one.
+        """
+        with self.lock:
+            doc_ids = list(self._unmerged)
+            self._unmerged = set()
+        for start in range(0, len(doc_ids), MATCHES_REFRESH_BATCH):
+            with self.lock:
+                batch = [doc_id for doc_id in doc_ids[start:start + MATCHES_REFRESH_BATCH] if doc_id in self.index]
+                if not batch:
+                    continue
+                scores = self.engine.score_batch([self.index.tfidf_vector(doc_id) for doc_id in batch])
+                row_doc_ids = self.engine.row_doc_ids
+                thresholds = np.array([self._entry_threshold(self.neighbours.get(row_doc_id))
+                                       for row_doc_id in row_doc_ids])
+                for column, doc_id in enumerate(batch):
+                    for row in np.flatnonzero(scores[:, column] > thresholds):
+                        match_id = row_doc_ids[row]
+                        if match_id != doc_id:
+                            self._enter(match_id, doc_id, float(scores[row, column]))
+
+    def _enter(self, match_id, doc_id, score):
+        # Thresholds only rise while a batch is merged, so a candidate is checked against its current list
+        matches = self.neighbours[match_id]
+        if len(matches) < self.top_n or score > matches[-1][0]:
+            matches = [entry for entry in matches if entry[1] != doc_id] + [(score, doc_id)]
+            matches.sort(reverse=True)
+            self._set_list(match_id, matches[:self.top_n])
+            self._dirty.add(match_id)
+
+    def document_removed(self, doc_id):
+        """Index listener: drops the document's list and takes it out of every list it appears in."""
+        if self._refreshing:
+            self._changed_during_refresh.add(doc_id)
+        self.changes_since_refresh += 1
+        self._set_list(doc_id, [])
+        del self.neighbours[doc_id]
+        self._dirty.add(doc_id)
+        self._unmerged.discard(doc_id)
+        for match_id in self.referenced_by.pop(doc_id, set()):
+            matches = self.neighbours.get(match_id)
+            if matches is not None:
+                # The list is one short until the next refresh refills it
+                self.neighbours[match_id] = [entry for entry in matches if entry[1] != doc_id]
+                self._dirty.add(match_id)
+
+    def refresh_if_drifted(self):
+        """Recomputes all lists if the drift passed the threshold; returns True if it did."""
+        if self.drift() < self.drift_threshold:
+            return False
+        self.refresh()
+        return True
+
+    def refresh(self):
+        """
+        Recomputes every neighbour list against the current corpus.
+
+        Scoring runs in batches, each holding the index lock only for its own sparse
+        mat-mat, so scans keep going meanwhile. Documents added or removed during the
+        refresh are replayed against the new lists before they replace the old ones.
+        """
+        with self.lock:
+            doc_ids = self.index.doc_ids()
+            self._refreshing = True
+            self._changed_during_refresh = set()
+            self._unmerged = set()  # The new lists cover every document indexed now
+            changes_at_start = self.changes_since_refresh
+
+        try:
+            lists = {}
+            for start in range(0, len(doc_ids), MATCHES_REFRESH_BATCH):
+                with self.lock:
+                    batch = [doc_id for doc_id in doc_ids[start:start + MATCHES_REFRESH_BATCH] if doc_id in self.index]
+                    vectors = [self.index.tfidf_vector(doc_id) for doc_id in batch]
+                    results = self.engine.query_batch(vectors, k=self.top_n, exclude=batch)
+                for doc_id, matches in zip(batch, results):
+                    lists[doc_id] = [(score, match_id) for match_id, score in matches]
+
+            with self.lock:
+                self.neighbours = {}
+                self.referenced_by = {}
+                for doc_id, matches in lists.items():
+                    if doc_id in self.index:
+                        self._set_list(doc_id, [entry for entry in matches if entry[1] in self.index])
+                for doc_id in self._changed_during_refresh:
+                    if doc_id in self.index:
+                        self._add_matches(doc_id)
+                self.changes_since_refresh -= changes_at_start
+                self.refreshed_size = len(self.neighbours)
+        finally:
+            self._refreshing = False
+        self.flush(everything=True)
+
+    def flush(self, everything=False):
+        """
+        Writes the lists changed since the last flush to the document_matches table in one transaction.
+
+        Args:
+            everything: Rewrite the whole table instead (after a refresh).
+        """
+        with self._write_lock:
+            with self.lock:
+                doc_ids = list(self.neighbours) if everything else list(self._dirty)
+                self._dirty = set()
+                rows = [(doc_id, match_id, score) for doc_id in doc_ids
+                        for score, match_id in self.neighbours.get(doc_id, ())]
+            if not doc_ids and not everything:
+                return
+
+            conn = get_db_connection()
+            try:
+                if everything:
+                    conn.execute("DELETE FROM document_matches")
+                else:
+                    conn.executemany("DELETE FROM document_matches WHERE doc_key = ?", [(doc_id,) for doc_id in doc_ids])
+                conn.executemany("INSERT INTO document_matches (doc_key, match_key, score) VALUES (?, ?, ?)", rows)
+                conn.commit()
+            except sqlite3.Error as e:
+                print(f"Database error in MatchStore.flush: {e}")
+                conn.rollback()
+                if not everything:
+                    with self.lock:
+                        self._dirty.update(doc_ids)  # Retry on the next flush
+            finally:
+                conn.close()
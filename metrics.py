@@ -0,0 +1,163 @@
+"""
+In-process metrics in the Prometheus text exposition format.
+
+Histograms are filled on the hot paths (stage timers of /scan and /matches,
+query timing in the pooled database connections); gauges are read through a
+callback only when /admin/metrics renders them, so they cost nothing between
+scrapes.
+"""
+import bisect
+import threading
+import time
+
+# Upper bounds (seconds) of the latency buckets; +Inf is implied
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    """Cumulative-bucket histogram with a fixed set of label names."""
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}  # label values -> [bucket counts (non-cumulative, +Inf last), sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labelvalues):
+        """Records one observation (e.g. a duration in seconds) for the given label values."""
+        position = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                series = self._series[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][position] += 1
+            series[1] += value
+            series[2] += 1
+
+    def time(self, *labelvalues):
+        """Context manager observing the duration of its block."""
+        return _Timer(self, labelvalues)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = sorted((labels, [list(counts), total, count]) for labels, (counts, total, count) in self._series.items())
+        for labels, (counts, total, count) in series:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, [('le', le)])} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {count}")
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram, labelvalues):
+        self.histogram = histogram
+        self.labelvalues = labelvalues
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labelvalues)
+        return False
+
+
+class Gauge:
+    """Gauge whose value is read from a callback at render time."""
+
+    def __init__(self, name, documentation, function):
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+
+    def render(self):
+        try:
+            value = self.function()
+        except Exception as e:
+            print(f"Error reading gauge {self.name}: {e}")
+            return []
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge",
+                f"{self.name} {_format_value(value)}"]
+
+
+class StageTimer:
+    """
+    Lap timer for the stages of one request.
+
+    lap(stage) records the time since the previous lap (or since the timer was
+    created) under that stage, so instrumenting a handler only takes one call at
+    the end of every stage; finish() records the whole request as stage "total".
+    """
+
+    def __init__(self, histogram, endpoint):
+        self.histogram = histogram
+        self.endpoint = endpoint
+        self.start = self.last = time.perf_counter()
+
+    def lap(self, stage):
+        now = time.perf_counter()
+        self.histogram.observe(now - self.last, self.endpoint, stage)
+        self.last = now
+
+    def skip(self):
+        """Starts the next stage now, without recording the time since the last lap."""
+        self.last = time.perf_counter()
+
+    def finish(self):
+        self.histogram.observe(time.perf_counter() - self.start, self.endpoint, 'total')
+
+
+class MetricsRegistry:
+    """Named collection of metrics rendered together."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge(self, name, documentation, function):
+        return self._register(Gauge(name, documentation, function))
+
+    def render(self):
+        """Returns every metric in the Prometheus text exposition format (version 0.0.4)."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+REQUEST_STAGE_SECONDS = REGISTRY.histogram(
+    'docscan_request_stage_seconds', 'Duration of each stage of the /scan and /matches handlers.', ['endpoint', 'stage'])
+DB_QUERY_SECONDS = REGISTRY.histogram(
+    'docscan_db_query_seconds', 'Duration of database statements, by statement type.', ['statement'])
@@ -0,0 +1,279 @@
+"""
+Versioned schema migrations.
+
+init_db.py creates the baseline tables; every later schema change is a
+numbered migration in MIGRATIONS. The number of the last applied migration is
+kept in the database header (PRAGMA user_version), so upgrading an existing
+database in place only runs the migrations it has not seen yet, each in its
+own transaction.
+
+Usage:
+    python -m migrations upgrade [--database new_database.db]
+    python -m migrations status  [--database new_database.db]
+    python -m migrations check   [--database new_database.db]
+
+`check` runs EXPLAIN QUERY PLAN on the hot queries listed by hot_queries() and
+fails if any of them has to scan a whole table; tests/test_migrations.py runs
+the same check on a freshly migrated database.
+"""
+import argparse
+import sqlite3
+import sys
+
+DATABASE = 'new_database.db'
+
+
+class MigrationError(Exception):
+    """Raised when a migration cannot be applied to the data in the database."""
+
+
+def _unique_usernames(cursor):
+    # Registration relies on an IntegrityError for taken usernames, which needs a UNIQUE constraint
+    duplicates = cursor.execute(
+        "SELECT username, COUNT(*) FROM users GROUP BY username HAVING COUNT(*) > 1").fetchall()
+    if duplicates:
+        names = ', '.join(f"{row[0]} ({row[1]} accounts)" for row in duplicates)
+        raise MigrationError(f"Cannot make usernames unique, duplicates must be merged or renamed first: {names}")
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_users_username ON users (username)")
+
+
+def _lookup_indexes(cursor):
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_documents_filename ON documents (filename)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_documents_filepath ON documents (filepath)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_documents_user_scan_date ON documents (user_id, scan_date)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_credit_requests_status_date ON credit_requests (status, request_date)")
+
+
+def _stamp_credit_resets(cursor):
+    # Credits are now reset lazily when last_reset is before today; users never reset by the
+    # old nightly job keep their balance until the next midnight, as they would have before
+    cursor.execute("UPDATE users SET last_reset = CURRENT_TIMESTAMP WHERE last_reset IS NULL")
+
+
+def _document_content_hash(cursor):
+    # Content-addressed storage: identical uploads share one stored file, named after this SHA-256
+    columns = [row[1] for row in cursor.execute("PRAGMA table_info(documents)")]
+    if 'content_hash' not in columns:
+        cursor.execute("ALTER TABLE documents ADD COLUMN content_hash TEXT")
+
+
+def _scan_jobs(cursor):
+    # Queue of asynchronous /scan requests
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS scan_jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        document_id INTEGER,
+        filename TEXT NOT NULL,
+        filepath TEXT NOT NULL,
+        content_hash TEXT,
+        already_stored INTEGER DEFAULT 0,
+        scan_mode TEXT DEFAULT 'similarity',
+        status TEXT DEFAULT 'queued',
+        result TEXT,
+        error TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        started_at TIMESTAMP,
+        finished_at TIMESTAMP
+    );
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_scan_jobs_status ON scan_jobs (status, id)")
+
+
+def _scan_job_leases(cursor):
+    # Workers of several processes share the queue; a job is only taken over once its worker's lease expired
+    columns = [row[1] for row in cursor.execute("PRAGMA table_info(scan_jobs)")]
+    if 'claimed_by' not in columns:
+        cursor.execute("ALTER TABLE scan_jobs ADD COLUMN claimed_by TEXT")
+    if 'lease_expires_at' not in columns:
+        cursor.execute("ALTER TABLE scan_jobs ADD COLUMN lease_expires_at TIMESTAMP")
+
+
+def _document_matches(cursor):
+    # Materialized top-N neighbours, keyed by index document keys
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS document_matches (
+        doc_key TEXT NOT NULL,
+        match_key TEXT NOT NULL,
+        score REAL NOT NULL,
+        PRIMARY KEY (doc_key, match_key)
+    );
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_document_matches_score ON document_matches (doc_key, score DESC)")
+
+
+def _analytics_rollups(cursor):
+    # Kept current by the writes; a database with history fills them once with `python -m analytics backfill`
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS daily_user_scans (
+        user_id INTEGER NOT NULL,
+        scan_day TEXT,
+        scan_count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, scan_day)
+    );
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS topic_scan_counts (
+        topic TEXT PRIMARY KEY,
+        scan_count INTEGER NOT NULL DEFAULT 0
+    );
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS user_activity_totals (
+        user_id INTEGER PRIMARY KEY,
+        total_scans INTEGER NOT NULL DEFAULT 0,
+        approved_credits INTEGER
+    );
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS credit_request_totals (
+        status TEXT PRIMARY KEY,
+        request_count INTEGER NOT NULL DEFAULT 0,
+        requested_credits INTEGER NOT NULL DEFAULT 0
+    );
+    ''')
+
+
+def _scan_day_index(cursor):
+    # The dashboard only reads the most recent days of daily_user_scans
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_daily_user_scans_day ON daily_user_scans (scan_day)")
+
+
+def _rollup_rank_indexes(cursor):
+    # The dashboard lists the busiest topics and users; with these it reads only the first rows
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_topic_scan_counts_rank ON topic_scan_counts (scan_count DESC, topic)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_activity_totals_rank "
+                   "ON user_activity_totals (total_scans DESC, approved_credits DESC)")
+
+
+# (version, description, function applying it to a cursor); versions must increase by one.
+# Every migration is idempotent, so a database whose tables predate its version number upgrades cleanly
+MIGRATIONS = [
+    (1, 'unique usernames', _unique_usernames),
+    (2, 'indexes for document, user and credit request lookups', _lookup_indexes),
+    (3, 'start the lazy daily credit reset for users never reset', _stamp_credit_resets),
+    (4, 'content hash of documents', _document_content_hash),
+    (5, 'scan job queue', _scan_jobs),
+    (6, 'scan job worker leases', _scan_job_leases),
+    (7, 'materialized document matches', _document_matches),
+    (8, 'analytics rollup tables', _analytics_rollups),
+    (9, 'index for recent daily scan counts', _scan_day_index),
+    (10, 'rank indexes for the dashboard top topics and users', _rollup_rank_indexes),
+]
+
+def hot_queries():
+    """
+    The queries run on every request (or every scan) that must not scan a whole table.
+
+    The SQL is imported from the modules that run it, so the check plans exactly those statements.
+
+    Returns:
+        A list of (name, SQL, sample parameters) tuples.
+    """
+    # Imported here: the models pull in the app's connection pool, which migrating does not need
+    import analytics
+    import models
+    return [
+        ("User.get_user_by_username", models.USER_BY_USERNAME, ('alice',)),
+        ("User.get_user_by_id", models.USER_BY_ID, (1,)),
+        ("User.reserve_credits", models.RESERVE_CREDITS, {'amount': 1, 'user_id': 1, 'allowance': 20}),
+        ("User.add_credits", models.ADD_CREDITS, {'amount': 1, 'user_id': 1, 'allowance': 20}),
+        ("Document.get_by_filename", models.DOCUMENT_BY_FILENAME, ('a.txt',)),
+        ("Document.get_by_filepath", models.DOCUMENT_BY_FILEPATH, ('uploads/a.txt',)),
+        ("Document.get_copies", models.DOCUMENTS_BY_FILEPATH, ('uploads/a.txt', 6)),
+        ("Document.get_by_ids", models.DOCUMENTS_BY_IDS.format(placeholders='?, ?'), (1, 2)),
+        ("DocumentKeyMap.key_for", models.DOCUMENT_KEY_BY_ID, (1,)),
+        ("pending credit requests", models.PENDING_CREDIT_REQUESTS, ()),
+        ("credit request by id", models.CREDIT_REQUEST_BY_ID, (1,)),
+        ("ScanJob.claim_next", models.NEXT_QUEUED_JOB, ()),
+        ("ScanJob.renew_lease", models.RENEW_JOB_LEASE, ('+120 seconds', 1, 'worker')),
+        ("ScanJob.finish", models.FINISH_JOB, ('done', '{}', None, 1, 'worker')),
+        ("ScanJob.requeue_expired", models.REQUEUE_EXPIRED_JOBS, ()),
+        ("dashboard scans per user", analytics.DASHBOARD_SCANS_PER_USER, ('-29 days',)),
+        ("dashboard top topics", analytics.DASHBOARD_TOP_TOPICS, (10,)),
+        ("dashboard top users", analytics.DASHBOARD_TOP_USERS, (10,)),
+    ]
+
+
+def current_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn, target=None):
+    """
+    Applies every migration newer than the database's version, in order.
+
+    Args:
+        conn: Open connection to the database (tables from init_db.py must exist).
+        target: Optional version to stop at (default: the latest).
+
+    Returns:
+        The list of versions that were applied.
+    """
+    applied = []
+    for version, description, apply in MIGRATIONS:
+        if version <= current_version(conn) or (target is not None and version > target):
+            continue
+        cursor = conn.cursor()
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            apply(cursor)
+            cursor.execute(f"PRAGMA user_version = {version}")  # Part of the same transaction
+            conn.commit()
+        except (sqlite3.Error, MigrationError):
+            conn.rollback()
+            raise
+        print(f"Applied migration {version}: {description}")
+        applied.append(version)
+    return applied
+
+
+def full_scans(conn):
+    """
+    Runs EXPLAIN QUERY PLAN on every hot query.
+
+    Returns:
+        A list of (name, plan lines) tuples for the queries that scan a whole table.
+    """
+    failures = []
+    for name, query, params in hot_queries():
+        plan = [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {query}", params)]
+        # "SCAN <table>" without an index reads every row; "SEARCH ..." and index scans are fine
+        if any(step.startswith('SCAN') and 'INDEX' not in step for step in plan):
+            failures.append((name, plan))
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m migrations', description='Database schema migrations.')
+    parser.add_argument('command', choices=['upgrade', 'status', 'check'])
+    parser.add_argument('--database', default=DATABASE, help='SQLite database file')
+    args = parser.parse_args(argv)
+
+    conn = sqlite3.connect(args.database)
+    try:
+        if args.command == 'upgrade':
+            try:
+                applied = migrate(conn)
+            except MigrationError as e:
+                print(f"Migration failed: {e}", file=sys.stderr)
+                return 1
+            print(f"Database is at version {current_version(conn)} ({len(applied)} migrations applied)")
+        elif args.command == 'status':
+            version = current_version(conn)
+            for number, description, _ in MIGRATIONS:
+                print(f"{'applied' if number <= version else 'pending'}  {number}: {description}")
+        else:
+            failures = full_scans(conn)
+            for name, plan in failures:
+                print(f"Full table scan in {name}: {' / '.join(plan)}", file=sys.stderr)
+            total = len(hot_queries())
+            print(f"{total - len(failures)}/{total} hot queries use an index")
+            return 1 if failures else 0
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,25 +1,88 @@
 from db import get_db_connection  # Import database connection function
+from analytics import record_scans  # Analytics rollups are updated in the same transaction as the documents
 from werkzeug.security import generate_password_hash, check_password_hash  # For password hashing
 import sqlite3
 import datetime
+import json
+import os
+import threading
+import time
+
+DAILY_CREDITS = int(os.environ.get('DAILY_CREDITS', 20))  # Credits every user is refilled to each day (UTC)
+
+# Credits are refilled lazily: the first statement touching a user's credits after
+# midnight UTC sees the reset as due and applies it, so no job rewrites the whole table
+CREDIT_RESET_DUE = "(last_reset IS NULL OR last_reset < DATE('now'))"  # last_reset is a UTC CURRENT_TIMESTAMP
+CURRENT_CREDITS = f"(CASE WHEN {CREDIT_RESET_DUE} THEN :allowance ELSE credits END)"
+CURRENT_LAST_RESET = f"(CASE WHEN {CREDIT_RESET_DUE} THEN CURRENT_TIMESTAMP ELSE last_reset END)"
+USER_COLUMNS = "id, username, password_hash, role, credits, last_reset"
+
+# SQL of the hot paths, kept here so `python -m migrations check` and its test plan the statements actually run
+USER_BY_USERNAME = f"SELECT {USER_COLUMNS} FROM users WHERE username = ?"
+USER_BY_ID = f"SELECT {USER_COLUMNS} FROM users WHERE id = ?"
+RESERVE_CREDITS = (f"UPDATE users SET credits = {CURRENT_CREDITS} - :amount, last_reset = {CURRENT_LAST_RESET} "
+                   f"WHERE id = :user_id AND {CURRENT_CREDITS} >= :amount RETURNING credits")
+ADD_CREDITS = (f"UPDATE users SET credits = {CURRENT_CREDITS} + :amount, last_reset = {CURRENT_LAST_RESET} "
+               f"WHERE id = :user_id RETURNING credits")
+DOCUMENT_BY_FILENAME = "SELECT * FROM documents WHERE filename = ?"
+DOCUMENT_BY_FILEPATH = "SELECT * FROM documents WHERE filepath = ? ORDER BY id LIMIT 1"
+DOCUMENTS_BY_FILEPATH = "SELECT * FROM documents WHERE filepath = ? ORDER BY id LIMIT ?"
+DOCUMENTS_BY_IDS = "SELECT * FROM documents WHERE id IN ({placeholders})"
+DOCUMENT_KEY_BY_ID = "SELECT id, filepath FROM documents WHERE id = ?"
+PENDING_CREDIT_REQUESTS = """
+    SELECT cr.id, u.username, cr.requested_credits, cr.request_date
+    FROM credit_requests cr
+    JOIN users u ON cr.user_id = u.id
+    WHERE cr.status = 'pending'
+    ORDER BY cr.request_date DESC
+"""
+CREDIT_REQUEST_BY_ID = "SELECT user_id, requested_credits, status FROM credit_requests WHERE id = ?"
+NEXT_QUEUED_JOB = "SELECT * FROM scan_jobs WHERE status = 'queued' ORDER BY id LIMIT 1"
+RENEW_JOB_LEASE = ("UPDATE scan_jobs SET lease_expires_at = datetime('now', ?) "
+                   "WHERE id = ? AND status = 'running' AND claimed_by = ?")
+FINISH_JOB = ("UPDATE scan_jobs SET status = ?, result = ?, error = ?, finished_at = CURRENT_TIMESTAMP, "
+              "lease_expires_at = NULL WHERE id = ? AND status = 'running' AND claimed_by = ?")
+REQUEUE_EXPIRED_JOBS = ("UPDATE scan_jobs SET status = 'queued', started_at = NULL, claimed_by = NULL, "
+                        "lease_expires_at = NULL "
+                        "WHERE status = 'running' AND (lease_expires_at IS NULL OR lease_expires_at < datetime('now'))")
+
+USER_CACHE_TTL = float(os.environ.get('USER_CACHE_TTL', 5))  # Seconds a cached user row is trusted
+USER_CACHE_MAX_ENTRIES = 10000  # Users kept in the cache before the oldest are dropped
 
 class User:
-    def __init__(self, id, username, password_hash, role, total_credits, last_reset):
+    # Cached users live for the whole process, so keep them small
+    __slots__ = ('id', 'username', 'password_hash', 'role', 'credits', 'last_reset')
+
+    def __init__(self, id, username, password_hash, role, credits, last_reset):
         self.id = id
         self.username = username
         self.password_hash = password_hash
         self.role = role
-        self.total_credits = total_credits
+        self.credits = credits  # Stored balance, before a daily reset that may be due
         self.last_reset = last_reset
 
+    @staticmethod
+    def from_row(row):
+        return User(id=row['id'], username=row['username'], password_hash=row['password_hash'],
+                    role=row['role'], credits=row['credits'], last_reset=row['last_reset'])
+
+    @property
+    def total_credits(self):
+        """Current balance: DAILY_CREDITS if today's reset is still due (same test as CREDIT_RESET_DUE)."""
+        today = datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%d')
+        if self.last_reset is None or self.last_reset < today:
+            return DAILY_CREDITS
+        return self.credits
+
     @staticmethod
     def create_user(username, password, role='user'):
         conn = get_db_connection()
         cursor = conn.cursor()
         password_hash = generate_password_hash(password)  # Hash the password
         try:
-            cursor.execute("INSERT INTO users (username, password_hash, role) VALUES (?, ?, ?)",
-                           (username, password_hash, role))
+            cursor.execute("INSERT INTO users (username, password_hash, role, credits, last_reset) "
+                           "VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)",
+                           (username, password_hash, role, DAILY_CREDITS))
             conn.commit()
             user_id = cursor.lastrowid  # Get the ID of the newly inserted user
             conn.close()
@@ -28,51 +91,82 @@ class User:
             conn.close()
             return None  # Indicate registration failure due to username conflict
     @staticmethod
-    def decrement_credits(user_id):
-        """Atomic credit decrement with transaction"""
+    def reserve_credits(user_id, amount=1):
+        """
+        Checks and deducts credits in a single statement (one credit per scan, several for a batch).
+
+        The balance check is part of the UPDATE, so concurrent scans can never take
+        the balance below zero, and nothing has to be read first. A daily reset that
+        is due is applied by the same statement.
+
+        Args:
+            user_id (int): User to charge.
+            amount (int): Number of credits to reserve.
+
+        Returns:
+            int: The remaining balance, or None if the user does not exist or has fewer than `amount` credits.
+        """
         conn = get_db_connection()
         try:
-            conn.execute("BEGIN TRANSACTION")
-            # Add check for credits > 0
-            conn.execute(
-                "UPDATE users SET credits = credits - 1 WHERE id = ? AND credits > 0",
-                (user_id,)
-            )
+            rows = conn.execute(
+                RESERVE_CREDITS, {'amount': amount, 'user_id': user_id, 'allowance': DAILY_CREDITS}
+            ).fetchall()  # Step the statement to completion before committing
             conn.commit()
-            return True
+            USER_CACHE.invalidate(user_id)
+            return rows[0]['credits'] if rows else None
         except sqlite3.Error as e:
             conn.rollback()
-            print(f"Database error in decrement_credits: {e}")
-            return False
+            print(f"Database error in reserve_credits: {e}")
+            return None
         finally:
             conn.close()
 
-    # Add this new method
     @staticmethod
-    def reset_all_credits():
-        """Reset credits for all users to 20"""
+    def refund_credits(user_id, amount=1):
+        """
+        Gives back credits reserved for a scan that failed.
+
+        Returns:
+            int: The new balance, or None if the refund could not be recorded.
+        """
         conn = get_db_connection()
         try:
-            conn.execute(
-                "UPDATE users SET credits = 20, last_reset = CURRENT_TIMESTAMP"
-            )
+            balance = User.add_credits(conn.cursor(), user_id, amount)
             conn.commit()
-            return True
+            USER_CACHE.invalidate(user_id)
+            return balance
         except sqlite3.Error as e:
-            print(f"Credit reset failed: {e}")
-            return False
+            conn.rollback()
+            print(f"Database error in refund_credits: {e}")
+            return None
         finally:
             conn.close()
+
+    @staticmethod
+    def add_credits(cursor, user_id, amount):
+        """
+        Adds credits to a user (refunds, approved credit requests) inside the caller's transaction.
+
+        A daily reset that is due is applied first, as the nightly reset would have done.
+        The caller invalidates USER_CACHE for the user once its transaction is committed.
+
+        Returns:
+            int: The new balance, or None if the user does not exist.
+        """
+        rows = cursor.execute(
+            ADD_CREDITS, {'amount': amount, 'user_id': user_id, 'allowance': DAILY_CREDITS}
+        ).fetchall()
+        return rows[0]['credits'] if rows else None
+
     @staticmethod
     def get_user_by_username(username):
         conn = get_db_connection()
         cursor = conn.cursor()
-        cursor.execute("SELECT * FROM users WHERE username = ?", (username,))
+        cursor.execute(USER_BY_USERNAME, (username,))
         row = cursor.fetchone()
         conn.close()
         if row:
-            return User(id=row['id'], username=row['username'], password_hash=row['password_hash'],
-                        role=row['role'], total_credits=row['credits'], last_reset=row['last_reset'])
+            return User.from_row(row)
         return None
 
     def check_password(self, password):
@@ -83,37 +177,107 @@ class User:
 
     @staticmethod
     def get_user_by_id(user_id):  # New method to fetch user by ID
+        # Authenticated hot paths read the same user over and over; serve them from USER_CACHE
+        user = USER_CACHE.get(user_id)
+        if user is not None:
+            return user
+        version = USER_CACHE.version
         conn = get_db_connection()
         cursor = conn.cursor()
-        cursor.execute("SELECT * FROM users WHERE id = ?", (user_id,))
+        cursor.execute(USER_BY_ID, (user_id,))
         row = cursor.fetchone()
         conn.close()
         if row:
-            return User(id=row['id'], username=row['username'], password_hash=row['password_hash'],
-                        role=row['role'], total_credits=row['credits'], last_reset=row['last_reset'])
+            user = User.from_row(row)
+            USER_CACHE.put(user, version)
+            return user
         return None
-    
-    @staticmethod
-    def decrement_credits(user_id):
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        try:
-            cursor.execute("UPDATE users SET credits = credits - 1 WHERE id = ?", (user_id,))
-            conn.commit()
-        except sqlite3.Error as e:
-            print(f"Database error in decrement_credits: {e}") # Log the error for debugging
-            conn.rollback() # Rollback in case of error
-            return False # Indicate failure
-        finally:
-            conn.close()
-        return True # Indicate success if no exception
+
+
+class UserCache:
+    """
+    Read-through cache of User objects by id, local to this process.
+
+    Entries are trusted for ttl seconds. Writes in this process that change a user
+    (credit reservations, refunds, approved credit requests) call invalidate() once
+    they are committed; the ttl bounds how long a change made by another process can
+    go unseen. The daily credit reset needs no invalidation, because
+    User.total_credits applies it when it is read.
+    """
+
+    def __init__(self, ttl=USER_CACHE_TTL, max_entries=USER_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.users = {}  # user id -> (User, expires_at), oldest first
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.version = 0  # Bumped by every invalidation
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        """Returns the cached User, or None if it is not cached or has expired."""
+        with self._lock:
+            entry = self.users.get(user_id)
+            if entry is None or entry[1] < time.monotonic():
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[0]
+
+    def put(self, user, version=None):
+        """
+        Caches a user read from the database.
+
+        Args:
+            user: The User.
+            version: Value of self.version taken before the read; if an invalidation
+                happened since, the row may predate that change and is not cached.
+        """
+        with self._lock:
+            if version is not None and version != self.version:
+                return
+            self.users.pop(user.id, None)  # Re-inserted at the end, as the newest entry
+            self.users[user.id] = (user, time.monotonic() + self.ttl)
+            if len(self.users) > self.max_entries:
+                now = time.monotonic()
+                self.users = {user_id: entry for user_id, entry in self.users.items() if entry[1] >= now}
+                while len(self.users) > self.max_entries:
+                    del self.users[next(iter(self.users))]
+
+    def invalidate(self, user_id):
+        """Drops a user after a committed change, so the next read goes to the database."""
+        with self._lock:
+            self.version += 1
+            if self.users.pop(user_id, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self.users = {}
+
+    def stats(self):
+        """Returns the hit/miss/invalidation counters of the cache."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.users),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'invalidations': self.invalidations,
+                'ttl': self.ttl,
+            }
+
+
+USER_CACHE = UserCache()
 
 ##Document class
 class Document:
   
     # Represents a scanned document and its metadata, stored in the 'documents' table.
     
-    def __init__(self, filename, filepath, user_id, scan_date=None, id=None):
+    def __init__(self, filename, filepath, user_id, scan_date=None, id=None, content_hash=None):
         """
         Initializes a Document object.
 
@@ -123,12 +287,14 @@ class Document:
             user_id (int): ID of the user who uploaded the document (foreign key to users table).
             scan_date (datetime, optional): Date and time of scan. Defaults to current time if None.
             id (int, optional): Document ID (for database, auto-generated upon saving). Defaults to None.
+            content_hash (str, optional): SHA-256 of the document body (content-addressed storage key).
         """
         self.id = id  # Document ID (integer, primary key, auto-generated by DB)
         self.filename = filename  # Filename (string, not null)
         self.filepath = filepath  # Filepath on server (string, not null)
         self.user_id = user_id  # User ID of uploader (integer, foreign key to users table, not null)
         self.scan_date = scan_date or datetime.datetime.now()  # Scan datetime (datetime, defaults to now)
+        self.content_hash = content_hash  # SHA-256 of the content (string, None for legacy uploads)
 
     def save(self):
         """
@@ -143,11 +309,13 @@ class Document:
         cursor = conn.cursor()
         try:
             cursor.execute(
-                "INSERT INTO documents (filename, filepath, user_id, scan_date) VALUES (?, ?, ?, ?)",
-                (self.filename, self.filepath, self.user_id, self.scan_date)
+                "INSERT INTO documents (filename, filepath, user_id, scan_date, content_hash) VALUES (?, ?, ?, ?, ?)",
+                (self.filename, self.filepath, self.user_id, self.scan_date, self.content_hash)
             )
+            record_scans(cursor, [self])
             conn.commit()
             self.id = cursor.lastrowid  # Retrieve the auto-generated ID after INSERT
+            DOCUMENT_KEYS.record(self)  # Keep the content key -> document id map current
             return True # Indicate successful save
         except sqlite3.Error as e:
             print(f"Database error in Document.save: {e}") # Log database error
@@ -156,6 +324,44 @@ class Document:
         finally:
             conn.close() # Ensure connection is closed
 
+    @staticmethod
+    def save_many(documents):
+        """
+        Saves several new Document objects with a single executemany in one transaction.
+        Updates the id of every document after successful insertion.
+
+        Args:
+            documents (list): Document objects that have not been saved yet.
+
+        Returns:
+            bool: True if all documents were saved, False otherwise (nothing is saved then).
+        """
+        if not documents:
+            return True
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.executemany(
+                "INSERT INTO documents (filename, filepath, user_id, scan_date, content_hash) VALUES (?, ?, ?, ?, ?)",
+                [(document.filename, document.filepath, document.user_id, document.scan_date, document.content_hash)
+                 for document in documents]
+            )
+            # Rows inserted inside one write transaction get consecutive ids, ending at the last inserted one
+            last_id = cursor.execute("SELECT last_insert_rowid()").fetchone()[0]
+            record_scans(cursor, documents)
+            conn.commit()
+            first_id = last_id - len(documents) + 1
+            for offset, document in enumerate(documents):
+                document.id = first_id + offset
+                DOCUMENT_KEYS.record(document)
+            return True
+        except sqlite3.Error as e:
+            print(f"Database error in Document.save_many: {e}") # Log database error
+            conn.rollback() # Rollback transaction on error
+            return False
+        finally:
+            conn.close() # Ensure connection is closed
+
     @staticmethod
     def get_document_by_id(document_id):
         """
@@ -179,7 +385,8 @@ class Document:
                     filename=row['filename'],
                     filepath=row['filepath'],
                     user_id=row['user_id'],
-                    scan_date=row['scan_date']
+                    scan_date=row['scan_date'],
+                    content_hash=row['content_hash']
                 )
         except sqlite3.Error as e:
             print(f"Database error in Document.get_document_by_id: {e}") # Log database error
@@ -207,7 +414,8 @@ class Document:
                     filename=row['filename'],
                     filepath=row['filepath'],
                     user_id=row['user_id'],
-                    scan_date=row['scan_date']
+                    scan_date=row['scan_date'],
+                    content_hash=row['content_hash']
                 ))
         except sqlite3.Error as e:
             print(f"Database error in get_all_documents: {e}")
@@ -223,7 +431,7 @@ class Document:
         document = None
         try:
             cursor = conn.cursor()
-            cursor.execute("SELECT * FROM documents WHERE filename = ?", (filename,))
+            cursor.execute(DOCUMENT_BY_FILENAME, (filename,))
             row = cursor.fetchone()
             if row:
                 document = Document(
@@ -231,10 +439,358 @@ class Document:
                     filename=row['filename'],
                     filepath=row['filepath'],
                     user_id=row['user_id'],
-                    scan_date=row['scan_date']
+                    scan_date=row['scan_date'],
+                    content_hash=row['content_hash']
                 )
         except sqlite3.Error as e:
             print(f"Database error in get_by_filename: {e}")
         finally:
             conn.close()
-        return document
\ No newline at end of file
+        return document
+
+    @classmethod
+    def get_by_ids(cls, document_ids):
+        """
+        Gets many documents in one query (WHERE id IN (...)).
+
+        Args:
+            document_ids (iterable): IDs of the documents to fetch.
+
+        Returns:
+            dict: Document objects keyed by ID; IDs without a row are left out.
+        """
+        document_ids = list(set(document_ids))
+        documents = {}
+        if not document_ids:
+            return documents
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
+            placeholders = ', '.join('?' * len(document_ids))
+            cursor.execute(DOCUMENTS_BY_IDS.format(placeholders=placeholders), document_ids)
+            for row in cursor.fetchall():
+                documents[row['id']] = Document(
+                    id=row['id'],
+                    filename=row['filename'],
+                    filepath=row['filepath'],
+                    user_id=row['user_id'],
+                    scan_date=row['scan_date'],
+                    content_hash=row['content_hash']
+                )
+        except sqlite3.Error as e:
+            print(f"Database error in get_by_ids: {e}")
+        finally:
+            conn.close()
+        return documents
+
+    @classmethod
+    def get_by_filepath(cls, filepath):
+        """Get the first document stored at a filepath (identical uploads share one stored file)"""
+        conn = get_db_connection()
+        document = None
+        try:
+            cursor = conn.cursor()
+            cursor.execute(DOCUMENT_BY_FILEPATH, (filepath,))
+            row = cursor.fetchone()
+            if row:
+                document = Document(
+                    id=row['id'],
+                    filename=row['filename'],
+                    filepath=row['filepath'],
+                    user_id=row['user_id'],
+                    scan_date=row['scan_date'],
+                    content_hash=row['content_hash']
+                )
+        except sqlite3.Error as e:
+            print(f"Database error in get_by_filepath: {e}")
+        finally:
+            conn.close()
+        return document
+
+    @classmethod
+    def get_copies(cls, filepaths, limit):
+        """
+        Gets the documents stored at each filepath, i.e. every upload of the same content.
+
+        Args:
+            filepaths (iterable): Stored filepaths (named after the content hash).
+            limit (int): Documents returned per filepath, oldest first.
+
+        Returns:
+            dict: Lists of Document objects keyed by filepath; filepaths without a row are left out.
+        """
+        copies = {}
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
+            for filepath in set(filepaths):
+                # One indexed lookup per stored file, so a batch does not read every copy of popular content
+                cursor.execute(DOCUMENTS_BY_FILEPATH, (filepath, limit))
+                for row in cursor.fetchall():
+                    copies.setdefault(filepath, []).append(Document(
+                        id=row['id'],
+                        filename=row['filename'],
+                        filepath=row['filepath'],
+                        user_id=row['user_id'],
+                        scan_date=row['scan_date'],
+                        content_hash=row['content_hash']
+                    ))
+        except sqlite3.Error as e:
+            print(f"Database error in get_copies: {e}")
+        finally:
+            conn.close()
+        return copies
+
+
+##DocumentKeyMap class
+class DocumentKeyMap:
+
+    # In-memory map between documents rows and the content keys (stored file names) the
+    # document indexes use, so similarity results can be mapped to documents without a query per match.
+
+    def __init__(self):
+        self.keys_by_id = {}  # document id -> content key of its stored file
+        self.first_ids = {}  # content key -> id of the first document stored under it
+        self.loaded = False
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def content_key(filepath):
+        """The key of a stored file in the document indexes (its file name)."""
+        return os.path.basename(filepath)
+
+    def _add(self, document_id, filepath):
+        key = self.content_key(filepath)
+        self.keys_by_id[document_id] = key
+        first_id = self.first_ids.get(key)
+        if first_id is None or document_id < first_id:
+            self.first_ids[key] = document_id
+
+    def load(self):
+        """Reads the id and filepath of every document once; later saves are added through record()."""
+        with self._lock:
+            if self.loaded:
+                return
+            conn = get_db_connection()
+            try:
+                for row in conn.execute("SELECT id, filepath FROM documents"):
+                    self._add(row['id'], row['filepath'])
+                self.loaded = True
+            except sqlite3.Error as e:
+                print(f"Database error in DocumentKeyMap.load: {e}")
+            finally:
+                conn.close()
+
+    def record(self, document):
+        """Adds a newly saved document (only needed once the map is loaded; load() would read it anyway)."""
+        with self._lock:
+            if self.loaded:
+                self._add(document.id, document.filepath)
+
+    def key_for(self, document_id):
+        """
+        Returns the content key of a document, or None if there is no such document.
+
+        Documents saved by another app process after load() are not in the map yet, so a
+        miss is looked up once by primary key and the row is added to the map.
+        """
+        self.load()
+        key = self.keys_by_id.get(document_id)
+        if key is not None:
+            return key
+        conn = get_db_connection()
+        try:
+            row = conn.execute(DOCUMENT_KEY_BY_ID, (document_id,)).fetchone()
+        except sqlite3.Error as e:
+            print(f"Database error in DocumentKeyMap.key_for: {e}")
+            return None
+        finally:
+            conn.close()
+        if row is None:
+            return None
+        with self._lock:
+            self._add(row['id'], row['filepath'])
+        return self.content_key(row['filepath'])
+
+    def document_id_for(self, key):
+        """Returns the id of the first document stored under a content key, or None (e.g. files placed by hand)."""
+        self.load()
+        return self.first_ids.get(key)
+
+
+DOCUMENT_KEYS = DocumentKeyMap()
+
+
+##ScanJob class
+class ScanJob:
+
+    # An asynchronous /scan request, queued in the 'scan_jobs' table until a worker has run it.
+
+    def __init__(self, id, user_id, document_id, filename, filepath, content_hash, already_stored,
+                 scan_mode, status, result=None, error=None, created_at=None, started_at=None, finished_at=None,
+                 claimed_by=None, lease_expires_at=None):
+        self.id = id
+        self.user_id = user_id
+        self.document_id = document_id  # documents row created when the job was queued
+        self.filename = filename
+        self.filepath = filepath
+        self.content_hash = content_hash
+        self.already_stored = bool(already_stored)  # The content was stored before this upload
+        self.scan_mode = scan_mode
+        self.status = status  # 'queued', 'running', 'done' or 'failed'
+        self.result = json.loads(result) if result else None  # scan_results of a finished job
+        self.error = error
+        self.created_at = created_at
+        self.started_at = started_at
+        self.finished_at = finished_at
+        self.claimed_by = claimed_by  # Worker running the job
+        self.lease_expires_at = lease_expires_at  # Other workers may take the job over after this time
+
+    @staticmethod
+    def from_row(row):
+        return ScanJob(id=row['id'], user_id=row['user_id'], document_id=row['document_id'],
+                       filename=row['filename'], filepath=row['filepath'], content_hash=row['content_hash'],
+                       already_stored=row['already_stored'], scan_mode=row['scan_mode'], status=row['status'],
+                       result=row['result'], error=row['error'], created_at=row['created_at'],
+                       started_at=row['started_at'], finished_at=row['finished_at'],
+                       claimed_by=row['claimed_by'], lease_expires_at=row['lease_expires_at'])
+
+    @staticmethod
+    def enqueue(user_id, document_id, filename, filepath, content_hash, already_stored, scan_mode):
+        """
+        Queues a scan of an already stored upload.
+
+        Returns:
+            int or None: The ID of the new job, None on a database error.
+        """
+        conn = get_db_connection()
+        try:
+            cursor = conn.execute(
+                "INSERT INTO scan_jobs (user_id, document_id, filename, filepath, content_hash, already_stored, scan_mode) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (user_id, document_id, filename, filepath, content_hash, int(already_stored), scan_mode)
+            )
+            conn.commit()
+            return cursor.lastrowid
+        except sqlite3.Error as e:
+            print(f"Database error in ScanJob.enqueue: {e}")
+            conn.rollback()
+            return None
+        finally:
+            conn.close()
+
+    @staticmethod
+    def claim_next(worker_id, lease_seconds):
+        """
+        Takes the oldest queued job and marks it as running, leased to one worker.
+
+        The select and the update run in one write transaction, so two workers
+        (threads or processes) can never claim the same job. The worker keeps the
+        job by renewing the lease (renew_lease) while it runs; once the lease has
+        expired, requeue_expired gives the job to the next worker.
+
+        Args:
+            worker_id (str): Identifier of the claiming worker, unique across processes.
+            lease_seconds (float): Seconds until the lease expires unless it is renewed.
+
+        Returns:
+            ScanJob or None: The claimed job, None if the queue is empty.
+        """
+        conn = get_db_connection()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(NEXT_QUEUED_JOB).fetchone()
+            if row is None:
+                conn.rollback()
+                return None
+            conn.execute(
+                "UPDATE scan_jobs SET status = 'running', started_at = CURRENT_TIMESTAMP, claimed_by = ?, "
+                "lease_expires_at = datetime('now', ?) WHERE id = ?",
+                (worker_id, f"+{lease_seconds} seconds", row['id'])
+            )
+            job = ScanJob.from_row(conn.execute("SELECT * FROM scan_jobs WHERE id = ?", (row['id'],)).fetchone())
+            conn.commit()
+            return job
+        except sqlite3.Error as e:
+            print(f"Database error in ScanJob.claim_next: {e}")
+            conn.rollback()
+            return None
+        finally:
+            conn.close()
+
+    @staticmethod
+    def renew_lease(job_id, worker_id, lease_seconds):
+        """
+        Extends the lease of a running job.
+
+        Returns:
+            bool: False if the worker no longer holds the job (its lease expired and it was requeued).
+        """
+        conn = get_db_connection()
+        try:
+            cursor = conn.execute(RENEW_JOB_LEASE, (f"+{lease_seconds} seconds", job_id, worker_id))
+            conn.commit()
+            return cursor.rowcount > 0
+        except sqlite3.Error as e:
+            print(f"Database error in ScanJob.renew_lease: {e}")
+            conn.rollback()
+            return True  # Not known to be lost; the next renewal tries again
+        finally:
+            conn.close()
+
+    @staticmethod
+    def finish(job_id, worker_id, result=None, error=None):
+        """
+        Stores the outcome of a job: its scan_results on success, or an error message.
+
+        Returns:
+            bool: True if it was stored, False if the worker no longer holds the job or on a database error.
+        """
+        conn = get_db_connection()
+        try:
+            cursor = conn.execute(
+                FINISH_JOB,
+                ('failed' if error is not None else 'done', json.dumps(result) if result is not None else None,
+                 error, job_id, worker_id)
+            )
+            conn.commit()
+            return cursor.rowcount > 0
+        except sqlite3.Error as e:
+            print(f"Database error in ScanJob.finish: {e}")
+            conn.rollback()
+            return False
+        finally:
+            conn.close()
+
+    @staticmethod
+    def requeue_expired():
+        """
+        Puts running jobs whose lease expired back into the queue.
+
+        Only a worker that stopped renewing (its process crashed, hung or was restarted) lets a
+        lease expire, so jobs still being run by live processes are left alone.
+        """
+        conn = get_db_connection()
+        try:
+            cursor = conn.execute(REQUEUE_EXPIRED_JOBS)
+            conn.commit()
+            return cursor.rowcount
+        except sqlite3.Error as e:
+            print(f"Database error in ScanJob.requeue_expired: {e}")
+            conn.rollback()
+            return 0
+        finally:
+            conn.close()
+
+    @staticmethod
+    def get_by_id(job_id):
+        """Returns the ScanJob with the given ID, or None."""
+        conn = get_db_connection()
+        try:
+            row = conn.execute("SELECT * FROM scan_jobs WHERE id = ?", (job_id,)).fetchone()
+            return ScanJob.from_row(row) if row else None
+        except sqlite3.Error as e:
+            print(f"Database error in ScanJob.get_by_id: {e}")
+            return None
+        finally:
+            conn.close()
@@ -0,0 +1,222 @@
+import os
+import zlib
+
+import numpy as np
+
+MERSENNE_PRIME = (1 << 61) - 1
+MAX_HASH = (1 << 32) - 1
+HASH_CHUNK_SIZE = 4096  # Shingles hashed per numpy block, keeps memory bounded for huge documents
+
+
+def generate_shingles(words, shingle_size=3):
+    """
+    Builds the set of hashed word shingles (overlapping n-grams) of a document.
+
+    Args:
+        words: List of preprocessed words (output of preprocess_text).
+        shingle_size: Number of consecutive words per shingle.
+
+    Returns:
+        A set of 32-bit shingle hashes. Documents shorter than one shingle
+        produce a single shingle made of all their words.
+    """
+    if not words:
+        return set()
+    if len(words) < shingle_size:
+        return {zlib.crc32(' '.join(words).encode('utf-8'))}
+    return {zlib.crc32(' '.join(words[i:i + shingle_size]).encode('utf-8'))
+            for i in range(len(words) - shingle_size + 1)}
+
+
+class SignatureAccumulator:
+    """
+    Builds a MinHash signature from a document's words as they arrive in pieces,
+    so a streamed upload never has to hold its whole word list or shingle set.
+    """
+
+    def __init__(self, lsh):
+        self.lsh = lsh
+        self._values = np.full(lsh.num_perm, MAX_HASH, dtype=np.uint64)
+        self._tail = []  # Last shingle_size - 1 words; shingles continue across pieces
+        self._has_shingles = False
+
+    def update(self, words):
+        """Adds the next words of the document."""
+        size = self.lsh.shingle_size
+        window = self._tail + list(words)
+        if len(window) >= size:
+            self.lsh.merge_hashes(self._values, generate_shingles(window, size))
+            self._has_shingles = True
+        self._tail = window[max(0, len(window) - size + 1):] if size > 1 else []
+
+    def signature(self):
+        """Returns the finished signature (None for an empty document)."""
+        if not self._has_shingles:
+            if not self._tail:
+                return None
+            # Shorter than one shingle: all words form a single shingle, as in generate_shingles
+            self.lsh.merge_hashes(self._values, generate_shingles(self._tail, self.lsh.shingle_size))
+            self._has_shingles = True
+        return self._values.astype(np.uint32)
+
+
+class MinHashLSH:
+    """
+    MinHash signatures kept in banded locality-sensitive hash buckets.
+
+    Each signature has bands * rows MinHash values. Two documents become candidates
+    when all rows of at least one band are equal, which happens with probability
+    1 - (1 - J^rows)^bands for Jaccard similarity J: more bands raise recall,
+    more rows per band cut down the candidates that have to be checked.
+    """
+
+    def __init__(self, bands=16, rows=8, shingle_size=3, seed=1):
+        self.bands = bands
+        self.rows = rows
+        self.shingle_size = shingle_size
+        self.seed = seed
+        self.num_perm = bands * rows
+
+        generator = np.random.RandomState(seed)
+        # Coefficients below 2^29 keep a * hash + b inside 64 bits for 32-bit hashes
+        self._a = generator.randint(1, 1 << 29, size=self.num_perm).astype(np.uint64)
+        self._b = generator.randint(0, 1 << 29, size=self.num_perm).astype(np.uint64)
+
+        self.signatures = {}  # doc_id -> uint32 signature array
+        self.buckets = [{} for _ in range(bands)]  # per band: band bytes -> set of doc_ids
+        self.generation = 0
+
+    def __len__(self):
+        return len(self.signatures)
+
+    def __contains__(self, doc_id):
+        return doc_id in self.signatures
+
+    def signature(self, words):
+        """
+        Computes the MinHash signature of a document.
+
+        Args:
+            words: List of preprocessed words.
+
+        Returns:
+            A uint32 numpy array of length bands * rows, or None for an empty document.
+        """
+        accumulator = SignatureAccumulator(self)
+        accumulator.update(words)
+        return accumulator.signature()
+
+    def merge_hashes(self, values, shingle_hashes):
+        """Lowers the running MinHash values with the permutations of a batch of shingle hashes."""
+        hashes = np.fromiter(shingle_hashes, dtype=np.uint64, count=len(shingle_hashes))
+        for start in range(0, len(hashes), HASH_CHUNK_SIZE):
+            block = hashes[start:start + HASH_CHUNK_SIZE, None]
+            permuted = (block * self._a + self._b) % MERSENNE_PRIME & MAX_HASH
+            np.minimum(values, permuted.min(axis=0), out=values)
+
+    def _band_keys(self, signature):
+        return [signature[band * self.rows:(band + 1) * self.rows].tobytes() for band in range(self.bands)]
+
+    def add(self, doc_id, signature):
+        """Stores a document's signature and puts it into one bucket per band (replacing any old one)."""
+        self.remove(doc_id)
+        if signature is None:
+            return
+        self.signatures[doc_id] = signature
+        for band, key in enumerate(self._band_keys(signature)):
+            self.buckets[band].setdefault(key, set()).add(doc_id)
+        self.generation += 1
+
+    def remove(self, doc_id):
+        """Drops a document's signature and bucket entries."""
+        signature = self.signatures.pop(doc_id, None)
+        if signature is None:
+            return
+        for band, key in enumerate(self._band_keys(signature)):
+            bucket = self.buckets[band][key]
+            bucket.discard(doc_id)
+            if not bucket:
+                del self.buckets[band][key]
+        self.generation += 1
+
+    def document_added(self, doc_id, term_ids, counts, total_words, words):
+        """
+        Index listener: keeps the signature of a new (or replaced) document.
+
+        Documents indexed from term counts alone carry no word order; their
+        signature has to be added separately (see SignatureAccumulator).
+        """
+        if words is not None:
+            self.add(doc_id, self.signature(words))
+        else:
+            self.remove(doc_id)
+
+    def document_removed(self, doc_id):
+        """Index listener: forgets a removed document."""
+        self.remove(doc_id)
+
+    def query(self, signature, min_jaccard=0.0, exclude=None):
+        """
+        Finds near-duplicates of a signature among the documents sharing a bucket with it.
+
+        Args:
+            signature: MinHash signature of the query document.
+            min_jaccard: Only candidates with an estimated Jaccard similarity of at least this are returned.
+            exclude: Optional doc_id to leave out (usually the query document itself).
+
+        Returns:
+            A list of (doc_id, estimated Jaccard similarity) tuples, most similar first.
+        """
+        if signature is None:
+            return []
+
+        candidates = set()
+        for band, key in enumerate(self._band_keys(signature)):
+            bucket = self.buckets[band].get(key)
+            if bucket:
+                candidates.update(bucket)
+        candidates.discard(exclude)
+        if not candidates:
+            return []
+
+        candidates = list(candidates)
+        candidate_signatures = np.stack([self.signatures[doc_id] for doc_id in candidates])
+        # The fraction of equal MinHash values estimates the Jaccard similarity of the shingle sets
+        estimates = (candidate_signatures == signature).mean(axis=1)
+        results = [(doc_id, float(estimate)) for doc_id, estimate in zip(candidates, estimates)
+                   if estimate >= min_jaccard]
+        results.sort(key=lambda item: item[1], reverse=True)
+        return results
+
+    def save(self, path):
+        """Writes all signatures and the hashing parameters to an .npz file."""
+        doc_ids = list(self.signatures)
+        matrix = (np.stack([self.signatures[doc_id] for doc_id in doc_ids]) if doc_ids
+                  else np.zeros((0, self.num_perm), dtype=np.uint32))
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, doc_ids=np.array(doc_ids, dtype=str), signatures=matrix,
+                     params=np.array([self.bands, self.rows, self.shingle_size, self.seed]))
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path, bands, rows, shingle_size=3, seed=1):
+        """
+        Restores an index written by save.
+
+        Raises:
+            ValueError: If the file is unreadable or was built with other hashing parameters.
+        """
+        try:
+            with np.load(path) as data:
+                params = [int(value) for value in data['params']]
+                doc_ids = [str(doc_id) for doc_id in data['doc_ids']]
+                matrix = data['signatures']
+        except Exception as e:  # Missing, truncated or foreign files fail in many different ways
+            raise ValueError(f"Cannot read near-duplicate index {path}: {e}") from e
+        if params != [bands, rows, shingle_size, seed]:
+            raise ValueError("Near-duplicate index was built with different parameters")
+
+        lsh = cls(bands=bands, rows=rows, shingle_size=shingle_size, seed=seed)
+        for doc_id, signature in zip(doc_ids, matrix):
+            lsh.add(doc_id, signature.astype(np.uint32))
+        return lsh
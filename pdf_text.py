@@ -0,0 +1,608 @@
+"""
+Pure-Python text extraction from PDF files.
+
+Only the parts of the PDF format needed to get at the text are implemented:
+the object syntax, indirect objects (also inside object streams), the
+FlateDecode/ASCIIHexDecode/ASCII85Decode stream filters, the page tree and the
+text operators of content streams (including form XObjects). Strings are
+mapped to Unicode through the font's ToUnicode CMap when there is one and
+read as cp1252 (close to WinAnsiEncoding) otherwise. Layout is approximated:
+the output is meant for tokenizing, so words only need to stay whole and
+separated.
+
+Objects are located with a scan for "N G obj" rather than through the xref
+table, which also copes with slightly damaged files, and are parsed lazily, so
+extracting a few pages only parses what those pages use.
+"""
+import base64
+import re
+import zlib
+
+MAX_FORM_DEPTH = 8  # Nesting of form XObjects followed before giving up (guards against cycles)
+TJ_SPACE_THRESHOLD = -200  # TJ adjustment (thousandths of an em) wide enough to be a space between words
+
+WHITESPACE = b' \t\r\n\x0c\x00'
+OBJECT_HEADER = re.compile(rb'(?<![0-9])(\d+)\s+(\d+)\s+obj\b')
+TOKEN = re.compile(rb'[^\s()<>\[\]{}/%\x00]+')
+INLINE_IMAGE_END = re.compile(rb'\sEI(?=\s|$)')
+NAME_ESCAPE = re.compile(rb'#([0-9A-Fa-f]{2})')
+STRING_ESCAPES = {ord('n'): b'\n', ord('r'): b'\r', ord('t'): b'\t', ord('b'): b'\b', ord('f'): b'\f',
+                  ord('('): b'(', ord(')'): b')', ord('\\'): b'\\'}
+
+
+class PdfError(Exception):
+    """Raised when a file is not a PDF this module can read."""
+
+
+class Name(str):
+    """A PDF name object (/Name), kept apart from strings."""
+
+
+class Ref:
+    """Reference to an indirect object ("N G R")."""
+
+    __slots__ = ('number', 'generation')
+
+    def __init__(self, number, generation):
+        self.number = number
+        self.generation = generation
+
+
+class Keyword(str):
+    """A bare keyword in a content stream or object (an operator, true/false/null are converted)."""
+
+
+class Stream:
+    """A stream object: its dictionary and its still encoded data."""
+
+    def __init__(self, attributes, raw):
+        self.attributes = attributes
+        self.raw = raw
+
+
+class Lexer:
+    """Reads PDF objects from a byte string."""
+
+    def __init__(self, data, position=0):
+        self.data = data
+        self.position = position
+
+    def skip_whitespace(self):
+        data = self.data
+        length = len(data)
+        while self.position < length:
+            byte = data[self.position]
+            if byte in WHITESPACE:
+                self.position += 1
+            elif byte == 0x25:  # % comment up to the end of the line
+                end = data.find(b'\n', self.position)
+                self.position = length if end < 0 else end + 1
+            else:
+                break
+
+    def next(self):
+        """
+        Returns the next object or keyword, or raises EOFError at the end of the data.
+
+        Dictionaries and arrays are returned whole; "N G R" is returned as a Ref.
+        """
+        self.skip_whitespace()
+        data = self.data
+        if self.position >= len(data):
+            raise EOFError
+        start = self.position
+        byte = data[start]
+
+        if data.startswith(b'<<', start):
+            self.position += 2
+            return self._dictionary()
+        if byte == 0x3C:  # <hex string>
+            end = data.find(b'>', start)
+            if end < 0:
+                raise PdfError("Unterminated hex string")
+            self.position = end + 1
+            digits = re.sub(rb'[^0-9A-Fa-f]', b'', data[start + 1:end])
+            if len(digits) % 2:
+                digits += b'0'
+            return bytes.fromhex(digits.decode('ascii'))
+        if byte == 0x28:  # (literal string)
+            return self._literal_string()
+        if byte == 0x2F:  # /Name
+            match = TOKEN.match(data, start + 1)
+            self.position = match.end() if match else start + 1
+            raw = match.group() if match else b''
+            return Name(NAME_ESCAPE.sub(lambda m: bytes([int(m.group(1), 16)]), raw).decode('latin-1'))
+        if byte == 0x5B:  # [array]
+            self.position += 1
+            items = []
+            while True:
+                self.skip_whitespace()
+                if self.position >= len(data):
+                    raise PdfError("Unterminated array")
+                if data[self.position] == 0x5D:
+                    self.position += 1
+                    return self._resolve_refs(items)
+                items.append(self.next())
+        if byte in b'>]{})':
+            self.position += 1
+            return Keyword(chr(byte))
+
+        match = TOKEN.match(data, start)
+        self.position = match.end()
+        token = match.group()
+        number = _number(token)
+        if number is not None:
+            return number
+        if token == b'true':
+            return True
+        if token == b'false':
+            return False
+        if token == b'null':
+            return None
+        return Keyword(token.decode('latin-1'))
+
+    def _dictionary(self):
+        items = []
+        while True:
+            self.skip_whitespace()
+            if self.position >= len(self.data):
+                raise PdfError("Unterminated dictionary")
+            if self.data.startswith(b'>>', self.position):
+                self.position += 2
+                break
+            items.append(self.next())
+        items = self._resolve_refs(items)
+        return {items[i]: items[i + 1] for i in range(0, len(items) - 1, 2) if isinstance(items[i], Name)}
+
+    @staticmethod
+    def _resolve_refs(items):
+        # "N G R" arrives as three tokens; fold them into one Ref
+        result = []
+        for item in items:
+            if (isinstance(item, Keyword) and item == 'R' and len(result) >= 2
+                    and type(result[-1]) is int and type(result[-2]) is int):
+                generation = result.pop()
+                result[-1] = Ref(result[-1], generation)
+            else:
+                result.append(item)
+        return result
+
+    def _literal_string(self):
+        data = self.data
+        position = self.position + 1
+        depth = 1
+        out = bytearray()
+        length = len(data)
+        while position < length:
+            byte = data[position]
+            if byte == 0x5C:  # backslash escape
+                position += 1
+                if position >= length:
+                    break
+                escaped = data[position]
+                if escaped in STRING_ESCAPES:
+                    out += STRING_ESCAPES[escaped]
+                    position += 1
+                elif 0x30 <= escaped <= 0x37:  # up to three octal digits
+                    end = position
+                    while end < min(position + 3, length) and 0x30 <= data[end] <= 0x37:
+                        end += 1
+                    out.append(int(data[position:end], 8) & 0xFF)
+                    position = end
+                elif escaped in b'\r\n':  # line continuation
+                    position += 2 if data.startswith(b'\r\n', position) else 1
+                else:
+                    out.append(escaped)
+                    position += 1
+                continue
+            if byte == 0x28:
+                depth += 1
+            elif byte == 0x29:
+                depth -= 1
+                if depth == 0:
+                    self.position = position + 1
+                    return bytes(out)
+            out.append(byte)
+            position += 1
+        raise PdfError("Unterminated string")
+
+
+def _number(token):
+    try:
+        return int(token)
+    except ValueError:
+        pass
+    try:
+        return float(token)
+    except ValueError:
+        return None
+
+
+def decode_stream(stream):
+    """Returns the decoded data of a stream, applying its filters in order."""
+    data = stream.raw
+    filters = stream.attributes.get('Filter')
+    if filters is None:
+        return data
+    if not isinstance(filters, list):
+        filters = [filters]
+    for name in filters:
+        if name in ('FlateDecode', 'Fl'):
+            try:
+                data = zlib.decompress(data)
+            except zlib.error:
+                # Truncated or slightly damaged streams: keep whatever inflates
+                data = zlib.decompressobj().decompress(data)
+        elif name in ('ASCIIHexDecode', 'AHx'):
+            digits = re.sub(rb'[^0-9A-Fa-f]', b'', data.split(b'>', 1)[0])
+            data = bytes.fromhex((digits + b'0' * (len(digits) % 2)).decode('ascii'))
+        elif name in ('ASCII85Decode', 'A85'):
+            data = base64.a85decode(data.strip().removeprefix(b'<~').split(b'~>', 1)[0], adobe=False,
+                                    ignorechars=WHITESPACE)
+        else:
+            raise PdfError(f"Unsupported stream filter: {name}")
+    return data
+
+
+class PdfDocument:
+    """
+    A PDF file opened for text extraction.
+
+    Args:
+        data: The whole file as bytes.
+    """
+
+    def __init__(self, data):
+        if not data.lstrip()[:5] == b'%PDF-':
+            raise PdfError("Not a PDF file")
+        self.data = data
+        self._offsets = {}  # object number -> offset of its "N G obj" header (the last one wins)
+        for match in OBJECT_HEADER.finditer(data):
+            self._offsets[int(match.group(1))] = match.end()
+        self._objects = {}
+        self._compressed = None  # object number -> (object stream number, index), read on first miss
+        self._pages = None
+        self.fonts = {}  # id of a font dictionary -> _Font
+
+    def get(self, value):
+        """Resolves a Ref to its object (other values are returned as they are)."""
+        depth = 0
+        while isinstance(value, Ref):
+            value = self._object(value.number)
+            depth += 1
+            if depth > 32:
+                raise PdfError("Reference loop")
+        return value
+
+    def _object(self, number):
+        if number in self._objects:
+            return self._objects[number]
+        value = None
+        if number in self._offsets:
+            value = self._parse_indirect(self._offsets[number])
+        else:
+            location = self._compressed_objects().get(number)
+            if location is not None:
+                value = self._parse_compressed(*location)
+        self._objects[number] = value
+        return value
+
+    def _parse_indirect(self, offset):
+        lexer = Lexer(self.data, offset)
+        try:
+            value = lexer.next()
+        except (EOFError, PdfError):
+            return None
+        if not isinstance(value, dict):
+            return value
+        lexer.skip_whitespace()
+        if not self.data.startswith(b'stream', lexer.position):
+            return value
+
+        start = lexer.position + 6
+        if self.data.startswith(b'\r\n', start):
+            start += 2
+        elif self.data.startswith(b'\n', start) or self.data.startswith(b'\r', start):
+            start += 1
+        length = value.get('Length')
+        if isinstance(length, Ref):
+            # Length may itself be an indirect object; guard against it pointing back at us
+            length = self._object(length.number) if length.number in self._offsets else None
+        end = start + length if isinstance(length, int) else -1
+        if end < start or not self.data.startswith(b'endstream', self._skip_eol(end)):
+            end = self.data.find(b'endstream', start)
+            if end < 0:
+                end = len(self.data)
+            while end > start and self.data[end - 1] in b'\r\n':
+                end -= 1
+        return Stream(value, self.data[start:end])
+
+    def _skip_eol(self, position):
+        while position < len(self.data) and self.data[position] in WHITESPACE:
+            position += 1
+        return position
+
+    def _compressed_objects(self):
+        # Objects inside object streams (PDF 1.5+) have no "N G obj" header of their own
+        if self._compressed is None:
+            self._compressed = {}
+            for number in list(self._offsets):
+                stream = self._object(number)
+                if isinstance(stream, Stream) and stream.attributes.get('Type') == 'ObjStm':
+                    try:
+                        header = Lexer(decode_stream(stream))
+                        for index in range(stream.attributes.get('N', 0)):
+                            member = header.next()
+                            header.next()  # Offset, read again when the object is parsed
+                            if isinstance(member, int) and member not in self._offsets:
+                                self._compressed.setdefault(member, (number, index))
+                    except (EOFError, PdfError, zlib.error, ValueError):
+                        continue
+        return self._compressed
+
+    def _parse_compressed(self, stream_number, index):
+        stream = self._object(stream_number)
+        try:
+            data = decode_stream(stream)
+            header = Lexer(data)
+            pairs = [(header.next(), header.next()) for _ in range(stream.attributes.get('N', 0))]
+            return Lexer(data, stream.attributes.get('First', 0) + pairs[index][1]).next()
+        except (EOFError, PdfError, zlib.error, ValueError, IndexError, TypeError):
+            return None
+
+    def _trailer(self):
+        # The last trailer, or the xref stream dictionary of files using cross-reference streams
+        position = self.data.rfind(b'trailer')
+        if position >= 0:
+            try:
+                trailer = Lexer(self.data, position + 7).next()
+                if isinstance(trailer, dict) and 'Root' in trailer:
+                    return trailer
+            except (EOFError, PdfError):
+                pass
+        for number in sorted(self._offsets, key=self._offsets.get, reverse=True):
+            value = self._object(number)
+            if isinstance(value, Stream) and value.attributes.get('Type') == 'XRef' and 'Root' in value.attributes:
+                return value.attributes
+        return {}
+
+    def _catalog(self):
+        trailer = self._trailer()
+        if 'Encrypt' in trailer:
+            raise PdfError("Encrypted PDFs are not supported")
+        if 'Root' in trailer:
+            return self.get(trailer['Root'])
+        for number in self._offsets:
+            value = self._object(number)
+            if isinstance(value, dict) and value.get('Type') == 'Catalog':
+                return value
+        raise PdfError("No document catalog found")
+
+    def pages(self):
+        """Returns the page dictionaries in reading order, each with its inherited resources filled in."""
+        if self._pages is None:
+            self._pages = []
+            catalog = self._catalog()
+            if not isinstance(catalog, dict):
+                raise PdfError("Invalid document catalog")
+            self._collect_pages(self.get(catalog.get('Pages')), {}, set())
+        return self._pages
+
+    def _collect_pages(self, node, inherited, seen):
+        if not isinstance(node, dict) or id(node) in seen:
+            return
+        seen.add(id(node))
+        inherited = dict(inherited)
+        if 'Resources' in node:
+            inherited['Resources'] = node['Resources']
+        kids = self.get(node.get('Kids'))
+        if node.get('Type') == 'Pages' or isinstance(kids, list):
+            for kid in kids or []:
+                self._collect_pages(self.get(kid), inherited, seen)
+        else:
+            page = dict(inherited)
+            page.update(node)
+            self._pages.append(page)
+
+    def page_count(self):
+        return len(self.pages())
+
+    def page_text(self, page_number):
+        """Returns the text of one page (0-based)."""
+        page = self.pages()[page_number]
+        contents = self.get(page.get('Contents'))
+        if contents is None:
+            return ''
+        streams = contents if isinstance(contents, list) else [contents]
+        data = b'\n'.join(decode_stream(stream) for stream in (self.get(item) for item in streams)
+                          if isinstance(stream, Stream))
+        return _ContentReader(self, self.get(page.get('Resources'))).read(data)
+
+
+class _ContentReader:
+    """Runs the text operators of a content stream and collects the shown text."""
+
+    def __init__(self, document, resources, depth=0):
+        self.document = document
+        self.resources = resources if isinstance(resources, dict) else {}
+        self.depth = depth
+        self.font = None
+        self.parts = []
+
+    def _font(self, name):
+        fonts = self.document.get(self.resources.get('Font')) or {}
+        font = self.document.get(fonts.get(name)) if isinstance(fonts, dict) else None
+        return _Font.for_dict(self.document, font)
+
+    def read(self, data):
+        lexer = Lexer(data)
+        operands = []
+        while True:
+            try:
+                token = lexer.next()
+            except EOFError:
+                break
+            except PdfError:
+                break  # Damaged content: keep the text read so far
+            if not isinstance(token, Keyword):
+                operands.append(token)
+                continue
+
+            if token == 'Tf' and len(operands) >= 2:
+                self.font = self._font(operands[-2])
+            elif token == 'Tj' and operands:
+                self._show(operands[-1])
+            elif token in ("'", '"') and operands:
+                self.parts.append('\n')
+                self._show(operands[-1])
+            elif token == 'TJ' and operands and isinstance(operands[-1], list):
+                for item in operands[-1]:
+                    if isinstance(item, bytes):
+                        self._show(item)
+                    elif isinstance(item, (int, float)) and item < TJ_SPACE_THRESHOLD:
+                        self.parts.append(' ')
+            elif token in ('Td', 'TD') and len(operands) >= 2:
+                self.parts.append('\n' if operands[-1] else ' ')
+            elif token in ('T*', 'Tm', 'ET'):
+                self.parts.append('\n')
+            elif token == 'Do' and operands:
+                self._form(operands[-1])
+            elif token == 'ID':
+                # Inline image data up to EI, which may contain anything
+                end = INLINE_IMAGE_END.search(lexer.data, lexer.position)
+                lexer.position = end.end() if end else len(lexer.data)
+            operands = []
+        return ''.join(self.parts)
+
+    def _show(self, value):
+        if isinstance(value, bytes):
+            self.parts.append(self.font.decode(value) if self.font else value.decode('cp1252', errors='replace'))
+
+    def _form(self, name):
+        if self.depth >= MAX_FORM_DEPTH:
+            return
+        xobjects = self.document.get(self.resources.get('XObject')) or {}
+        form = self.document.get(xobjects.get(name)) if isinstance(xobjects, dict) else None
+        if not isinstance(form, Stream) or form.attributes.get('Subtype') != 'Form':
+            return
+        resources = self.document.get(form.attributes.get('Resources')) or self.resources
+        reader = _ContentReader(self.document, resources, self.depth + 1)
+        try:
+            self.parts.append(reader.read(decode_stream(form)))
+        except (PdfError, zlib.error, ValueError):
+            pass
+
+
+class _Font:
+    """Maps the bytes of shown strings to text for one font."""
+
+    def __init__(self, mapping, code_width, identity):
+        self.mapping = mapping  # code -> text, from the ToUnicode CMap
+        self.code_width = code_width  # Bytes per character code
+        self.identity = identity  # Two-byte glyph ids without a ToUnicode map: not decodable
+
+    @classmethod
+    def for_dict(cls, document, font):
+        if not isinstance(font, dict):
+            return None
+        # Font dictionaries stay alive in the document's object cache, so their id is a stable key
+        key = id(font)
+        if key not in document.fonts:
+            mapping, code_width = {}, 1
+            to_unicode = document.get(font.get('ToUnicode'))
+            if isinstance(to_unicode, Stream):
+                try:
+                    mapping, code_width = parse_cmap(decode_stream(to_unicode))
+                except (PdfError, zlib.error, ValueError):
+                    mapping = {}
+            identity = not mapping and str(font.get('Encoding', '')).startswith('Identity')
+            document.fonts[key] = cls(mapping, 2 if identity else code_width, identity)
+        return document.fonts[key]
+
+    def decode(self, value):
+        if self.mapping and self.code_width == 1:
+            # ToUnicode maps of simple fonts often only list ligatures and symbols
+            return ''.join(self.mapping.get(byte) or bytes([byte]).decode('cp1252', errors='replace') for byte in value)
+        if self.mapping:
+            width = self.code_width
+            return ''.join(self.mapping.get(int.from_bytes(value[i:i + width], 'big'), '')
+                           for i in range(0, len(value), width))
+        if self.identity:
+            return ''
+        return value.decode('cp1252', errors='replace')
+
+
+def _utf16(data):
+    return data.decode('utf-16-be', errors='replace')
+
+
+def parse_cmap(data):
+    """
+    Parses the bfchar and bfrange sections of a ToUnicode CMap.
+
+    Returns:
+        A tuple (mapping of character code -> text, bytes per character code).
+    """
+    mapping = {}
+    code_width = 1
+    lexer = Lexer(data)
+    operands = []
+    section = None
+    while True:
+        try:
+            token = lexer.next()
+        except EOFError:
+            break
+        if isinstance(token, Keyword):
+            if token in ('beginbfchar', 'beginbfrange'):
+                section = token
+            elif token in ('endbfchar', 'endbfrange'):
+                if section == 'beginbfchar':
+                    for source, target in zip(operands[0::2], operands[1::2]):
+                        if isinstance(source, bytes) and isinstance(target, bytes):
+                            code_width = max(code_width, len(source))
+                            mapping[int.from_bytes(source, 'big')] = _utf16(target)
+                else:
+                    for low, high, target in zip(operands[0::3], operands[1::3], operands[2::3]):
+                        if not (isinstance(low, bytes) and isinstance(high, bytes)):
+                            continue
+                        code_width = max(code_width, len(low))
+                        first, last = int.from_bytes(low, 'big'), int.from_bytes(high, 'big')
+                        if isinstance(target, list):
+                            for code, item in zip(range(first, last + 1), target):
+                                if isinstance(item, bytes):
+                                    mapping[code] = _utf16(item)
+                        elif isinstance(target, bytes) and last - first < 65536:
+                            base = int.from_bytes(target, 'big')
+                            for offset in range(last - first + 1):
+                                mapping[first + offset] = _utf16((base + offset).to_bytes(max(len(target), 2), 'big'))
+                section = None
+            operands = []
+        elif section is not None:
+            operands.append(token)
+    return mapping, code_width
+
+
+def page_count(path):
+    """Returns the number of pages of a PDF file."""
+    with open(path, 'rb') as f:
+        return PdfDocument(f.read()).page_count()
+
+
+def extract_pages(path, first, last):
+    """
+    Extracts the text of pages first..last-1 (0-based) of a PDF file.
+
+    Returns:
+        A list with the text of every page in the range.
+    """
+    with open(path, 'rb') as f:
+        document = PdfDocument(f.read())
+    pages = []
+    for page_number in range(first, min(last, document.page_count())):
+        try:
+            pages.append(document.page_text(page_number))
+        except (PdfError, zlib.error, ValueError) as e:
+            print(f"Error extracting page {page_number + 1} of {path}: {e}")
+            pages.append('')
+    return pages
@@ -0,0 +1,122 @@
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+RESULT_CACHE_MAX_BYTES = 32 * 1024 * 1024  # Estimated memory the cached results may take
+RESULT_CACHE_TTL = 300  # Seconds a cached result stays valid even if the index does not change
+
+
+def estimate_size(value):
+    """
+    Roughly estimates the memory taken by a cached result.
+
+    Counts the containers, their tuples/lists and the scalars and strings in them
+    (one level deep is enough for (doc_id, score) match lists).
+    """
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        value = list(value.items())
+    if isinstance(value, (list, tuple)):
+        for item in value:
+            size += sys.getsizeof(item)
+            if isinstance(item, (list, tuple)):
+                size += sum(sys.getsizeof(part) for part in item)
+    return size
+
+
+class ResultCache:
+    """
+    Bounded LRU cache of similarity results, tied to one index generation.
+
+    Every ingest or removal bumps the index generation and changes IDF and norms,
+    so a result is only valid for the generation it was computed at. The first
+    get() or put() with a newer generation drops every entry at once. Entries
+    also expire after ttl seconds. Once the estimated size of all entries passes
+    max_bytes, the least recently used ones are evicted.
+    """
+
+    def __init__(self, max_bytes=RESULT_CACHE_MAX_BYTES, ttl=RESULT_CACHE_TTL):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.generation = None  # Index generation of the cached entries
+        self.size = 0  # Estimated bytes of all entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()  # key -> (value, size, expires_at), least recently used first
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _check_generation(self, generation):
+        # A newer index generation makes every cached result stale
+        if generation != self.generation:
+            if self._entries:
+                self.invalidations += 1
+            self._entries.clear()
+            self.size = 0
+            self.generation = generation
+
+    def get(self, key, generation):
+        """
+        Returns the cached result for key at the given index generation, or None.
+        """
+        with self._lock:
+            self._check_generation(generation)
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, size, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                self.size -= size
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, generation):
+        """Caches a result computed at the given index generation, evicting the least recently used ones."""
+        size = estimate_size(value)
+        with self._lock:
+            self._check_generation(generation)
+            if size > self.max_bytes:
+                return  # Would evict everything else and still not fit
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self._entries[key] = (value, size, time.monotonic() + self.ttl)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self):
+        """Returns the counters and current size of the cache."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self.size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+                'generation': self.generation,
+            }
@@ -0,0 +1,86 @@
+import os
+import sys
+import threading
+import time
+
+PROFILE_INTERVAL = 0.005  # Seconds between two stack samples
+PROFILE_TOP_STACKS = 50  # Most frequent stacks kept in a profile
+
+
+class SamplingProfiler:
+    """
+    One-shot sampling profiler for a single request.
+
+    arm() switches it on at runtime for the next request (optionally only one
+    whose path matches); while that request runs, a background thread samples
+    the request thread's stack every interval seconds. The result is kept as
+    collapsed stacks ("outer;inner;leaf count", the flame graph input format)
+    until the next profile replaces it. Requests run without any overhead while
+    the profiler is not armed.
+    """
+
+    def __init__(self, top_stacks=PROFILE_TOP_STACKS):
+        self.top_stacks = top_stacks
+        self.last_profile = None
+        self._armed = None  # (path, interval) of the pending profile
+        self._active = None  # (thread id, path, started, samples, stop event, sampler thread, interval)
+        self._lock = threading.Lock()
+
+    def arm(self, path=None, interval=PROFILE_INTERVAL):
+        """Profiles the next request (whose path equals path, if given)."""
+        with self._lock:
+            self._armed = (path, interval)
+
+    def start(self, path):
+        """Starts sampling the current thread if the profiler is armed for this path; returns True if it did."""
+        if self._armed is None:
+            return False  # Fast path of every request while nothing is armed
+        with self._lock:
+            if self._armed is None or self._active is not None:
+                return False
+            armed_path, interval = self._armed
+            if armed_path is not None and armed_path != path:
+                return False
+            self._armed = None
+            thread_id = threading.get_ident()
+            samples = {}
+            stop = threading.Event()
+            sampler = threading.Thread(target=self._sample, args=(thread_id, interval, samples, stop),
+                                       name='sampling-profiler', daemon=True)
+            self._active = (thread_id, path, time.perf_counter(), samples, stop, sampler, interval)
+        sampler.start()
+        return True
+
+    def stop(self):
+        """Stops the profile of the current thread (if any) and stores it as last_profile."""
+        if self._active is None:
+            return None
+        with self._lock:
+            if self._active is None or self._active[0] != threading.get_ident():
+                return None
+            thread_id, path, started, samples, stop, sampler, interval = self._active
+            self._active = None
+        stop.set()
+        sampler.join()
+        stacks = sorted(samples.items(), key=lambda item: item[1], reverse=True)
+        self.last_profile = {
+            'path': path,
+            'duration_ms': round((time.perf_counter() - started) * 1000, 3),
+            'interval_ms': interval * 1000,
+            'samples': sum(samples.values()),
+            'stacks': [f"{stack} {count}" for stack, count in stacks[:self.top_stacks]],
+        }
+        return self.last_profile
+
+    @staticmethod
+    def _sample(thread_id, interval, samples, stop):
+        while not stop.wait(interval):
+            frame = sys._current_frames().get(thread_id)
+            frames = []
+            while frame is not None:
+                code = frame.f_code
+                frames.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+                frame = frame.f_back
+            if frames:
+                stack = ';'.join(reversed(frames))  # Outermost frame first
+                samples[stack] = samples.get(stack, 0) + 1
@@ -0,0 +1,318 @@
+import math
+import sys
+from array import array
+from collections import Counter
+
+
+class Vocabulary:
+    """
+    Interned term <-> integer id mapping.
+
+    Every distinct term is stored once and referred to by its id everywhere else
+    (postings, document vectors, the similarity engine's matrix columns). Ids are
+    never reused, so they stay valid for the lifetime of the index.
+    """
+
+    def __init__(self):
+        self.ids = {}  # term -> term id
+        self.terms = []  # term id -> term
+
+    def __len__(self):
+        return len(self.terms)
+
+    def __contains__(self, term):
+        return term in self.ids
+
+    def get(self, term):
+        """Returns the id of a known term, or None."""
+        return self.ids.get(term)
+
+    def intern(self, term):
+        """Returns the id of a term, assigning the next free id to new terms."""
+        term_id = self.ids.get(term)
+        if term_id is None:
+            term = sys.intern(term)
+            term_id = self.ids[term] = len(self.terms)
+            self.terms.append(term)
+        return term_id
+
+    def encode_counts(self, counts):
+        """
+        Turns a term -> count mapping into a compact term vector.
+
+        Returns:
+            A tuple (term_ids, term_counts) of array('I'), sorted by term id.
+        """
+        pairs = sorted((self.intern(term), count) for term, count in counts.items())
+        return array('I', [term_id for term_id, _ in pairs]), array('I', [count for _, count in pairs])
+
+
+class InvertedIndex:
+    """
+    In-memory inverted index over the scanned corpus.
+
+    Terms are interned into a Vocabulary and documents get internal doc numbers,
+    so postings (term id -> doc numbers and counts) and document vectors (sorted
+    term ids and counts) are flat array('I') columns instead of nested dicts.
+    Per-document lengths and document-frequency counts are kept up to date as
+    documents come and go, so adding, removing or replacing one document only
+    touches the terms of that document. Removed documents are skipped in the
+    postings, and a term's arrays are compacted once half of their entries are dead.
+
+    IDF values and document norms are derived lazily from the maintained counts
+    and cached until the next change to the index.
+    """
+
+    def __init__(self):
+        self.vocabulary = Vocabulary()
+        self.doc_numbers = {}  # doc_id -> internal doc number
+        self.doc_ids_by_number = []  # doc number -> doc_id (None once removed)
+        self.doc_vectors = []  # doc number -> (term ids, term counts) arrays (None once removed)
+        self.doc_lengths = array('I')  # doc number -> total number of words in the document
+        self.postings = []  # term id -> (doc numbers, counts) arrays, may still list removed doc numbers
+        self.dead_postings = array('I')  # term id -> number of removed doc numbers left in its postings
+        self.document_frequency = array('I')  # term id -> number of documents containing the term
+        self.generation = 0  # Bumped on every change so cached IDF/norms know when they are stale
+        self.listeners = []  # Objects notified through document_added/document_removed (e.g. SimilarityEngine, MinHashLSH)
+        self._idf_cache = {}  # term id -> idf
+        self._norm_cache = {}  # doc number -> norm
+        self._cache_generation = 0
+
+    def __len__(self):
+        return len(self.doc_numbers)
+
+    def __contains__(self, doc_id):
+        return doc_id in self.doc_numbers
+
+    def doc_ids(self):
+        """Returns the ids of all indexed documents."""
+        return list(self.doc_numbers)
+
+    def add_document(self, doc_id, words):
+        """
+        Adds a document to the index, replacing any previous version with the same id.
+
+        Args:
+            doc_id: Identifier of the document (the stored filename).
+            words: List of preprocessed words of the document.
+        """
+        self.add_term_counts(doc_id, Counter(words), len(words), words)
+
+    def add_term_counts(self, doc_id, counts, total_words, words=None):
+        """
+        Adds a document given only its term counts (e.g. from a streaming tokenizer).
+
+        Args:
+            doc_id: Identifier of the document (the stored filename).
+            counts: Mapping of terms to their number of occurrences.
+            total_words: Total number of words in the document.
+            words: Optional full word list, passed on to listeners that need word order.
+        """
+        term_ids, term_counts = self.vocabulary.encode_counts(counts)
+        self.add_vector(doc_id, term_ids, term_counts, total_words, words)
+
+    def add_vector(self, doc_id, term_ids, term_counts, total_words, words=None):
+        """
+        Adds a document given as an already encoded term vector.
+
+        Args:
+            doc_id: Identifier of the document.
+            term_ids: array('I') of vocabulary ids, sorted ascending.
+            term_counts: array('I') of the matching term counts.
+            total_words: Total number of words in the document.
+            words: Optional full word list, passed on to listeners that need word order.
+        """
+        if doc_id in self.doc_numbers:
+            self.remove_document(doc_id)
+        self._grow_terms()
+
+        doc_number = len(self.doc_ids_by_number)
+        self.doc_numbers[doc_id] = doc_number
+        self.doc_ids_by_number.append(doc_id)
+        self.doc_vectors.append((term_ids, term_counts))
+        self.doc_lengths.append(total_words)
+
+        for term_id, count in zip(term_ids, term_counts):
+            doc_numbers, counts = self.postings[term_id]
+            doc_numbers.append(doc_number)
+            counts.append(count)
+            self.document_frequency[term_id] += 1
+        self.generation += 1
+
+        for listener in self.listeners:
+            listener.document_added(doc_id, term_ids, term_counts, total_words, words)
+
+    def _grow_terms(self):
+        # Give terms interned since the last call their (empty) per-term slots
+        missing = len(self.vocabulary) - len(self.postings)
+        if missing > 0:
+            self.postings.extend((array('I'), array('I')) for _ in range(missing))
+            self.dead_postings.extend([0] * missing)
+            self.document_frequency.extend([0] * missing)
+
+    def remove_document(self, doc_id):
+        """
+        Removes a document from the index.
+
+        Args:
+            doc_id: Identifier of the document to remove.
+
+        Returns:
+            bool: True if the document was indexed, False otherwise.
+        """
+        doc_number = self.doc_numbers.pop(doc_id, None)
+        if doc_number is None:
+            return False
+
+        term_ids, _ = self.doc_vectors[doc_number]
+        self.doc_vectors[doc_number] = None
+        self.doc_ids_by_number[doc_number] = None
+        for term_id in term_ids:
+            self.document_frequency[term_id] -= 1
+            self.dead_postings[term_id] += 1
+            if self.dead_postings[term_id] * 2 > len(self.postings[term_id][0]):
+                self._compact_postings(term_id)
+        self.generation += 1
+
+        for listener in self.listeners:
+            listener.document_removed(doc_id)
+        return True
+
+    def _compact_postings(self, term_id):
+        # Drop removed documents from a term's postings; paid for by the removals that left them behind
+        doc_vectors = self.doc_vectors
+        doc_numbers, counts = self.postings[term_id]
+        live = [(doc_number, count) for doc_number, count in zip(doc_numbers, counts)
+                if doc_vectors[doc_number] is not None]
+        self.postings[term_id] = (array('I', [doc_number for doc_number, _ in live]),
+                                  array('I', [count for _, count in live]))
+        self.dead_postings[term_id] = 0
+
+    def replace_document(self, doc_id, words):
+        """Replaces the indexed content of a document (alias for add_document)."""
+        self.add_document(doc_id, words)
+
+    def _check_cache(self):
+        # Any change to the corpus changes N (and possibly df), so every cached value is stale
+        if self._cache_generation != self.generation:
+            self._idf_cache = {}
+            self._norm_cache = {}
+            self._cache_generation = self.generation
+
+    def term_idf(self, term_id):
+        """Returns the inverse document frequency of a vocabulary id (0 if no document contains it)."""
+        self._check_cache()
+        value = self._idf_cache.get(term_id)
+        if value is None:
+            freq = self.document_frequency[term_id]
+            value = math.log(len(self.doc_numbers) / (freq + 1)) + 1 if freq else 0
+            self._idf_cache[term_id] = value
+        return value
+
+    def idf(self, term):
+        """
+        Returns the inverse document frequency of a term, using the same
+        formula as calculate_document_frequency. Unknown terms get 0.
+        """
+        term_id = self.vocabulary.get(term)
+        return self.term_idf(term_id) if term_id is not None else 0
+
+    def length(self, doc_id):
+        """Returns the number of words of an indexed document."""
+        return self.doc_lengths[self.doc_numbers[doc_id]]
+
+    def postings_bytes(self):
+        """Returns the bytes held by the postings arrays (doc numbers and counts, dead entries included)."""
+        return sum(numbers.itemsize * len(numbers) + counts.itemsize * len(counts)
+                   for numbers, counts in self.postings)
+
+    def document_vector(self, doc_id):
+        """Returns the (term ids, term counts) arrays of an indexed document."""
+        return self.doc_vectors[self.doc_numbers[doc_id]]
+
+    def term_counts(self, doc_id):
+        """Returns the term -> count dictionary of an indexed document."""
+        terms = self.vocabulary.terms
+        term_ids, counts = self.document_vector(doc_id)
+        return {terms[term_id]: count for term_id, count in zip(term_ids, counts)}
+
+    def term_frequencies(self, doc_id):
+        """Returns the term frequency dictionary of an indexed document."""
+        total_words = self.length(doc_id)
+        return {term: count / total_words for term, count in self.term_counts(doc_id).items()}
+
+    def vectorize(self, term_freq):
+        """Turns a term frequency dictionary into a TF-IDF vector against the current corpus."""
+        return {term: tf * self.idf(term) for term, tf in term_freq.items()}
+
+    def tfidf_vector(self, doc_id):
+        """
+        Returns the TF-IDF vector of an indexed document, or None if the
+        document is not in the index.
+        """
+        if doc_id not in self.doc_numbers:
+            return None
+        return self.vectorize(self.term_frequencies(doc_id))
+
+    def _doc_norm(self, doc_number):
+        self._check_cache()
+        value = self._norm_cache.get(doc_number)
+        if value is None:
+            total_words = self.doc_lengths[doc_number]
+            term_ids, counts = self.doc_vectors[doc_number]
+            value = math.sqrt(sum((count / total_words * self.term_idf(term_id)) ** 2
+                                  for term_id, count in zip(term_ids, counts)))
+            self._norm_cache[doc_number] = value
+        return value
+
+    def norm(self, doc_id):
+        """Returns the L2 norm of a document's TF-IDF vector (cached until the index changes)."""
+        return self._doc_norm(self.doc_numbers[doc_id])
+
+    def _query_terms(self, query_vector):
+        # (term id, weight) of the query terms that occur in at least one indexed document
+        vocabulary = self.vocabulary
+        query_terms = []
+        for term, query_weight in query_vector.items():
+            term_id = vocabulary.get(term)
+            if term_id is not None and query_weight and self.document_frequency[term_id]:
+                query_terms.append((term_id, query_weight))
+        return query_terms
+
+    def similarities(self, query_vector, exclude=None):
+        """
+        Scores a TF-IDF query vector against the corpus with cosine similarity.
+
+        Only the postings of the query terms are visited, so documents sharing no
+        term with the query are never touched (their similarity is 0).
+
+        Args:
+            query_vector: TF-IDF dictionary of the query document.
+            exclude: Optional doc_id to leave out (usually the query document itself).
+
+        Returns:
+            A dictionary mapping doc_ids to their cosine similarity with the query.
+        """
+        query_norm = math.sqrt(sum(weight * weight for weight in query_vector.values()))
+        if query_norm == 0:
+            return {}
+
+        doc_vectors = self.doc_vectors
+        doc_lengths = self.doc_lengths
+        dot_products = {}
+        for term_id, query_weight in self._query_terms(query_vector):
+            term_idf = self.term_idf(term_id)
+            doc_numbers, counts = self.postings[term_id]
+            for doc_number, count in zip(doc_numbers, counts):
+                if doc_vectors[doc_number] is None:
+                    continue
+                weight = query_weight * count / doc_lengths[doc_number] * term_idf
+                dot_products[doc_number] = dot_products.get(doc_number, 0) + weight
+
+        dot_products.pop(self.doc_numbers.get(exclude), None)
+
+        scores = {}
+        for doc_number, dot_product in dot_products.items():
+            doc_norm = self._doc_norm(doc_number)
+            scores[self.doc_ids_by_number[doc_number]] = dot_product / (query_norm * doc_norm) if doc_norm else 0
+        return scores
@@ -0,0 +1,454 @@
+"""
+Append-only segment store for the text of the corpus.
+
+Instead of one small file per document, document texts are appended as
+records to a few large segment files:
+
+    <folder>/000001.seg   records: header (flag, key length, data length, CRC32), key, data
+    <folder>/000001.idx   offset index of a sealed segment: the same headers, without the data
+
+Records are read through one mmap per segment, so get() returns a memoryview
+slice of the mapped file: re-indexing and snippets only touch the pages they
+need and never copy a whole file into Python memory first. A segment is
+sealed (and its offset index written) once it reaches the size limit; opening
+the store reads the small .idx files of sealed segments and scans only the
+active segment. Deleting a document appends a tombstone; compact() rewrites
+the live records of segments that are mostly dead and removes those files.
+
+Several processes may write to the same folder (app processes, the indexer).
+Every write holds an inter-process lock (fcntl on <folder>/LOCK) and first
+replays the records, sealed segments and compactions of the other writers, so
+a record is always appended at the real end of the file.
+
+The uploads folder stays the archive of the original files; the store holds
+the text they are indexed by (see sync_with_uploads).
+"""
+import mmap
+import os
+import struct
+import threading
+import zlib
+from contextlib import contextmanager
+
+from streaming_ingest import READ_CHUNK_SIZE
+
+try:
+    import fcntl
+except ImportError:  # Windows: no inter-process lock, so only one process may write to a folder
+    fcntl = None
+
+SEGMENT_MAX_BYTES = 64 * 1024 * 1024  # A segment is sealed once it grows past this size
+COMPACT_DEAD_RATIO = 0.5  # Sealed segments with at least this share of dead bytes are compacted
+
+RECORD_HEADER = struct.Struct('<BHII')  # flag, key length, data length, CRC32 of the data
+INDEX_ENTRY = struct.Struct('<BHQI')  # flag, key length, data offset, data length (followed by the key)
+PUT = 1
+DELETE = 2
+UNFINISHED = 0  # Flag of a record whose header is not written yet; readers stop there
+
+
+class SegmentStore:
+    """
+    Key -> bytes store made of append-only segment files (see the module docstring).
+
+    Args:
+        folder: Folder holding the segment files (created if missing).
+        segment_max_bytes: Size at which the active segment is sealed and a new one started.
+        read_only: Open for reading only (e.g. in worker processes while another process
+            writes): nothing is repaired or appended.
+    """
+
+    def __init__(self, folder, segment_max_bytes=SEGMENT_MAX_BYTES, read_only=False):
+        self.folder = folder
+        self.segment_max_bytes = segment_max_bytes
+        self.read_only = read_only
+        self.locations = {}  # key -> (segment number, data offset, data length) of its live record
+        self.segment_bytes = {}  # segment number -> bytes written
+        self.dead_bytes = {}  # segment number -> bytes of records superseded or deleted
+        self._tombstones = {}  # segment number -> keys deleted by a tombstone in that segment
+        self._maps = {}  # segment number -> (mmap, mapped length)
+        self._active = None  # Number of the segment appended to
+        self._active_entries = []  # Offset index entries of the active segment, written out when it is sealed
+        self._file = None  # Write handle of the active segment
+        self._lock_file = None  # Handle of <folder>/LOCK, locked by fcntl while this process writes
+        self._lock = threading.RLock()
+        if not read_only:
+            os.makedirs(folder, exist_ok=True)
+            self._lock_file = open(os.path.join(folder, 'LOCK'), 'ab')
+        with self._lock, self._folder_lock():
+            self._open()
+
+    def __len__(self):
+        return len(self.locations)
+
+    def __contains__(self, key):
+        return key in self.locations
+
+    def keys(self):
+        return list(self.locations)
+
+    def _path(self, number, extension):
+        return os.path.join(self.folder, f"{number:06d}.{extension}")
+
+    @contextmanager
+    def _folder_lock(self):
+        # Inter-process write lock; callers hold self._lock, so it is never taken twice by one process
+        if self._lock_file is None or fcntl is None:
+            yield
+            return
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    @contextmanager
+    def _writing(self):
+        # Held around every write: no other thread or process appends meanwhile, and their earlier writes are replayed
+        with self._lock, self._folder_lock():
+            self._catch_up(repair=True)
+            yield
+
+    def _segment_numbers(self):
+        try:
+            names = os.listdir(self.folder)
+        except FileNotFoundError:  # Only possible when read-only
+            names = []
+        return sorted(int(name[:-4]) for name in names if name.endswith('.seg') and name[:-4].isdigit())
+
+    def _open(self):
+        # Caller holds the folder lock when writing, so a torn record at the end is not a write in progress
+        numbers = self._segment_numbers()
+        for number in numbers:
+            entries = self._read_index(number) if number != numbers[-1] else None
+            if entries is None:
+                entries, end = self._scan_segment(number, repair=not self.read_only)
+                if number != numbers[-1] and not self.read_only:
+                    self._write_index(number, entries)  # Sealed without its index (e.g. a crash); write it now
+            else:
+                end = os.path.getsize(self._path(number, 'seg'))
+            self.segment_bytes[number] = end
+            self.dead_bytes.setdefault(number, 0)
+            for flag, key, offset, length in entries:
+                self._apply(number, flag, key, offset, length)
+
+        self._active = numbers[-1] if numbers else 1
+        self._active_entries = entries if numbers else []
+        self.segment_bytes.setdefault(self._active, 0)
+        self.dead_bytes.setdefault(self._active, 0)
+        self._open_active()
+
+    def _open_active(self):
+        if self.read_only:
+            return
+        if self._file is not None:
+            self._file.close()
+        path = self._path(self._active, 'seg')
+        open(path, 'ab').close()  # Created if missing; not opened for appending, so headers can be written last
+        self._file = open(path, 'r+b')
+
+    def _catch_up(self, repair=False):
+        """
+        Replays what other processes wrote since this store last looked: records appended to
+        the active segment, segments they sealed, and segments they compacted away.
+
+        Args:
+            repair: Truncate a torn record at the end of the active segment (only with the folder lock held).
+        """
+        numbers = set(self._segment_numbers())
+        while True:
+            # Segments after the active one are numbered in order, with gaps where one was compacted away since
+            newer = [number for number in numbers if number > self._active]
+            entries, end = self._scan_segment(self._active, self.segment_bytes[self._active],
+                                              repair=repair and not newer)
+            self.segment_bytes[self._active] = end
+            for flag, key, offset, length in entries:
+                self._apply(self._active, flag, key, offset, length)
+            self._active_entries.extend(entries)
+            if not newer:
+                break
+            # Sealed (and its offset index written) by another process
+            self._active = min(newer)
+            self._active_entries = []
+            self.segment_bytes.setdefault(self._active, 0)
+            self.dead_bytes.setdefault(self._active, 0)
+            self._open_active()
+        for number in [number for number in self.segment_bytes if number < self._active and number not in numbers]:
+            # Compacted by another process: its live records were rewritten to a newer segment, replayed above
+            del self.segment_bytes[number]
+            self.dead_bytes.pop(number, None)
+            self._tombstones.pop(number, None)
+            self._maps.pop(number, None)
+
+    def _apply(self, number, flag, key, offset, length):
+        # Replays one record in order: the newest record of a key wins
+        old = self.locations.pop(key, None)
+        if old is not None:
+            self.dead_bytes[old[0]] = self.dead_bytes.get(old[0], 0) + old[2] + RECORD_HEADER.size + len(key.encode('utf-8'))
+        if flag == PUT:
+            self.locations[key] = (number, offset, length)
+        else:
+            self._tombstones.setdefault(number, set()).add(key)
+            self.dead_bytes[number] = self.dead_bytes.get(number, 0) + RECORD_HEADER.size + len(key.encode('utf-8'))
+
+    def _scan_segment(self, number, start=0, repair=False):
+        """
+        Reads the record headers of a segment from offset start.
+
+        Returns:
+            A tuple (entries, end): the records found and the offset after the last complete one.
+            With repair, a torn record after it (left by a crash) is truncated.
+        """
+        path = self._path(number, 'seg')
+        entries = []
+        try:
+            size = os.path.getsize(path)
+        except FileNotFoundError:  # A read-only store of a segment not created yet
+            return entries, start
+        if size <= start:
+            return entries, start
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as data:
+            view = memoryview(data)
+            position = start
+            try:
+                while position + RECORD_HEADER.size <= size:
+                    flag, key_length, data_length, checksum = RECORD_HEADER.unpack_from(data, position)
+                    key_start = position + RECORD_HEADER.size
+                    data_start = key_start + key_length
+                    end = data_start + data_length
+                    if flag not in (PUT, DELETE) or end > size or zlib.crc32(view[data_start:end]) != checksum:
+                        break
+                    entries.append((flag, bytes(view[key_start:data_start]).decode('utf-8'), data_start, data_length))
+                    position = end
+            finally:
+                view.release()
+        if position < size and repair:
+            # Left by a write interrupted by a crash; everything before it is intact
+            print(f"Truncating {size - position} bytes of an incomplete record in {path}")
+            with open(path, 'r+b') as f:
+                f.truncate(position)
+        return entries, position
+
+    def _read_index(self, number):
+        path = self._path(number, 'idx')
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        entries = []
+        position = 0
+        try:
+            while position < len(data):
+                flag, key_length, offset, length = INDEX_ENTRY.unpack_from(data, position)
+                position += INDEX_ENTRY.size
+                entries.append((flag, data[position:position + key_length].decode('utf-8'), offset, length))
+                position += key_length
+        except (struct.error, UnicodeDecodeError) as e:
+            print(f"Offset index {path} is damaged, rescanning its segment: {e}")
+            return None
+        return entries
+
+    def _write_index(self, number, entries):
+        path = self._path(number, 'idx')
+        with open(path + '.tmp', 'wb') as f:
+            for flag, key, offset, length in entries:
+                encoded = key.encode('utf-8')
+                f.write(INDEX_ENTRY.pack(flag, len(encoded), offset, length))
+                f.write(encoded)
+        os.replace(path + '.tmp', path)
+
+    def _append(self, flag, key, chunks=()):
+        # Caller holds _writing(). The header goes in last, once the length and CRC of the chunks are known
+        if self.read_only:
+            raise ValueError(f"Segment store {self.folder} is open read-only")
+        encoded = key.encode('utf-8')
+        self._file.seek(0, os.SEEK_END)
+        start = self._file.tell()
+        self._file.write(RECORD_HEADER.pack(UNFINISHED, 0, 0, 0) + encoded)
+        length = checksum = 0
+        for chunk in chunks:
+            self._file.write(chunk)
+            length += len(chunk)
+            checksum = zlib.crc32(chunk, checksum)
+        self._file.seek(start)
+        self._file.write(RECORD_HEADER.pack(flag, len(encoded), length, checksum))
+        self._file.flush()
+        offset = start + RECORD_HEADER.size + len(encoded)
+        self.segment_bytes[self._active] = offset + length
+        self._apply(self._active, flag, key, offset, length)
+        self._active_entries.append((flag, key, offset, length))
+        if self.segment_bytes[self._active] >= self.segment_max_bytes:
+            self._seal()
+
+    def _seal(self):
+        # The offset index of the full segment is written from the records it holds
+        self._write_index(self._active, self._active_entries)
+        self._active += 1
+        self._active_entries = []
+        self.segment_bytes[self._active] = 0
+        self.dead_bytes[self._active] = 0
+        self._open_active()
+
+    def put(self, key, data):
+        """Stores the data of a key (bytes-like), replacing any earlier version."""
+        with self._writing():
+            self._append(PUT, key, (data,))
+
+    def put_file(self, key, path):
+        """Stores the content of a file under key, copied in READ_CHUNK_SIZE chunks."""
+        with open(path, 'rb') as f, self._writing():
+            self._append(PUT, key, iter(lambda: f.read(READ_CHUNK_SIZE), b''))
+
+    def delete(self, key):
+        """Removes a key; its bytes are reclaimed by the next compaction of its segment."""
+        with self._writing():
+            if key in self.locations:
+                self._append(DELETE, key)
+
+    def _view(self, number, offset, length):
+        mapped = self._maps.get(number)
+        if mapped is None or offset + length > mapped[1]:
+            with self._lock:
+                mapped = self._maps.get(number)
+                if mapped is None or offset + length > mapped[1]:
+                    # The active segment grows: map it again to see the new records
+                    with open(self._path(number, 'seg'), 'rb') as f:
+                        size = os.fstat(f.fileno()).st_size
+                        mapped = (mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ), size)
+                    self._maps[number] = mapped  # The old map is released once no view uses it
+        return memoryview(mapped[0])[offset:offset + length]
+
+    def get(self, key):
+        """
+        Returns the data of a key as a read-only memoryview of the mapped segment, or None.
+
+        The view stays valid after the record is deleted or compacted away. A key this
+        store does not know, or whose segment another process compacted away, is looked
+        up again after replaying the other writers' records.
+        """
+        with self._lock:
+            for attempt in range(2):
+                if attempt:
+                    self._catch_up()
+                location = self.locations.get(key)
+                if location is None:
+                    continue
+                number, offset, length = location
+                if length == 0:
+                    return memoryview(b'')
+                try:
+                    return self._view(number, offset, length)
+                except FileNotFoundError:
+                    continue
+            return None
+
+    def head(self, key, size):
+        """Returns the first size bytes of a key's data (a view, as get())."""
+        view = self.get(key)
+        return view[:size] if view is not None else None
+
+    def location(self, key):
+        """Returns (segment number, data offset) of a key's live record, which changes whenever the key is rewritten."""
+        location = self.locations.get(key)
+        return location[:2] if location is not None else None
+
+    def compact(self, min_dead_ratio=COMPACT_DEAD_RATIO):
+        """
+        Rewrites the live records of sealed segments whose dead share reached min_dead_ratio
+        into the active segment and deletes those segments.
+
+        Returns:
+            The number of segments removed.
+        """
+        removed = 0
+        if self.read_only:
+            return removed
+        with self._writing():
+            candidates = [number for number in sorted(self.segment_bytes)
+                          if number != self._active and self.segment_bytes[number]
+                          and self.dead_bytes.get(number, 0) / self.segment_bytes[number] >= min_dead_ratio]
+        for number in candidates:
+            with self._writing():
+                if number not in self.segment_bytes:  # Compacted by another process meanwhile
+                    continue
+                live = [(key, location) for key, location in self.locations.items() if location[0] == number]
+                for key, (_, offset, length) in live:
+                    view = self._view(number, offset, length) if length else memoryview(b'')
+                    self._append(PUT, key, (view[start:start + READ_CHUNK_SIZE]
+                                            for start in range(0, length, READ_CHUNK_SIZE)))
+                # A tombstone must survive as long as an older segment may still hold the record it deletes
+                if any(older < number for older in self.segment_bytes):
+                    for key in self._tombstones.get(number, ()):
+                        if key not in self.locations:
+                            self._append(DELETE, key)
+                self._tombstones.pop(number, None)
+                del self.segment_bytes[number]
+                self.dead_bytes.pop(number, None)
+                self._maps.pop(number, None)  # Views handed out earlier keep their map alive
+                for extension in ('seg', 'idx'):
+                    try:
+                        os.remove(self._path(number, extension))
+                    except FileNotFoundError:
+                        pass
+                removed += 1
+        return removed
+
+    def stats(self):
+        with self._lock:
+            total = sum(self.segment_bytes.values())
+            dead = sum(self.dead_bytes.values())
+            return {
+                'documents': len(self.locations),
+                'segments': len(self.segment_bytes),
+                'bytes': total,
+                'dead_bytes': dead,
+                'dead_ratio': round(dead / total, 4) if total else 0.0,
+            }
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            if self._lock_file is not None:
+                self._lock_file.close()
+                self._lock_file = None
+
+
+def sync_with_uploads(store, upload_folder, text_path):
+    """
+    Brings the store in line with the uploads folder from a single directory listing.
+
+    Uploads not in the store yet (e.g. copied in by hand, or stored before the
+    store existed) are imported, and keys whose upload is gone are deleted. Uploads
+    are named after their content hash and never rewritten in place, so a file
+    edited in place is not noticed; delete and re-add it instead.
+
+    Args:
+        store: The SegmentStore, keyed by upload filename.
+        upload_folder: Folder holding the original uploads.
+        text_path: Callable returning the path of the text an upload is indexed by, or None.
+
+    Returns:
+        A tuple (imported, deleted) with the number of keys added and removed.
+    """
+    os.makedirs(upload_folder, exist_ok=True)
+    filenames = set(os.listdir(upload_folder))
+    imported = deleted = 0
+    for filename in sorted(filenames):
+        if filename in store:
+            continue
+        path = text_path(filename)
+        if path is None or not os.path.isfile(path):
+            continue
+        try:
+            store.put_file(filename, path)
+            imported += 1
+        except OSError as e:
+            print(f"Error reading {filename}: {e}")
+    for key in store.keys():
+        if key not in filenames:
+            store.delete(key)
+            deleted += 1
+    return imported, deleted
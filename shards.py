@@ -0,0 +1,571 @@
+"""
+Sharded similarity search with scatter-gather across shard server processes.
+
+The corpus is partitioned into N shards by a hash of the document id. Every
+shard is an InvertedIndex of its own documents, held by a shard server process
+that answers over a multiprocessing connection (a Unix socket, or host:port so
+a shard can run on another machine). The ShardCoordinator in the web process
+listens to the document index like the other indexes do and routes every added
+or removed document to its shard. A query is sent to all shards at once; each
+one answers with its own top k (from a SimilarityEngine over the shard), and
+the coordinator merges them into the global top k.
+
+Cosine similarity needs corpus-wide IDF, so the shards do not use their local
+document frequencies: every update answers with the df changes it caused, the
+coordinator sums them into the global df table, and the changed entries are
+sent to all shards together with the next query. A shard therefore scores with
+exactly the IDF of the unsharded index.
+
+Usage (a shard server on its own, e.g. on another host):
+    SEARCH_SHARD_AUTHKEY=secret python -m shards serve --address 10.0.0.5:7100 \\
+        [--shard 0 --shards 4 --corpus corpus_segments]
+
+With --corpus, the server first loads its partition from a copy of the corpus
+store; the web app then only sends the documents that differ. One web process
+feeds a set of shard servers: the global df table lives in its coordinator.
+"""
+import argparse
+import heapq
+import math
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from array import array
+from collections import Counter
+from itertools import chain
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+
+import numpy as np
+
+from search_index import InvertedIndex
+from similarity_engine import SimilarityEngine
+from segment_store import SegmentStore
+from streaming_ingest import StreamingTokenizer, READ_CHUNK_SIZE
+
+UPDATE_BATCH = 1000  # Document updates buffered per shard before they are sent without waiting for a query
+CONNECT_TIMEOUT = 10.0  # Seconds to wait for a newly started shard server to accept connections
+RECONNECT_INTERVAL = 30.0  # Seconds between attempts to reconnect to failed shard servers
+
+
+class ShardError(Exception):
+    """Raised when a shard server cannot be reached or fails a request."""
+
+
+def shard_of(doc_id, shards):
+    """Returns the shard number a document belongs to (stable across processes and restarts)."""
+    return zlib.crc32(doc_id.encode('utf-8')) % shards
+
+
+def parse_address(address):
+    """Turns 'host:port' into a (host, port) tuple; anything else is a Unix socket path."""
+    host, _, port = address.rpartition(':')
+    if host and port.isdigit() and os.sep not in address:
+        return host, int(port)
+    return address
+
+
+class ShardIndex(InvertedIndex):
+    """
+    InvertedIndex of one shard, scoring with corpus-wide document frequencies.
+
+    Local document frequencies are still maintained (the postings need them);
+    set_global_stats() provides the df of every term across all shards and the
+    corpus size used for IDF instead. The df changes of every
+    update are collected until the coordinator takes them.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.global_documents = 0  # Documents in the whole corpus
+        self.global_frequency = array('I')  # term id -> df across all shards (0: not known yet)
+        self.frequency_changes = Counter()  # term -> change of its local df since take_frequency_changes()
+
+    def add_vector(self, doc_id, term_ids, term_counts, total_words, words=None):
+        super().add_vector(doc_id, term_ids, term_counts, total_words, words)
+        terms = self.vocabulary.terms
+        for term_id in term_ids:
+            self.frequency_changes[terms[term_id]] += 1
+
+    def remove_document(self, doc_id):
+        doc_number = self.doc_numbers.get(doc_id)
+        if doc_number is None:
+            return False
+        term_ids, _ = self.doc_vectors[doc_number]
+        super().remove_document(doc_id)
+        terms = self.vocabulary.terms
+        for term_id in term_ids:
+            self.frequency_changes[terms[term_id]] -= 1
+        return True
+
+    def take_frequency_changes(self):
+        """Returns the local df changes since the last call (term -> delta) and starts over."""
+        changes = {term: delta for term, delta in self.frequency_changes.items() if delta}
+        self.frequency_changes = Counter()
+        return changes
+
+    def set_global_stats(self, documents, frequencies):
+        """
+        Updates the corpus-wide statistics used for IDF.
+
+        Args:
+            documents: Number of documents in the whole corpus.
+            frequencies: term -> global df, for the terms whose df changed (others keep their value).
+        """
+        vocabulary = self.vocabulary
+        global_frequency = self.global_frequency
+        global_frequency.extend([0] * (len(vocabulary) - len(global_frequency)))
+        for term, frequency in frequencies.items():
+            term_id = vocabulary.get(term)
+            if term_id is not None:  # Terms this shard never saw cannot match here
+                global_frequency[term_id] = frequency
+        self.global_documents = documents
+        self.generation += 1  # Every cached IDF and norm is stale
+
+    def corpus_documents(self):
+        """Returns the corpus size used for IDF: until the first exchange (or if it lags behind), at least the shard itself."""
+        return max(self.global_documents, len(self.doc_numbers))
+
+    def term_idf(self, term_id):
+        self._check_cache()
+        value = self._idf_cache.get(term_id)
+        if value is None:
+            if self.document_frequency[term_id]:
+                known = self.global_frequency[term_id] if term_id < len(self.global_frequency) else 0
+                frequency = max(known, self.document_frequency[term_id])
+                value = math.log(self.corpus_documents() / (frequency + 1)) + 1
+            else:
+                value = 0
+            self._idf_cache[term_id] = value
+        return value
+
+    def frequency_vector(self):
+        """Returns the df used for IDF of every vocabulary id as a NumPy array (global, or local if larger)."""
+        local = np.frombuffer(self.document_frequency, dtype=np.uint32).astype(np.float64)
+        known = np.zeros(len(local))
+        known[:len(self.global_frequency)] = np.frombuffer(self.global_frequency, dtype=np.uint32)[:len(local)]
+        return np.where(local > 0, np.maximum(known, local), 0.0)
+
+    def document_frequencies(self):
+        """Returns term -> local df of every term present in the shard."""
+        terms = self.vocabulary.terms
+        return {terms[term_id]: frequency for term_id, frequency in enumerate(self.document_frequency) if frequency}
+
+
+class ShardSimilarityEngine(SimilarityEngine):
+    """SimilarityEngine over a ShardIndex, with the same corpus-wide IDF as ShardIndex.term_idf."""
+
+    def document_frequencies(self):
+        return self.index.frequency_vector()
+
+    def corpus_size(self):
+        return self.index.corpus_documents()
+
+
+class ShardServer:
+    """
+    Answers the coordinator's requests for one ShardIndex.
+
+    A request is a (command, arguments) tuple; the reply is ('ok', result) or
+    ('error', message). Connections are served on their own threads, and the
+    index is only touched under one lock. Like the web app, queries are scored
+    with the SimilarityEngine, whose norms follow the IDF moved by every set_global.
+    """
+
+    COMMANDS = {'update', 'doc_ids', 'stats', 'set_global', 'top_k'}
+
+    def __init__(self, index=None):
+        self.index = index if index is not None else ShardIndex()
+        self.engine = ShardSimilarityEngine(self.index)  # Kept in sync through its listener hook
+        self._lock = threading.Lock()
+
+    def handle(self, command, arguments):
+        if command not in self.COMMANDS:
+            raise ValueError(f"Unknown shard command: {command}")
+        with self._lock:
+            return getattr(self, f"_{command}")(*arguments)
+
+    def _update(self, operations):
+        # ('add', doc_id, term counts, total words) or ('remove', doc_id), applied in order
+        for operation in operations:
+            if operation[0] == 'add':
+                self.index.add_term_counts(operation[1], operation[2], operation[3])
+            else:
+                self.index.remove_document(operation[1])
+        return len(self.index), self.index.take_frequency_changes()
+
+    def _doc_ids(self):
+        return self.index.doc_ids()
+
+    def _stats(self):
+        # A full df table replaces any pending changes
+        self.index.take_frequency_changes()
+        return len(self.index), self.index.document_frequencies()
+
+    def _set_global(self, documents, frequencies):
+        self.index.set_global_stats(documents, frequencies)
+
+    def _top_k(self, query_vectors, k, min_score, exclude):
+        return self.engine.query_batch(query_vectors, k=k, exclude=exclude, min_score=min_score)
+
+    def serve_connection(self, connection):
+        with connection:
+            while True:
+                try:
+                    command, arguments = connection.recv()
+                except (EOFError, OSError):
+                    return  # The coordinator went away
+                try:
+                    reply = ('ok', self.handle(command, arguments))
+                except Exception as e:
+                    reply = ('error', f"{type(e).__name__}: {e}")
+                try:
+                    connection.send(reply)
+                except OSError:
+                    return
+
+
+def load_partition(index, corpus_folder, shard, shards):
+    """Adds the documents of one shard from a corpus store to a ShardIndex; returns their number."""
+    store = SegmentStore(corpus_folder, read_only=True)
+    loaded = 0
+    for doc_id in store.keys():
+        if shard_of(doc_id, shards) != shard:
+            continue
+        view = store.get(doc_id)
+        tokenizer = StreamingTokenizer(keep_limit=0)
+        for start in range(0, len(view), READ_CHUNK_SIZE):
+            tokenizer.feed(view[start:start + READ_CHUNK_SIZE])
+        tokenizer.close()
+        if tokenizer.error is not None:
+            print(f"Error reading {doc_id}: {tokenizer.error}", file=sys.stderr)
+            continue
+        index.add_term_counts(doc_id, tokenizer.term_counts, tokenizer.total_words)
+        loaded += 1
+    index.take_frequency_changes()  # The coordinator asks for the full table when it connects
+    return loaded
+
+
+def serve(address, authkey, server=None):
+    """Runs a shard server on address until the process is stopped."""
+    server = server if server is not None else ShardServer()
+    with Listener(parse_address(address), authkey=authkey) as listener:
+        while True:
+            try:
+                connection = listener.accept()
+            except (OSError, EOFError, AuthenticationError) as e:
+                print(f"Shard server could not accept a connection: {e}", file=sys.stderr)
+                continue
+            threading.Thread(target=server.serve_connection, args=(connection,), daemon=True).start()
+
+
+class ShardCoordinator:
+    """
+    Scatter-gather search over shard servers, kept in sync with an InvertedIndex.
+
+    Without addresses, one local shard server process per shard is started on
+    a Unix socket. The coordinator registers itself as a listener of the index:
+    document changes are buffered per shard and sent before the next query (or
+    once UPDATE_BATCH of them are pending). If a shard fails, all connections
+    are dropped and the next query reconnects (restarting dead local servers)
+    and re-syncs the shards; until then queries raise ShardError.
+
+    Args:
+        index: The InvertedIndex whose documents are searched.
+        shards: Number of local shards to start (ignored when addresses are given).
+        addresses: Optional list of shard server addresses ('host:port' or a socket path), one per shard.
+        authkey: Key shared with the shard servers, as bytes (random for local ones).
+    """
+
+    def __init__(self, index, shards=2, addresses=None, authkey=None):
+        self.index = index
+        self.authkey = authkey or os.urandom(32).hex().encode('ascii')
+        self._processes = []
+        self._socket_folder = None
+        if not addresses:
+            self._socket_folder = tempfile.mkdtemp(prefix='docscan-shards-')
+            addresses = [os.path.join(self._socket_folder, f"shard{shard}.sock") for shard in range(shards)]
+            self._processes = [self._start_local_server(address) for address in addresses]
+        self.addresses = list(addresses)
+        self.shards = len(self.addresses)
+        self.global_frequency = Counter()  # term -> df across all shards
+        self._shard_documents = [0] * self.shards
+        self._changed_terms = set()  # Terms whose global df the shards have not been sent yet
+        self._stats_changed = True
+        self._pending = [[] for _ in range(self.shards)]  # Buffered update operations per shard
+        self._pending_count = 0
+        self._connections = None  # None while disconnected
+        self._retry_at = 0.0
+        self._lock = threading.RLock()
+        try:
+            with self._lock:
+                self._connections = [self._connect(shard) for shard in range(self.shards)]
+                self.sync()
+        except ShardError:
+            self.close()
+            raise
+        index.listeners.append(self)
+
+    def _start_local_server(self, address):
+        environment = dict(os.environ, SEARCH_SHARD_AUTHKEY=self.authkey.decode('ascii'))
+        module_folder = os.path.dirname(os.path.abspath(__file__))
+        environment['PYTHONPATH'] = os.pathsep.join(filter(None, [module_folder, environment.get('PYTHONPATH')]))
+        if os.path.exists(address):
+            os.remove(address)  # Left by a server that died
+        return subprocess.Popen([sys.executable, '-m', 'shards', 'serve', '--address', address], env=environment)
+
+    def _connect(self, shard):
+        address = self.addresses[shard]
+        process = self._processes[shard] if self._processes else None
+        if process is not None and process.poll() is not None:
+            print(f"Shard server {shard} exited with status {process.returncode}, restarting it")
+            process = self._processes[shard] = self._start_local_server(address)
+        deadline = time.monotonic() + CONNECT_TIMEOUT
+        while True:
+            try:
+                return Client(parse_address(address), authkey=self.authkey)
+            except AuthenticationError as e:
+                raise ShardError(f"Shard server {address} rejected the key: {e}")
+            except (OSError, EOFError) as e:
+                if process is not None and process.poll() is not None:
+                    raise ShardError(f"Shard server for {address} exited with status {process.returncode}")
+                if time.monotonic() > deadline:
+                    raise ShardError(f"Cannot connect to shard server {address}: {e}")
+                time.sleep(0.05)
+
+    def _disconnect(self):
+        # A failed exchange may leave replies unread, so no connection can be trusted afterwards
+        for connection in self._connections or ():
+            connection.close()
+        self._connections = None
+        self._retry_at = time.monotonic() + RECONNECT_INTERVAL
+
+    def _ensure_connected(self):
+        if self._connections is not None:
+            return
+        if time.monotonic() < self._retry_at:
+            raise ShardError("Shard servers unavailable")
+        try:
+            self._connections = [self._connect(shard) for shard in range(self.shards)]
+            self.sync()
+        except ShardError:
+            self._disconnect()
+            raise
+
+    def _exchange(self, requests):
+        """
+        Sends every shard its list of requests, then collects all replies.
+
+        Requests go out to all shards before any reply is read, so the shards work in parallel.
+
+        Returns:
+            One list of results per shard, in request order.
+        """
+        try:
+            for connection, shard_requests in zip(self._connections, requests):
+                for request in shard_requests:
+                    connection.send(request)
+            replies = [[connection.recv() for _ in shard_requests]
+                       for connection, shard_requests in zip(self._connections, requests)]
+        except (OSError, EOFError) as e:
+            self._disconnect()
+            raise ShardError(f"Shard server connection failed: {e}")
+        results = []
+        for shard, shard_replies in enumerate(replies):
+            for status, value in shard_replies:
+                if status != 'ok':
+                    self._disconnect()  # The shard may have applied only part of an update
+                    raise ShardError(f"Shard {shard} failed: {value}")
+            results.append([value for _, value in shard_replies])
+        return results
+
+    def _apply_frequency_changes(self, shard, documents, changes):
+        self._shard_documents[shard] = documents
+        global_frequency = self.global_frequency
+        for term, delta in changes.items():
+            frequency = global_frequency[term] + delta
+            if frequency > 0:
+                global_frequency[term] = frequency
+            else:
+                del global_frequency[term]
+            self._changed_terms.add(term)
+        self._stats_changed = True
+
+    def sync(self):
+        """
+        Brings the shards in line with the index and rebuilds the global df table from their full tables.
+
+        Shards that already hold documents (e.g. loaded from a corpus store) only get the differences.
+        """
+        with self._lock:
+            self._pending = [[] for _ in range(self.shards)]  # Superseded by the differences found below
+            self._pending_count = 0
+            on_shards = self._exchange([[('doc_ids', ()), ('stats', ())] for _ in range(self.shards)])
+            self.global_frequency = Counter()
+            for shard, (doc_ids, (documents, frequencies)) in enumerate(on_shards):
+                self._shard_documents[shard] = documents
+                self.global_frequency.update(frequencies)
+            present = []
+            for shard, (doc_ids, _) in enumerate(on_shards):
+                for doc_id in doc_ids:
+                    if doc_id not in self.index or shard_of(doc_id, self.shards) != shard:
+                        self._queue(shard, ('remove', doc_id))
+                present.append(set(doc_ids))
+            for doc_id in self.index.doc_ids():
+                shard = shard_of(doc_id, self.shards)
+                if doc_id not in present[shard]:
+                    self._queue_add(doc_id, *self.index.document_vector(doc_id), self.index.length(doc_id))
+                if self._pending_count >= UPDATE_BATCH:
+                    self._send_updates()
+            self._changed_terms = set(self.global_frequency)
+            self._stats_changed = True
+            self._send_updates()
+
+    def _queue(self, shard, operation):
+        self._pending[shard].append(operation)
+        self._pending_count += 1
+
+    def _queue_add(self, doc_id, term_ids, term_counts, total_words):
+        terms = self.index.vocabulary.terms
+        counts = {terms[term_id]: count for term_id, count in zip(term_ids, term_counts)}
+        self._queue(shard_of(doc_id, self.shards), ('add', doc_id, counts, total_words))
+
+    def _send_updates(self):
+        if not self._pending_count:
+            return
+        pending, self._pending = self._pending, [[] for _ in range(self.shards)]
+        self._pending_count = 0
+        replies = self._exchange([[('update', (operations,))] if operations else [] for operations in pending])
+        for shard, shard_replies in enumerate(replies):
+            for documents, changes in shard_replies:
+                self._apply_frequency_changes(shard, documents, changes)
+
+    def _global_stats_request(self):
+        # The global df of terms changed since the last query, or None if nothing changed
+        if not self._stats_changed:
+            return None
+        frequencies = {term: self.global_frequency.get(term, 0) for term in self._changed_terms}
+        self._changed_terms = set()
+        self._stats_changed = False
+        return ('set_global', (sum(self._shard_documents), frequencies))
+
+    # Listener hooks of InvertedIndex; they never fail an ingest
+    def document_added(self, doc_id, term_ids, counts, total_words, words):
+        with self._lock:
+            if self._connections is None:
+                return  # The re-sync after reconnecting picks it up
+            self._queue_add(doc_id, term_ids, counts, total_words)
+            self._send_if_full()
+
+    def document_removed(self, doc_id):
+        with self._lock:
+            if self._connections is None:
+                return
+            self._queue(shard_of(doc_id, self.shards), ('remove', doc_id))
+            self._send_if_full()
+
+    def _send_if_full(self):
+        if self._pending_count >= UPDATE_BATCH:
+            try:
+                self._send_updates()
+            except ShardError as e:
+                print(f"Error updating search shards: {e}")
+
+    def top_k_batch(self, query_vectors, k, min_score=0.0, exclude=None):
+        """
+        Finds the k best matches of every query vector across all shards.
+
+        Args:
+            query_vectors: List of TF-IDF dictionaries.
+            k: Maximum number of results per query.
+            min_score: Only documents scoring strictly above this are returned.
+            exclude: Optional list (parallel to query_vectors) of doc_ids to leave out.
+
+        Returns:
+            A list with one result list of (doc_id, similarity) tuples per query, best match first.
+
+        Raises:
+            ShardError: A shard server could not be reached or failed.
+        """
+        if not query_vectors:
+            return []
+        exclude = exclude or [None] * len(query_vectors)
+        with self._lock:
+            self._ensure_connected()
+            self._send_updates()
+            stats_request = self._global_stats_request()
+            query = ('top_k', (query_vectors, k, min_score, exclude))
+            requests = [[stats_request, query] if stats_request else [query] for _ in range(self.shards)]
+            shard_results = [replies[-1] for replies in self._exchange(requests)]
+        # Each shard's list is its own top k, so the global top k is among them
+        return [heapq.nlargest(k, chain.from_iterable(results[number] for results in shard_results),
+                               key=lambda match: match[1])
+                for number in range(len(query_vectors))]
+
+    def top_k(self, query_vector, k, min_score=0.0, exclude=None):
+        """Finds the k best matches of one query vector across all shards (see top_k_batch)."""
+        return self.top_k_batch([query_vector], k, min_score=min_score, exclude=[exclude])[0]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'shards': self.shards,
+                'addresses': self.addresses,
+                'connected': self._connections is not None,
+                'documents': list(self._shard_documents),
+                'pending_updates': self._pending_count,
+                'terms': len(self.global_frequency),
+            }
+
+    def close(self):
+        """Closes the connections and stops the local shard servers."""
+        with self._lock:
+            for connection in self._connections or ():
+                connection.close()
+            self._connections = None
+            for process in self._processes:
+                process.terminate()
+            for process in self._processes:
+                try:
+                    process.wait(timeout=5)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+            self._processes = []
+            if self._socket_folder is not None:
+                shutil.rmtree(self._socket_folder, ignore_errors=True)
+                self._socket_folder = None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m shards', description='Similarity search shard server.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    command = commands.add_parser('serve', help='serve one shard (key from the SEARCH_SHARD_AUTHKEY environment variable)')
+    command.add_argument('--address', required=True, help='host:port or Unix socket path to listen on')
+    command.add_argument('--shard', type=int, help='shard number, to load its documents from --corpus')
+    command.add_argument('--shards', type=int, help='total number of shards')
+    command.add_argument('--corpus', help='corpus store folder to load the shard from')
+    args = parser.parse_args(argv)
+
+    authkey = os.environ.get('SEARCH_SHARD_AUTHKEY')
+    if not authkey:
+        parser.error('SEARCH_SHARD_AUTHKEY must be set')
+
+    server = ShardServer()
+    if args.corpus:
+        if args.shard is None or not args.shards:
+            parser.error('--corpus needs --shard and --shards')
+        loaded = load_partition(server.index, args.corpus, args.shard, args.shards)
+        print(f"Loaded {loaded} documents of shard {args.shard}/{args.shards}", file=sys.stderr)
+    try:
+        serve(args.address, authkey.encode('utf-8'), server)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,281 @@
+import math
+
+import numpy as np
+from scipy import sparse
+
+
+class SimilarityEngine:
+    """
+    Vectorized cosine similarity over the documents of an InvertedIndex.
+
+    The corpus is kept as a sparse matrix of term frequencies (one row per document,
+    one column per vocabulary id of the index). IDF weights and the per-row L2 normalization
+    are applied as vectors at query time, because both move with every ingest;
+    scoring one query against the whole corpus is therefore a single sparse
+    mat-vec and scoring many queries a single sparse mat-mat. The main matrix is
+    stored by column, so a query only reads the columns of its own terms.
+
+    New documents are collected in a small delta matrix that is folded into the
+    main matrix once it holds merge_threshold rows, so an ingest never has to
+    copy the whole corpus. The merge also drops the rows of removed and replaced
+    documents (it runs early once merge_threshold of them have piled up).
+
+    Row norms are not recomputed when the IDF moves. With idf = a - b, where
+    a = log N + 1 and b = log(df + 1), a row's squared norm is
+    a^2 * sum(tf^2) - 2a * sum(tf^2 * b) + sum(tf^2 * b^2); the three sums are
+    kept per row of the main matrix, and only the rows containing a term whose df
+    changed are updated.
+    """
+
+    def __init__(self, index, merge_threshold=1024):
+        self.index = index
+        self.merge_threshold = merge_threshold
+        self.row_doc_ids = []  # row number -> doc_id
+        self.doc_rows = {}  # doc_id -> row number of its live row
+        self._alive = np.zeros(0, dtype=bool)  # row number -> row is live (grown by doubling, may be longer)
+        self._dead = 0  # Rows of removed or replaced documents not dropped yet
+        self._matrix = sparse.csc_matrix((0, 0), dtype=np.float64)
+        self._pending_rows = []  # (term ids, term frequencies) of rows not yet in a matrix
+        self._delta = None
+        self._norm_sums = np.zeros((3, 0))  # sum(tf^2), sum(tf^2 * b), sum(tf^2 * b^2) of every main matrix row
+        self._norm_df = np.zeros(0)  # column -> df the norm sums were computed with
+        self._build()
+        index.listeners.append(self)
+
+    def __len__(self):
+        return len(self.doc_rows)
+
+    def _build(self):
+        # Build the main matrix from everything currently in the index
+        index = self.index
+        indptr, indices, data = [0], [], []
+        for doc_id in index.doc_ids():
+            term_ids, frequencies = self._row(*index.document_vector(doc_id), index.length(doc_id))
+            indices.append(term_ids)
+            data.append(frequencies)
+            indptr.append(indptr[-1] + len(term_ids))
+            self.doc_rows[doc_id] = len(self.row_doc_ids)
+            self.row_doc_ids.append(doc_id)
+
+        self._alive = np.ones(len(self.row_doc_ids), dtype=bool)
+        self._matrix = self._csr(indptr, indices, data).tocsc()
+        self._reset_norm_sums(self.document_frequencies())
+
+    def _columns(self):
+        return len(self.index.vocabulary)
+
+    def _csr(self, indptr, indices, data):
+        # Stack per-row (term ids, frequencies) arrays into a CSR matrix over the whole vocabulary
+        return sparse.csr_matrix(
+            (np.concatenate(data) if data else np.zeros(0, dtype=np.float64),
+             np.concatenate(indices) if indices else np.zeros(0, dtype=np.int64),
+             np.asarray(indptr, dtype=np.int64)),
+            shape=(len(indptr) - 1, self._columns()))
+
+    def _row(self, term_ids, counts, total_words):
+        # The index already keeps term vectors as sorted id/count arrays, so they convert without copying per term
+        ids = np.frombuffer(term_ids, dtype=np.uint32).astype(np.int64)
+        frequencies = np.frombuffer(counts, dtype=np.uint32) / float(total_words) if total_words else np.zeros(len(ids))
+        return ids, frequencies
+
+    def document_added(self, doc_id, term_ids, counts, total_words, words):
+        """Index listener: appends a row for a new (or replaced) document."""
+        if doc_id in self.doc_rows:
+            self.document_removed(doc_id)
+
+        row = len(self.row_doc_ids)
+        if row == len(self._alive):
+            self._alive = np.concatenate([self._alive, np.zeros(max(row, 64), dtype=bool)])
+        self._alive[row] = True
+        self.doc_rows[doc_id] = row
+        self.row_doc_ids.append(doc_id)
+        self._pending_rows.append(self._row(term_ids, counts, total_words))
+        self._delta = None
+
+    def document_removed(self, doc_id):
+        """Index listener: marks the document's row as dead until the next merge drops it."""
+        row = self.doc_rows.pop(doc_id, None)
+        if row is not None:
+            self._alive[row] = False
+            self._dead += 1
+
+    def _matrices(self):
+        # Returns the (main, delta) matrices, folding the delta into the main matrix when it grew large
+        if self._delta is None and self._pending_rows:
+            indptr = np.concatenate([[0], np.cumsum([len(term_ids) for term_ids, _ in self._pending_rows])])
+            self._delta = self._csr(indptr, [term_ids for term_ids, _ in self._pending_rows],
+                                    [frequencies for _, frequencies in self._pending_rows])
+
+        delta_rows = self._delta.shape[0] if self._delta is not None else 0
+        if delta_rows >= self.merge_threshold or self._dead >= self.merge_threshold:
+            self._merge()
+        return self._matrix, self._delta
+
+    def _merge(self):
+        # Fold the delta into the main matrix and drop dead rows; row numbers change, so the row maps are rebuilt
+        columns = self._columns()
+        self._matrix.resize((self._matrix.shape[0], columns))
+        parts = [self._matrix.tocsr()]
+        if self._delta is not None:
+            self._delta.resize((self._delta.shape[0], columns))
+            parts.append(self._delta)
+        live = np.flatnonzero(self._alive[:len(self.row_doc_ids)])
+        self._matrix = sparse.vstack(parts, format='csr')[live].tocsc()
+        self.row_doc_ids = [self.row_doc_ids[row] for row in live]
+        self.doc_rows = {doc_id: row for row, doc_id in enumerate(self.row_doc_ids)}
+        self._alive = np.ones(len(live), dtype=bool)
+        self._dead = 0
+        self._pending_rows = []
+        self._delta = None
+        # Recomputed from scratch, so rounding from the incremental updates does not pile up
+        self._reset_norm_sums(self.document_frequencies())
+
+    def document_frequencies(self):
+        """Returns the df of every vocabulary id the IDF is computed from, as a float array."""
+        return np.frombuffer(self.index.document_frequency, dtype=np.uint32).astype(np.float64)
+
+    def corpus_size(self):
+        """Returns the number of documents N the IDF is computed from."""
+        return len(self.index)
+
+    def idf_vector(self, df=None):
+        """Returns the IDF of every vocabulary id, using the same formula as calculate_document_frequency."""
+        df = self.document_frequencies() if df is None else df
+        idf = np.zeros(self._columns(), dtype=np.float64)
+        present = np.flatnonzero(df > 0)
+        idf[present] = np.log(self.corpus_size() / (df[present] + 1)) + 1
+        return idf
+
+    def _main_df(self, df):
+        # df of the main matrix columns (terms interned after the last merge have no entries there)
+        columns = self._matrix.shape[1]
+        main_df = np.zeros(columns)
+        main_df[:min(columns, len(df))] = df[:columns]
+        return main_df
+
+    def _reset_norm_sums(self, df):
+        main_df = self._main_df(df)
+        squares = self._matrix.multiply(self._matrix).tocsc()
+        log_df = np.log(main_df + 1)
+        self._norm_sums = np.vstack([squares @ np.ones(len(main_df)), squares @ log_df, squares @ (log_df * log_df)])
+        self._norm_df = main_df
+
+    def _update_norm_sums(self, df):
+        # Only the columns whose df changed since the last query are read
+        main_df = self._main_df(df)
+        changed = np.flatnonzero(main_df != self._norm_df)
+        if len(changed):
+            columns = self._matrix[:, changed]
+            squares = columns.multiply(columns)
+            old_log = np.log(self._norm_df[changed] + 1)
+            new_log = np.log(main_df[changed] + 1)
+            self._norm_sums[1] += squares @ (new_log - old_log)
+            self._norm_sums[2] += squares @ (new_log * new_log - old_log * old_log)
+            self._norm_df = main_df
+
+    def _row_norms(self, df, idf):
+        # L2 norm of every row's TF-IDF vector: main rows from their kept sums, delta rows computed directly
+        self._update_norm_sums(df)
+        num_docs = self.corpus_size()
+        a = math.log(num_docs) + 1 if num_docs else 0.0
+        sums = self._norm_sums
+        parts = [np.sqrt(np.maximum(a * a * sums[0] - 2 * a * sums[1] + sums[2], 0.0))]
+        if self._delta is not None:
+            squared_idf = idf * idf
+            parts.append(np.sqrt(self._delta.multiply(self._delta) @ squared_idf[:self._delta.shape[1]]))
+        return np.concatenate(parts)
+
+    def _query_matrix(self, query_vectors):
+        # Sparse (queries x terms) matrix of TF-IDF query weights and the norm of every query
+        indptr, indices, data, query_norms = [0], [], [], []
+        for query_vector in query_vectors:
+            for term, weight in query_vector.items():
+                term_id = self.index.vocabulary.get(term)
+                if term_id is not None and weight:
+                    indices.append(term_id)
+                    data.append(weight)
+            indptr.append(len(indices))
+            query_norms.append(math.sqrt(sum(weight * weight for weight in query_vector.values())))
+        queries = sparse.csr_matrix(
+            (np.asarray(data, dtype=np.float64), np.asarray(indices, dtype=np.int64), np.asarray(indptr, dtype=np.int64)),
+            shape=(len(query_vectors), self._columns()))
+        return queries, np.asarray(query_norms, dtype=np.float64)
+
+    def score_batch(self, query_vectors):
+        """
+        Scores many TF-IDF query vectors against the whole corpus in one sparse mat-mat.
+
+        Args:
+            query_vectors: List of TF-IDF dictionaries.
+
+        Returns:
+            A dense (documents x queries) array of cosine similarities; rows of
+            removed documents are 0. Row numbers map to doc_ids via row_doc_ids.
+        """
+        matrix, delta = self._matrices()  # First, since a merge renumbers the rows
+        df = self.document_frequencies()
+        idf = self.idf_vector(df)
+        norms = self._row_norms(df, idf)
+        queries, query_norms = self._query_matrix(query_vectors)
+        # Multiply the IDF into the queries once instead of into every document
+        weighted = (queries @ sparse.diags(idf)).T.tocsr()
+
+        # Only the columns of the query terms are read from the main matrix
+        terms = np.flatnonzero(np.diff(weighted.indptr[:matrix.shape[1] + 1]))
+        parts = [(matrix[:, terms] @ weighted[terms]).toarray()]
+        if delta is not None:
+            parts.append((delta @ weighted[:delta.shape[1]]).toarray())
+        dot_products = np.vstack(parts)
+
+        denominators = np.outer(norms, query_norms)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scores = np.where(denominators > 0, dot_products / denominators, 0.0)
+        scores[~self._alive[:len(scores)]] = 0.0
+        return scores
+
+    def _top_k(self, scores, k, exclude_row, min_score):
+        if k == 0:
+            return []
+        if exclude_row is not None:
+            scores[exclude_row] = 0.0
+        candidates = np.flatnonzero(scores > min_score)
+        if k is not None and len(candidates) > k:
+            # argpartition finds the k best in linear time; only those k get sorted
+            best = np.argpartition(scores[candidates], -k)[-k:]
+            candidates = candidates[best]
+        order = candidates[np.argsort(-scores[candidates], kind='stable')]
+        return [(self.row_doc_ids[row], float(scores[row])) for row in order]
+
+    def query(self, query_vector, k=None, exclude=None, min_score=0.0):
+        """
+        Finds the documents most similar to one TF-IDF query vector.
+
+        Args:
+            query_vector: TF-IDF dictionary of the query document.
+            k: Maximum number of results (None returns every document above min_score).
+            exclude: Optional doc_id to leave out (usually the query document itself).
+            min_score: Only documents scoring strictly above this are returned.
+
+        Returns:
+            A list of (doc_id, similarity) tuples, best match first.
+        """
+        scores = self.score_batch([query_vector])[:, 0]
+        return self._top_k(scores, k, self.doc_rows.get(exclude), min_score)
+
+    def query_batch(self, query_vectors, k=None, exclude=None, min_score=0.0):
+        """
+        Batched version of query: scores all query vectors in a single sparse mat-mat.
+
+        Args:
+            query_vectors: List of TF-IDF dictionaries.
+            k: Maximum number of results per query.
+            exclude: Optional list (parallel to query_vectors) of doc_ids to leave out.
+            min_score: Only documents scoring strictly above this are returned.
+
+        Returns:
+            A list with one result list of (doc_id, similarity) tuples per query.
+        """
+        scores = self.score_batch(query_vectors)
+        excluded = exclude or [None] * len(query_vectors)
+        return [self._top_k(scores[:, column], k, self.doc_rows.get(excluded[column]), min_score)
+                for column in range(len(query_vectors))]
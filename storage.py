@@ -0,0 +1,59 @@
+import hashlib
+import os
+import tempfile
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # Bytes read from the request stream at a time
+
+
+def content_path(upload_folder, content_hash, extension):
+    """Returns the content-addressed path of a stored upload."""
+    return os.path.join(upload_folder, f"{content_hash}.{extension}")
+
+
+def store_upload(file, upload_folder, extension, consumer=None):
+    """
+    Streams an uploaded file into content-addressed storage.
+
+    The body is written to a temporary file while its SHA-256 is computed in the
+    same pass, then renamed to <sha256>.<extension>. If a file with that content
+    is already stored, the temporary copy is dropped instead, so identical uploads
+    share one file on disk.
+
+    Args:
+        file: The uploaded werkzeug FileStorage.
+        upload_folder: Folder holding the stored uploads.
+        extension: Lowercase file extension to store the upload under.
+        consumer: Optional callable receiving every chunk of bytes as it is read
+            (e.g. StreamingTokenizer.feed), so the body is processed in the same pass.
+
+    Returns:
+        A tuple (content_hash, filepath, already_stored).
+    """
+    os.makedirs(upload_folder, exist_ok=True)
+    digest = hashlib.sha256()
+
+    # The temporary name does not end in a scanned extension, so readers of the folder ignore it
+    fd, tmp_path = tempfile.mkstemp(dir=upload_folder, prefix='.upload-', suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            while True:
+                chunk = file.stream.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                out.write(chunk)
+                if consumer is not None:
+                    consumer(chunk)
+
+        content_hash = digest.hexdigest()
+        filepath = content_path(upload_folder, content_hash, extension)
+        if os.path.exists(filepath):
+            os.remove(tmp_path)
+            return content_hash, filepath, True
+
+        os.replace(tmp_path, filepath)
+        return content_hash, filepath, False
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
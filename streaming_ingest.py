@@ -0,0 +1,167 @@
+import codecs
+import io
+import re
+from collections import Counter
+
+from near_duplicates import MinHashLSH, SignatureAccumulator
+
+PUNCTUATION = re.compile(r'[^\w\s]')  # Compiled once; preprocess_text uses it too
+TRAILING_TOKEN = re.compile(r'\S+\Z')  # A token touching the end of a chunk may continue in the next one
+SNIPPET_LENGTH = 200
+KEEP_CONTENT_LIMIT = 1024 * 1024  # Characters of text kept in full for the scan response
+READ_CHUNK_SIZE = 1024 * 1024  # Bytes read from a stored file at a time
+
+
+class StreamingTokenizer:
+    """
+    Tokenizes a UTF-8 byte stream chunk by chunk, with the same result as
+    preprocess_text followed by calculate_term_frequency on the whole text.
+
+    A word cut off at the end of a chunk is carried over and completed by the
+    next one. Term counts go straight into a Counter, so memory stays bounded
+    by the vocabulary rather than the file size. The full text and word list are
+    only kept while the document is at most keep_limit characters long; only a
+    single word longer than a chunk can grow the carry-over beyond one chunk.
+    """
+
+    def __init__(self, keep_limit=KEEP_CONTENT_LIMIT, word_consumers=()):
+        # Universal newlines, like reading the file back with open(..., 'r')
+        self._decoder = io.IncrementalNewlineDecoder(codecs.getincrementaldecoder('utf-8')(), translate=True)
+        self._carry = ''
+        self._head = ''  # First SNIPPET_LENGTH + 1 characters, enough to build content_snippet
+        self._content = []
+        self._words = []
+        self.keep_limit = keep_limit
+        self.word_consumers = list(word_consumers)  # Callables receiving every batch of new words
+        self.term_counts = Counter()
+        self.total_words = 0
+        self.total_chars = 0
+        self.error = None  # Decoding error, if the stream is not valid UTF-8
+
+    def feed(self, chunk, final=False):
+        """
+        Tokenizes the next chunk of raw bytes.
+
+        Args:
+            chunk: Bytes read from the upload.
+            final: True for the last chunk; flushes the decoder and the carried-over word.
+        """
+        if self.error is not None:
+            return
+        try:
+            text = self._decoder.decode(chunk, final=final)
+        except UnicodeDecodeError as e:
+            self.error = e
+            self._content = self._words = None
+            return
+
+        self.total_chars += len(text)
+        if len(self._head) <= SNIPPET_LENGTH:
+            self._head += text[:SNIPPET_LENGTH + 1 - len(self._head)]
+        if self._content is not None:
+            if self.total_chars <= self.keep_limit:
+                self._content.append(text)
+            else:
+                self._content = self._words = None
+
+        text = self._carry + text
+        self._carry = ''
+        if not final:
+            match = TRAILING_TOKEN.search(text)
+            if match:
+                self._carry = match.group()
+                text = text[:match.start()]
+
+        words = PUNCTUATION.sub('', text.lower()).split()
+        if not words:
+            return
+        self.term_counts.update(words)
+        self.total_words += len(words)
+        if self._words is not None:
+            self._words.extend(words)
+        for consumer in self.word_consumers:
+            consumer(words)
+
+    def close(self):
+        """Flushes the last carried-over word; call once after the final chunk."""
+        self.feed(b'', final=True)
+
+    @property
+    def content_snippet(self):
+        """The first 200 characters of the text, as built by scan_document."""
+        return self._head[:SNIPPET_LENGTH] + "..." if len(self._head) > SNIPPET_LENGTH else self._head
+
+    @property
+    def content(self):
+        """The full text, or None if it was longer than keep_limit."""
+        return ''.join(self._content) if self._content is not None else None
+
+    @property
+    def words(self):
+        """The full word list, or None if the text was longer than keep_limit."""
+        return self._words
+
+    def term_frequencies(self):
+        """Term frequencies of the whole stream, as calculate_term_frequency would compute them."""
+        return {word: count / self.total_words for word, count in self.term_counts.items()}
+
+
+def _read_chunks(filepath):
+    with open(filepath, 'rb') as f:
+        while True:
+            chunk = f.read(READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+
+def analyze_text_file(filepath, bands, rows):
+    """
+    Tokenizes a stored text file and computes its MinHash signature in one pass.
+
+    Runs in the worker processes of /scan/batch, so it only returns plain picklable
+    values and never touches the indexes of the web process.
+
+    Args:
+        filepath: Path of the stored upload.
+        bands: LSH bands of the near-duplicate index the signature is meant for.
+        rows: LSH rows per band of that index.
+
+    Returns:
+        A dictionary with term_counts, total_words, signature, content_snippet and
+        error (None, or the message of the read/decode error).
+    """
+    return _analyze(_read_chunks(filepath), bands, rows)
+
+
+def analyze_text(data, bands, rows):
+    """
+    Like analyze_text_file, for text already in memory (bytes, or a memoryview of a corpus segment).
+
+    The data is fed in READ_CHUNK_SIZE slices, so a memoryview is never copied whole.
+    """
+    view = memoryview(data)
+    return _analyze((view[start:start + READ_CHUNK_SIZE] for start in range(0, len(view), READ_CHUNK_SIZE)),
+                    bands, rows)
+
+
+def _analyze(chunks, bands, rows):
+    signature_accumulator = SignatureAccumulator(MinHashLSH(bands=bands, rows=rows))
+    tokenizer = StreamingTokenizer(keep_limit=0, word_consumers=[signature_accumulator.update])
+    try:
+        for chunk in chunks:
+            tokenizer.feed(chunk)
+        tokenizer.close()
+        if tokenizer.error is not None:
+            raise tokenizer.error
+    except (OSError, UnicodeDecodeError) as e:
+        return {'term_counts': Counter(), 'total_words': 0, 'signature': None,
+                'content_snippet': None, 'error': str(e)}
+
+    return {
+        'term_counts': tokenizer.term_counts,
+        'total_words': tokenizer.total_words,
+        'signature': signature_accumulator.signature(),
+        'content_snippet': tokenizer.content_snippet,
+        'error': None,
+    }
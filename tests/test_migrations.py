@@ -0,0 +1,98 @@
+"""
+Schema migration tests: a database created by the baseline init_db.py must upgrade
+in place to the current schema, and no hot query may scan a whole table on it.
+
+Run with `python -m pytest` from the repository root.
+"""
+import sqlite3
+
+import pytest
+
+from init_db import init_db
+from migrations import MIGRATIONS, current_version, full_scans, hot_queries, migrate
+
+# The tables of the first release, before any migration
+BASELINE_SCHEMA = """
+CREATE TABLE documents (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    filename TEXT NOT NULL,
+    filepath TEXT NOT NULL,
+    user_id INTEGER NOT NULL,
+    scan_date DATETIME
+);
+CREATE TABLE credit_requests (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    status TEXT DEFAULT 'pending',
+    requested_credits INTEGER,
+    admin_notes TEXT,
+    request_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+CREATE TABLE users (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    username TEXT NOT NULL,
+    password_hash TEXT NOT NULL,
+    role TEXT DEFAULT 'user',
+    credits INTEGER DEFAULT 20,
+    last_reset TIMESTAMP
+);
+"""
+
+
+@pytest.fixture
+def baseline(tmp_path):
+    conn = sqlite3.connect(tmp_path / 'baseline.db')
+    conn.executescript(BASELINE_SCHEMA)
+    conn.execute("INSERT INTO users (username, password_hash) VALUES ('alice', 'x')")
+    conn.execute("INSERT INTO documents (filename, filepath, user_id, scan_date) "
+                 "VALUES ('a.txt', 'uploads/a.txt', 1, '2025-01-01')")
+    conn.commit()
+    yield conn
+    conn.close()
+
+
+def columns(conn, table):
+    return {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+
+
+def test_baseline_database_upgrades_to_the_latest_version(baseline):
+    applied = migrate(baseline)
+    assert applied == [version for version, _, _ in MIGRATIONS]
+    assert current_version(baseline) == MIGRATIONS[-1][0]
+    assert 'content_hash' in columns(baseline, 'documents')
+    assert {'claimed_by', 'lease_expires_at'} <= columns(baseline, 'scan_jobs')
+    for table in ('document_matches', 'daily_user_scans', 'topic_scan_counts', 'user_activity_totals',
+                  'credit_request_totals'):
+        assert columns(baseline, table), table
+    assert baseline.execute("SELECT filename FROM documents").fetchall() == [('a.txt',)]
+    assert migrate(baseline) == []
+
+
+def test_upgraded_and_fresh_databases_have_the_same_schema(baseline, tmp_path):
+    migrate(baseline)
+    init_db(str(tmp_path / 'fresh.db'))
+    fresh = sqlite3.connect(tmp_path / 'fresh.db')
+    schema = "SELECT type, name, tbl_name FROM sqlite_master WHERE name NOT LIKE 'sqlite_%' ORDER BY name"
+    try:
+        assert fresh.execute(schema).fetchall() == baseline.execute(schema).fetchall()
+        assert current_version(fresh) == current_version(baseline)
+    finally:
+        fresh.close()
+
+
+def test_hot_queries_use_an_index(baseline):
+    migrate(baseline)
+    assert full_scans(baseline) == []
+
+
+def test_check_reports_a_full_table_scan(baseline):
+    migrate(baseline)
+    baseline.execute("DROP INDEX idx_users_username")
+    assert [name for name, _ in full_scans(baseline)] == ['User.get_user_by_username']
+
+
+def test_hot_queries_are_the_statements_the_models_run():
+    import models
+    queries = {name: query for name, query, _ in hot_queries()}
+    assert queries['User.get_user_by_id'] is models.USER_BY_ID
+    assert queries['User.reserve_credits'] is models.RESERVE_CREDITS